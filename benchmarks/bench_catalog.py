@@ -0,0 +1,69 @@
+'''Benchmark remote catalog lookups on a synthetic manifest.
+
+Usage: python benchmarks/bench_catalog.py [lines]'''
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.core import version_compare
+from rudix.remote import RemotePackage, RemoteRepository
+
+
+def synthetic_manifest(lines, versions=5):
+    'Return a manifest of lines packages with a few versions each.'
+    manifest = []
+    for i in range(lines):
+        name = 'package%d' % (i // versions)
+        manifest.append('%s-%d.%d.%d.pkg' % (name, i % versions,
+                                             random.randint(0, 20),
+                                             random.randint(0, 20)))
+    random.shuffle(manifest)
+    return manifest
+
+
+def scan_versions(packages, name):
+    'Linear scan, the way get_versions used to work.'
+    versions = [RemotePackage(pkg) for pkg in packages]
+    versions = [p for p in versions if p.name == name]
+    return sorted(versions, reverse=True,
+                  cmp=lambda x, y: version_compare(x.version, y.version))
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main(lines=50000, lookups=200):
+    manifest = synthetic_manifest(lines)
+    remote = RemoteRepository()
+    names = ['package%d' % random.randint(0, lines // 5 - 1)
+             for _ in range(lookups)]
+    _, index_time = timed(remote.load_manifest, manifest)
+    print 'Manifest: %d lines' % lines
+    print 'Index build: %.3fs' % index_time
+
+    def indexed():
+        for name in names:
+            remote.latest_version(name)
+
+    def scanned():
+        for name in names[:10]:
+            scan_versions(remote.packages, name)
+
+    _, t_indexed = timed(indexed)
+    _, t_scanned = timed(scanned)
+    print 'Indexed latest_version: %.2fus per lookup' % (t_indexed / lookups * 1e6)
+    print 'Linear scan: %.2fms per lookup' % (t_scanned / 10 * 1e3)
+    for name in names[:10]:
+        assert ([p.package for p in scan_versions(remote.packages, name)] ==
+                [p.package for p in remote.get_versions(name)])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,124 @@
+'''Benchmark the latency of commands answered by the rudix daemon.
+
+The synthetic installation and catalog of bench_suite are set up, then
+every command runs in a new interpreter, first on its own (RUDIX_SOCKET
+empty) and then forwarded to a running "rudix serve".  The round trip of
+a request made from a warm interpreter is measured too, which is the
+latency left once the interpreter starts up.
+
+Usage: python benchmarks/bench_daemon.py [--packages N] [--runs N]'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import threading
+import subprocess
+from StringIO import StringIO
+
+from bench_suite import ROOT, World, Handler, Server, run_rudix, median
+
+sys.path.insert(0, ROOT)
+
+COMMANDS = [
+    ('list-v', ['--list', '--verbose']),
+    ('info', ['--info', 'pkg00000']),
+    ('search', ['--search', 'pkg0001']),
+    ('search-path', ['--search-path', '/usr/local/share/pkg00000/file0']),
+    ('status', ['--status']),
+]
+
+
+def best_and_median(args, env, runs):
+    times = []
+    for i in range(runs + 1):
+        status, elapsed = run_rudix(args, env)
+        if i:
+            times.append(elapsed)
+    return min(times), median(times), status
+
+
+def start_daemon(env, path):
+    code = ('import sys; sys.path.insert(0, %r); '
+            'from rudix.main import main; sys.exit(main(["serve"]))' % ROOT)
+    with open(os.devnull, 'w') as devnull:
+        daemon = subprocess.Popen([sys.executable, '-c', code], env=env,
+                                  stdout=devnull, stderr=devnull)
+    for _ in range(500):
+        if os.path.exists(path):
+            return daemon
+        time.sleep(0.01)
+    daemon.terminate()
+    raise RuntimeError('The daemon did not start')
+
+
+def round_trip(path, volume, args, runs):
+    'Return the best time of forwarding args from this interpreter.'
+    from rudix.daemon import forward
+    best = None
+    stdout = sys.stdout
+    for _ in range(runs):
+        sys.stdout = StringIO()
+        try:
+            start = time.time()
+            forward(args + ['--volume', volume], [volume], path=path)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--packages', type='int', default=1000,
+                      help='installed packages. Default "%default"')
+    parser.add_option('--runs', type='int', default=5,
+                      help='timed runs per command. Default "%default"')
+    options, _ = parser.parse_args(args)
+    root = tempfile.mkdtemp(prefix='rudix-bench-')
+    server = Server(('127.0.0.1', 0), Handler)
+    Handler.world = world = World(root, options.packages)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    daemon = None
+    try:
+        world.create()
+        path = os.path.join(world.cache, 'rudix.sock')
+        env = dict(os.environ,
+                   PATH=world.bin + os.pathsep + os.environ.get('PATH', ''),
+                   VOLUME=world.volume,
+                   RUDIX_SITE='http://127.0.0.1:%d' % server.server_port,
+                   RUDIX_VERSION='master',
+                   RUDIX_CACHE=world.cache,
+                   OSX_VERSION='10.13')
+        direct_env = dict(env, RUDIX_SOCKET='')
+        print '%r' % world
+        print '%-12s %10s %10s %10s %8s' % ('Command', 'Direct', 'Daemon',
+                                           'In-process', 'Speedup')
+        daemon = start_daemon(env, path)
+        # Settings are compared, so this interpreter must use the same
+        os.environ.update(env)
+        for name, args in COMMANDS:
+            direct = best_and_median(args, direct_env, options.runs)[1]
+            forwarded = best_and_median(args, env, options.runs)[1]
+            warm = round_trip(path, world.volume, args, options.runs)
+            print '%-12s %9.1fms %9.1fms %9.1fms %7.1fx' % (
+                name, direct * 1000, forwarded * 1000, warm * 1000,
+                direct / forwarded)
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+'''Benchmark the memory used by package file lists and the remote catalog.
+
+Sizes are the sum of sys.getsizeof over every object reachable from the
+structure, counting shared objects once.
+
+Usage: python benchmarks/bench_memory.py [paths] [lines]'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.core import version_key
+from rudix.local import FileList
+from rudix.remote import RemotePackage, RemoteRepository
+
+from bench_catalog import synthetic_manifest
+
+
+def deep_size(obj, seen=None):
+    'Return the bytes used by obj and everything it refers to.'
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            if hasattr(obj, name):
+                size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def synthetic_rows(paths):
+    'Return the (path, is_dir) of a package with a deep tree of paths.'
+    rows = []
+    for i in range(paths):
+        if i % 20 == 0:
+            rows.append(('usr/local/share/pkg/dir%d' % (i // 20), True))
+        else:
+            rows.append(('usr/local/share/pkg/dir%d/file-%d.txt' % (i // 20, i),
+                         False))
+    return rows
+
+
+def old_catalog(manifest):
+    'The structures load_manifest used to build.'
+    packages = [line for line in manifest if line.endswith('.pkg')]
+    index = {}
+    by_package = {}
+    for pkg in packages:
+        if pkg in by_package:
+            continue
+        p = RemotePackage(pkg)
+        p.split()
+        by_package[pkg] = p
+        index.setdefault(p.name, []).append(p)
+    for versions in index.itervalues():
+        versions.sort(key=lambda p: version_key(p.version), reverse=True)
+    return packages, index, by_package
+
+
+def main(paths=200000, lines=50000):
+    volume = '/Volumes/Macintosh HD'
+    rows = synthetic_rows(paths)
+    joined = [os.path.join(volume, path) for path, _ in rows]
+    old = deep_size(joined)
+    files = FileList(volume, rows)
+    assert files[-1] == joined[-1]
+    new = deep_size(files)
+    print 'File list: %d paths' % paths
+    print 'list of str (old): %6.1f bytes/path' % (old / float(paths))
+    print 'FileList:          %6.1f bytes/path' % (new / float(paths))
+
+    manifest = synthetic_manifest(lines)
+    old = deep_size(old_catalog(manifest))
+    remote = RemoteRepository(osx_version='10.13')
+    remote.load_manifest(manifest)
+    new = deep_size((remote.packages, remote._index))
+    print 'Catalog: %d entries' % lines
+    print 'RemotePackage records (old): %6.1f bytes/entry' % (old / float(lines))
+    print 'positions index:             %6.1f bytes/entry' % (new / float(lines))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,149 @@
+'''Benchmark catalog requests and downloads with a slow and a broken mirror.
+
+Local servers stand in for the mirrors: a fast one, one that waits
+--delay seconds before every answer and one that drops the connection
+half way through every body.  A manifest is fetched from the slow site
+alone and raced between the slow and the fast one, then a package is
+downloaded starting from the broken mirror, which fails over to the
+others.
+
+Usage: python benchmarks/bench_mirrors.py [--delay S] [--size MB] [--runs N]'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.remote import HTTPTransport, SegmentedDownload, hedged_get
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    body = ''
+    delay = 0
+    drop = False
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        start, end = 0, len(self.body) - 1
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, last = byte_range[len('bytes='):].split('-')
+            start = int(first)
+            end = min(int(last), end) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        data = self.body[start:end + 1]
+        if self.drop:
+            data = data[:len(data) // 2]
+            self.close_connection = 1
+        self.wfile.write(data)
+
+    def handle(self):
+        # Clients hang up on the mirrors that lose a race
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except IOError:
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except IOError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+def start(body, delay=0, drop=False):
+    class Mirror(Handler):
+        pass
+    Mirror.body, Mirror.delay, Mirror.drop = body, delay, drop
+    server = Server(('127.0.0.1', 0), Mirror)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/file' % server.server_port
+
+
+def best(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--delay', type='float', default=0.2,
+                      help='seconds the slow mirror waits. Default "%default"')
+    parser.add_option('--size', type='int', default=16,
+                      help='package size in MB. Default "%default"')
+    parser.add_option('--runs', type='int', default=5,
+                      help='timed runs. Default "%default"')
+    options, _ = parser.parse_args(args)
+    manifest = ''.join('pkg%05d-1.0.pkg\n' % i for i in range(5000))
+    package = os.urandom(options.size * 1024 * 1024)
+    tmp_dir = tempfile.mkdtemp(prefix='rudix-bench-')
+    servers = []
+    try:
+        slow_server, slow = start(manifest, options.delay)
+        fast_server, fast = start(manifest)
+        servers = [slow_server, fast_server]
+        path = os.path.join(tmp_dir, '00MANIFEST.txt')
+        transport = HTTPTransport()
+        alone = best(lambda: transport.get(slow, path), options.runs)
+        raced = best(lambda: hedged_get([slow, fast], path, transport=transport),
+                     options.runs)
+        print 'Manifest from the slow mirror: %7.1fms' % (alone * 1000)
+        print 'Raced with a fast mirror:      %7.1fms' % (raced * 1000)
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        broken_server, broken = start(package, drop=True)
+        good_server, good = start(package)
+        servers = [broken_server, good_server]
+        path = os.path.join(tmp_dir, 'package.pkg')
+
+        def download(urls):
+            result = SegmentedDownload(urls[0], path, HTTPTransport(),
+                                       mirrors=urls[1:]).run()
+            assert result == 200 and os.path.getsize(path) == len(package)
+
+        direct = best(lambda: download([good]), options.runs)
+        failover = best(lambda: download([broken, good]), options.runs)
+        print 'Package (%d MB):' % options.size
+        print 'from the good mirror:          %7.1fms' % (direct * 1000)
+        print 'broken mirror, then good one:  %7.1fms' % (failover * 1000)
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+'''Benchmark --outdated on a large catalog.
+
+A catalog of synthetic packages (five versions per name) is indexed and
+joined with a set of installed packages whose versions come from their
+receipts, the way --outdated does with no pkgutil.  The catalog index is
+built once per command, so it is timed apart from the join.
+
+Usage: python benchmarks/bench_outdated.py [installed] [catalog]'''
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.core import Vendor
+from rudix.local import Package
+from rudix.main import outdated_packages
+from rudix.remote import RemoteRepository
+
+from bench_catalog import synthetic_manifest
+
+
+class Installed(object):
+
+    """Class that represents a volume whose receipts were read."""
+
+    def __init__(self, names):
+        self.info = dict(('%s.%s' % (Vendor, name),
+                          ('%d.%d.%d' % (random.randint(0, 4),
+                                         random.randint(0, 20),
+                                         random.randint(0, 20)), '0'))
+                         for name in names)
+        self.packages = sorted(self.info)
+
+    def get_package(self, package_id):
+        return Package(package_id, info=self.info[package_id])
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main(installed=1000, lines=100000):
+    remote = RemoteRepository(osx_version='10.13')
+    _, index_time = timed(remote.load_manifest, synthetic_manifest(lines))
+    names = random.sample(sorted(remote._index), installed)
+    repo = Installed(names)
+    outdated, join_time = timed(outdated_packages, repo, remote)
+    print 'Catalog: %d entries, %d installed, %d outdated' % (
+        lines, installed, len(outdated))
+    print 'Catalog index: %8.1fms' % (index_time * 1000)
+    print 'Join:          %8.1fms' % (join_time * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
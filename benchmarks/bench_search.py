@@ -0,0 +1,83 @@
+'''Benchmark package name search on a synthetic catalog.
+
+Names are made of random syllables, with the odd common word such as
+lib or py, so trigrams are spread roughly the way they are in real
+package names.  Indexed queries are compared with a linear
+scan of every name.  Exit with status 1 when a kind of query takes more
+than budget milliseconds on average.
+
+Usage: python benchmarks/bench_search.py [names] [queries] [budget]'''
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.remote import NameIndex, edit_distance
+
+WORDS = ['lib', 'ssl', 'py', 'gtk', 'net', 'git', 'zip', 'db', 'xml', 'js']
+SYLLABLES = [c + v for c in 'bcdfghjklmnprstvwxz' for v in 'aeiouy'] + WORDS
+
+
+def synthetic_names(count):
+    'Return count distinct names of two to five syllables.'
+    names = set()
+    while len(names) < count:
+        names.add(''.join(random.choice(SYLLABLES)
+                          for _ in range(random.randint(2, 5))))
+    return sorted(names)
+
+
+def typo(name):
+    'Return name with one letter changed.'
+    i = random.randrange(len(name))
+    return name[:i] + random.choice('abcdefghijklmnopqrstuvwxyz') + name[i + 1:]
+
+
+def scan(names, query):
+    'Linear scan: substrings, then names within one edit.'
+    found = [name for name in names if query in name]
+    if not found:
+        found = [name for name in names if edit_distance(query, name, 1) <= 1]
+    return found
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main(count=100000, queries=200, budget=1.0):
+    names = synthetic_names(count)
+    index, build_time = timed(NameIndex, names)
+    print 'Catalog: %d names' % count
+    print 'Index build: %.3fs' % build_time
+    samples = random.sample(names, queries)
+    kinds = [('exact', samples),
+             ('prefix', [name[:2] for name in samples]),
+             ('substring', [name[1:5] for name in samples]),
+             ('typo', [typo(name) for name in samples])]
+    status = 0
+    for kind, words in kinds:
+        def indexed():
+            for word in words:
+                index.search(word)
+        _, elapsed = timed(indexed)
+        print '%-10s %8.3f ms/query' % (kind, elapsed * 1000 / queries)
+        if elapsed * 1000 / queries > budget:
+            status = 1
+    words = [typo(name) for name in samples[:5]]
+    _, elapsed = timed(lambda: [scan(names, word) for word in words])
+    print 'Linear scan (typos): %8.3f ms/query' % (elapsed * 1000 / len(words))
+    if status:
+        print 'Over the budget of %gms' % budget
+    return status
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:4]
+    sys.exit(main(*[int(arg) for arg in args[:2]] +
+                  [float(arg) for arg in args[2:]]))
@@ -0,0 +1,52 @@
+'''Benchmark the cold start of local-only commands.
+
+Each command runs in a fresh interpreter; the best of several runs is
+compared with an empty interpreter.  Exit with status 1 when a command
+takes more than budget milliseconds over the interpreter alone.
+
+Usage: python benchmarks/bench_startup.py [runs] [budget]'''
+
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+VOLUME = os.path.join(ROOT, 'tests', 'volume')
+
+COMMANDS = [['--version'],
+            ['--list', '--volume', VOLUME],
+            ['--list', '--verbose', '--volume', VOLUME]]
+
+
+def cold_start(code, runs):
+    'Return the best time of running code in a new interpreter.'
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, '-c', code], cwd=ROOT,
+                            stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def main(runs=20, budget=100):
+    base = cold_start('pass', runs)
+    print 'python (empty):           %.1fms' % (base * 1000)
+    status = 0
+    for args in COMMANDS:
+        code = 'from rudix.main import main; main(%r)' % args
+        overhead = (cold_start(code, runs) - base) * 1000
+        print '%-25s +%.1fms' % (' '.join(args[:2]), overhead)
+        if overhead > budget:
+            status = 1
+    if status:
+        print 'Over the budget of %dms' % budget
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:3]]))
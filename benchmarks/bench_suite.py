@@ -0,0 +1,329 @@
+'''Benchmark rudix commands end to end on a synthetic installation.
+
+A volume with installed packages (receipts for the stand-in pkgutil and
+installer in benchmarks/fake) and a local HTTP server with a generated
+catalog are set up in a temporary directory, then every scenario runs
+rudix in a new interpreter, once to warm the caches and then --runs
+times.  Results can be saved as JSON and compared between commits:
+
+    python benchmarks/bench_suite.py --packages 10000 --output new.json
+    python benchmarks/bench_suite.py --compare old.json
+
+Usage: python benchmarks/bench_suite.py [options] [scenario ...]'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import optparse
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+FAKE = os.path.join(ROOT, 'benchmarks', 'fake')
+
+RECEIPT = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+	<key>InstallDate</key>
+	<date>2018-03-19T08:30:00Z</date>
+	<key>InstallPrefixPath</key>
+	<string>usr/local</string>
+	<key>PackageFileName</key>
+	<string>%(name)s-%(version)s.pkg</string>
+	<key>PackageIdentifier</key>
+	<string>%(id)s</string>
+	<key>PackageVersion</key>
+	<string>%(version)s</string>
+</dict>
+</plist>
+'''
+
+# Remote package versions always carry this revision (see RemotePackage)
+REVISION = '999'
+
+# name: (arguments or a function of the world, changes the volume)
+SCENARIOS = [
+    ('list-v', ['--list', '--verbose'], False),
+    ('info', ['--info', 'pkg00000'], False),
+    ('files', ['--files', 'pkg00000'], False),
+    ('search', ['--search'], False),
+    ('search-path', lambda world: ['--search-path'] + [
+        '/usr/local/share/%s/file0' % package_name(i)
+        for i in range(0, world.packages, max(1, world.packages // 20))],
+     False),
+    ('outdated', ['--outdated', '--json'], False),
+    ('update', ['--update'], True),
+    ('apply', lambda world: ['--apply', world.freeze()], True),
+    ('remove-all', ['--remove-all', '--force'], True),
+]
+
+
+def package_name(i):
+    return 'pkg%05d' % i
+
+
+def package_files(name, count):
+    'Return the (path, is_dir) of a synthetic package.'
+    base = 'usr/local/share/' + name
+    return ([('usr/local', True), ('usr/local/share', True), (base, True)] +
+            [('%s/file%d' % (base, i), False) for i in range(count)])
+
+
+class World(object):
+
+    """Class that represents the synthetic installation and catalog."""
+
+    def __init__(self, root, packages=1000, files=10, outdated=10):
+        self.root = root
+        self.packages = packages
+        self.files = files
+        self.outdated = outdated
+        self.pristine = os.path.join(root, 'pristine')
+        self.volume = os.path.join(root, 'volume')
+        self.cache = os.path.join(root, 'cache')
+        self.bin = os.path.join(root, 'bin')
+
+    def __repr__(self):
+        return 'World(%d packages, %d files each)' % (self.packages,
+                                                      self.files)
+
+    def is_outdated(self, i):
+        return self.outdated and i % max(1, self.packages // self.outdated) == 0
+
+    def manifest(self):
+        lines = []
+        for i in range(self.packages):
+            lines.append('%s-1.0.pkg' % package_name(i))
+            if self.is_outdated(i):
+                lines.append('%s-1.1.pkg' % package_name(i))
+        return ''.join(line + '\n' for line in lines)
+
+    def package(self, name, version):
+        return json.dumps({'id': 'org.rudix.pkg.' + name,
+                           'version': '%s-%s' % (version, REVISION),
+                           'files': package_files(name, self.files)})
+
+    def freeze(self):
+        '''Write a freeze file that updates the outdated packages and
+        leaves out one package in ten, return its path.'''
+        path = os.path.join(self.root, 'freeze.txt')
+        with open(path, 'w') as f:
+            for i in range(self.packages):
+                if i % 10 == 9:
+                    continue
+                version = '1.1' if self.is_outdated(i) else '1.0'
+                f.write('%s-%s-%s.pkg\n' % (package_name(i), version, REVISION))
+        return path
+
+    def create(self):
+        receipts = os.path.join(self.pristine, 'var', 'db', 'receipts')
+        os.makedirs(receipts)
+        for i in range(self.packages):
+            name = package_name(i)
+            package_id = 'org.rudix.pkg.' + name
+            with open(os.path.join(receipts, package_id + '.plist'), 'w') as f:
+                f.write(RECEIPT % {'id': package_id, 'name': name,
+                                   'version': '1.0-' + REVISION})
+            with open(os.path.join(receipts, package_id + '.files'), 'w') as f:
+                for path, is_dir in package_files(name, self.files):
+                    f.write('%s %s\n' % ('d' if is_dir else 'f', path))
+                    full = os.path.join(self.pristine, path)
+                    if is_dir:
+                        if not os.path.isdir(full):
+                            os.makedirs(full)
+                    else:
+                        open(full, 'w').close()
+        os.mkdir(self.bin)
+        # Wrappers, so the fakes run with this interpreter
+        for tool in ('pkgutil', 'installer'):
+            path = os.path.join(self.bin, tool)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (
+                    sys.executable, os.path.join(FAKE, tool)))
+            os.chmod(path, 0755)
+        self.reset()
+
+    def reset(self):
+        'Bring the volume back to its initial state.'
+        if os.path.exists(self.volume):
+            shutil.rmtree(self.volume)
+        shutil.copytree(self.pristine, self.volume, symlinks=True)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    wbufsize = -1
+    world = None
+
+    def do_GET(self):
+        name = self.path.rsplit('/', 1)[-1]
+        if name == '00MANIFEST.txt':
+            body = self.world.manifest()
+        elif name == '00ALIASES.txt':
+            body = ''
+        elif name.endswith('.pkg'):
+            pkg, _, version = name[:-len('.pkg')].rpartition('-')
+            body = self.world.package(pkg, version)
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+def run_rudix(args, env):
+    'Run rudix in a new interpreter, return its status and duration.'
+    code = ('import sys; sys.path.insert(0, %r); '
+            'from rudix.main import main; sys.exit(main(%r))' % (ROOT, args))
+    with open(os.devnull, 'r+') as devnull:
+        start = time.time()
+        status = subprocess.call([sys.executable, '-c', code], env=env,
+                                 stdin=devnull, stdout=devnull,
+                                 stderr=devnull)
+    return status, time.time() - start
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(world, names, runs):
+    server = Server(('127.0.0.1', 0), Handler)
+    Handler.world = world
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    env = dict(os.environ,
+               PATH=world.bin + os.pathsep + os.environ.get('PATH', ''),
+               VOLUME=world.volume,
+               RUDIX_SITE='http://127.0.0.1:%d' % server.server_port,
+               RUDIX_VERSION='master',
+               RUDIX_CACHE=world.cache,
+               OSX_VERSION='10.13')
+    results = {}
+    try:
+        for name, args, destructive in SCENARIOS:
+            if names and name not in names:
+                continue
+            if callable(args):
+                args = args(world)
+            if destructive and os.getuid() != 0:
+                results[name] = {'skipped': 'requires root'}
+                print '%-12s skipped (requires root)' % name
+                continue
+            times = []
+            status = 0
+            for i in range(runs + 1):
+                if destructive:
+                    world.reset()
+                status, elapsed = run_rudix(args, env)
+                # The first run only warms the caches
+                if i:
+                    times.append(elapsed)
+            if destructive:
+                world.reset()
+            results[name] = {'times': times, 'best': min(times),
+                             'median': median(times), 'status': status}
+            print '%-12s best %8.3fs  median %8.3fs%s' % (
+                name, min(times), median(times),
+                '  (status %d)' % status if status else '')
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def compare(old, new):
+    print
+    print '%-12s %10s %10s %8s' % ('Scenario', 'Old', 'New', 'Change')
+    for name, _, _ in SCENARIOS:
+        before = old['scenarios'].get(name, {}).get('median')
+        after = new['scenarios'].get(name, {}).get('median')
+        if before is None or after is None:
+            continue
+        print '%-12s %9.3fs %9.3fs %+7.1f%%' % (name, before, after,
+                                                (after - before) / before * 100)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--packages', type='int', default=1000,
+                      help='installed packages. Default "%default"')
+    parser.add_option('--files', type='int', default=10,
+                      help='files per package. Default "%default"')
+    parser.add_option('--outdated', type='int', default=10,
+                      help='packages with an update. Default "%default"')
+    parser.add_option('--runs', type='int', default=3,
+                      help='timed runs per scenario. Default "%default"')
+    parser.add_option('--output', metavar='FILE',
+                      help='save the results as JSON to FILE')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with those saved in FILE')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help='keep the temporary directory')
+    options, names = parser.parse_args(args)
+    unknown = set(names) - set(name for name, _, _ in SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario(s): %s' % ', '.join(sorted(unknown)))
+    root = tempfile.mkdtemp(prefix='rudix-bench-')
+    try:
+        world = World(root, options.packages, options.files, options.outdated)
+        start = time.time()
+        world.create()
+        print '%r created in %.1fs' % (world, time.time() - start)
+        report = {'suite': 1,
+                  'commit': git_commit(),
+                  'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'scale': {'packages': options.packages,
+                            'files': options.files,
+                            'outdated': options.outdated},
+                  'runs': options.runs,
+                  'scenarios': run_suite(world, names, options.runs)}
+    finally:
+        if options.keep:
+            print 'Kept %s' % root
+        else:
+            shutil.rmtree(root)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print 'Results saved to %s' % options.output
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+'''Benchmark synchronizing the catalogs of several targets.
+
+A local server answers every request after --delay seconds with a
+synthetic manifest.  The catalogs of --targets targets, spread over
+--versions Rudix versions, are downloaded one request after the other
+(the way sync used to work) and then with Catalogs.sync.
+
+Usage: python benchmarks/bench_targets.py [--targets N] [--versions N] [--delay S]'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.remote import Catalogs, RemoteRepository
+
+from bench_catalog import synthetic_manifest
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    manifest = ''
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = self.manifest if self.path.endswith('00MANIFEST.txt') else ''
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+def one_by_one(targets, site, cache_dir):
+    for rudix_version, osx_version in targets:
+        remote = RemoteRepository(site, rudix_version, osx_version, cache_dir)
+        remote.load_manifest(remote.cache.fetch('00MANIFEST.txt', True))
+        remote.load_aliases(remote.cache.fetch('00ALIASES.txt', True))
+
+
+def at_once(targets, site, cache_dir):
+    Catalogs(targets, site, cache_dir).sync(True)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--targets', type='int', default=6,
+                      help='targets to synchronize. Default "%default"')
+    parser.add_option('--versions', type='int', default=2,
+                      help='Rudix versions among them. Default "%default"')
+    parser.add_option('--delay', type='float', default=0.05,
+                      help='seconds the server waits. Default "%default"')
+    parser.add_option('--lines', type='int', default=20000,
+                      help='manifest lines. Default "%default"')
+    options, _ = parser.parse_args(args)
+    Handler.manifest = '\n'.join(synthetic_manifest(options.lines)) + '\n'
+    Handler.delay = options.delay
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    site = 'http://127.0.0.1:%d' % server.server_port
+    targets = [('v%d' % (i % options.versions), '10.%d' % (8 + i))
+               for i in range(options.targets)]
+    cache_dir = tempfile.mkdtemp(prefix='rudix-bench-')
+    try:
+        print '%d targets, %d Rudix versions, %.0fms per request' % (
+            len(targets), options.versions, options.delay * 1000)
+        for name, func in (('one request at a time', one_by_one),
+                           ('Catalogs.sync', at_once)):
+            start = time.time()
+            func(targets, site, cache_dir)
+            print '%-22s %8.1fms' % (name, (time.time() - start) * 1000)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
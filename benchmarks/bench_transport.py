@@ -0,0 +1,77 @@
+'''Benchmark HTTP transports against a local keep-alive server.
+
+Usage: python benchmarks/bench_transport.py [requests] [size]'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.remote import CurlTransport, HTTPTransport
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Buffer responses so headers do not trip over Nagle's algorithm
+    wbufsize = -1
+    body = ''
+    connections = [0]
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connections[0] += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+def run(transport, url, store_path, requests):
+    Handler.connections[0] = 0
+    start = time.time()
+    for _ in range(requests):
+        code, _ = transport.get(url, store_path)
+        assert code == 200
+    elapsed = time.time() - start
+    print '%-15s %8.1f requests/s %5d connection(s)' % (
+        transport.__class__.__name__, requests / elapsed,
+        Handler.connections[0])
+
+
+def main(requests=200, size=4096):
+    Handler.body = 'x' * size
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/00MANIFEST.txt' % server.server_port
+    tmp_dir = tempfile.mkdtemp()
+    store_path = os.path.join(tmp_dir, '00MANIFEST.txt')
+    print '%d requests of %d bytes' % (requests, size)
+    try:
+        run(CurlTransport(), url, store_path, requests)
+        run(HTTPTransport(), url, store_path, requests)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,86 @@
+'''Benchmark package removal on a synthetic file tree.
+
+Usage: python benchmarks/bench_uninstall.py [files]'''
+
+import os
+import sys
+import time
+import shutil
+import fnmatch
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.core import FORBIDDEN
+from rudix.local import Remover
+
+
+def make_tree(volume, files, per_dir=100):
+    'Create a usr/local tree and return its manifest (paths, dirs).'
+    paths = [os.path.join(volume, 'usr'), os.path.join(volume, 'usr/local')]
+    dirs = list(paths)
+    for i in range(files):
+        if i % per_dir == 0:
+            d = os.path.join(volume, 'usr/local/share/d%d' % (i // per_dir))
+            os.makedirs(d)
+            paths.append(d)
+            dirs.append(d)
+        path = os.path.join(d, 'f%d' % i)
+        open(path, 'w').close()
+        paths.append(path)
+    return paths, dirs
+
+
+def old_uninstall(volume, paths):
+    'Remove paths the way Package.uninstall used to.'
+    def is_forbidden(path):
+        for pattern in FORBIDDEN:
+            if fnmatch.fnmatch(path, os.path.join(volume, pattern)):
+                return True
+        return False
+    dirs = []
+    for x in paths:
+        if is_forbidden(x):
+            continue
+        if os.path.isdir(x):
+            dirs.append(x)
+            continue
+        try:
+            os.unlink(x)
+        except OSError:
+            pass
+    dirs.sort(lambda p1, p2: p1.count('/') - p2.count('/'), reverse=True)
+    for x in dirs:
+        try:
+            os.rmdir(x)
+        except OSError:
+            pass
+
+
+def main(files=100000):
+    volume = tempfile.mkdtemp()
+    try:
+        print '%d files' % files
+        paths, dirs = make_tree(volume, files)
+        start = time.time()
+        old_uninstall(volume, paths)
+        print 'Old uninstall: %.2fs' % (time.time() - start)
+        paths, dirs = make_tree(volume, files)
+        remover = Remover(volume)
+        remover.remove(paths, dirs)
+        print 'Remover:       %.2fs' % remover.elapsed
+        print remover
+        # The same tree split among ten packages sharing the top directories
+        paths, dirs = make_tree(volume, files)
+        shared = dirs[:3]
+        packages = [shared + paths[i::10] for i in range(10)]
+        remover = Remover(volume, jobs=4)
+        remover.remove([path for package in packages for path in package], dirs)
+        print 'Remover, 10 packages, 4 jobs: %.2fs' % remover.elapsed
+        print remover
+    finally:
+        shutil.rmtree(volume)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
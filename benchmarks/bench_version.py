@@ -0,0 +1,58 @@
+'''Benchmark sorting versions with keys against the old cmp function.
+
+Usage: python benchmarks/bench_version.py [versions]'''
+
+import os
+import re
+import sys
+import time
+import random
+
+from distutils.version import LooseVersion
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from rudix.core import version_key
+
+
+def old_version_compare(v1, v2):
+    'version_compare as it was, with LooseVersion.'
+    ver_rel_re = re.compile('([^-]+)(?:-(\d+)$)?')
+    v1, r1 = ver_rel_re.match(v1).groups()
+    v2, r2 = ver_rel_re.match(v2).groups()
+    v_cmp = cmp(LooseVersion(v1), LooseVersion(v2))
+    if v_cmp == 0:
+        return cmp(int(r1 or 0), int(r2 or 0))
+    return v_cmp
+
+
+def synthetic_versions(count):
+    versions = []
+    for _ in range(count):
+        v = '.'.join(str(random.randint(0, 20))
+                     for _ in range(random.randint(1, 4)))
+        if random.random() < 0.2:
+            v += random.choice(['a', 'b', 'rc', 'e'])
+        if random.random() < 0.5:
+            v += '-%d' % random.randint(0, 10)
+        versions.append(v)
+    return versions
+
+
+def main(count=100000):
+    versions = synthetic_versions(count)
+    print '%d versions' % count
+    start = time.time()
+    by_cmp = sorted(versions, cmp=old_version_compare)
+    print 'cmp=version_compare (old): %.2fs' % (time.time() - start)
+    start = time.time()
+    by_key = sorted(versions, key=version_key)
+    print 'key=version_key (cold):    %.2fs' % (time.time() - start)
+    start = time.time()
+    sorted(versions, key=version_key)
+    print 'key=version_key (warm):    %.2fs' % (time.time() - start)
+    assert [version_key(v) for v in by_cmp] == [version_key(v) for v in by_key]
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
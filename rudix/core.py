@@ -4,10 +4,10 @@ import sys
 import os
 import re
 import subprocess
-import platform
+import time
 import fnmatch
-
-from distutils.version import LooseVersion
+import threading
+import Queue
 
 __author__ = 'Rudá Moura <ruda.moura@gmail.com>'
 __copyright__ = 'Copyright © 2005-2018 Rudá Moura'
@@ -20,6 +20,16 @@ Vendor = os.getenv('VENDOR', 'org.rudix.pkg')
 RudixSite = os.getenv(
     'RUDIX_SITE', 'https://raw.githubusercontent.com/rudix-mac/pkg')
 RudixVersion = os.getenv('RUDIX_VERSION', 'master')
+Mirrors = os.getenv('RUDIX_MIRRORS', '').replace(',', ' ').split()
+CacheDir = os.getenv('RUDIX_CACHE',
+                     os.path.expanduser('~/Library/Caches/Rudix'))
+CacheTTL = int(os.getenv('RUDIX_CACHE_TTL', 3600))
+CacheSize = int(os.getenv('RUDIX_CACHE_SIZE', 1024)) * 1024 * 1024
+Transport = os.getenv('RUDIX_TRANSPORT', 'http')
+Segments = int(os.getenv('RUDIX_SEGMENTS', 4))
+Lookahead = int(os.getenv('RUDIX_LOOKAHEAD', 2))
+TraceFile = os.getenv('RUDIX_TRACE')
+SocketPath = os.getenv('RUDIX_SOCKET', os.path.join(CacheDir, 'rudix.sock'))
 
 OSX = {'10.6': 'Snow Leopard',
        '10.7': 'Lion',
@@ -29,14 +39,27 @@ OSX = {'10.6': 'Snow Leopard',
        '10.11': 'El Capitan',
        '10.12': 'Sierra',
        '10.13': 'High Sierra'}
-try:
-    OSXVersion = platform.mac_ver()[0]
-except:
-    OSXVersion = '(unknown)'
-OSXVersion = os.getenv('OSX_VERSION', OSXVersion)
+_osx_version = None
+
+
+def get_osx_version():
+    '''Return the OS X version (like 10.13), detected on first use.
+
+    The OSX_VERSION environment variable overrides the detection.'''
+    global _osx_version
+    if _osx_version is None:
+        version = os.getenv('OSX_VERSION')
+        if version is None:
+            try:
+                import platform
+                version = platform.mac_ver()[0]
+            except:
+                version = '(unknown)'
+        if version.count('.') == 2:
+            version = version.rsplit('.', 1)[0]
+        _osx_version = version
+    return _osx_version
 
-if OSXVersion.count('.') == 2:
-    OSXVersion = OSXVersion.rsplit('.', 1)[0]
 
 FORBIDDEN = [
     'Applications',
@@ -53,7 +76,7 @@ FORBIDDEN = [
     'dev',
     'etc',
     'home',
-    'mach_kernel'
+    'mach_kernel',
     'net',
     'private',
     'sbin',
@@ -62,28 +85,51 @@ FORBIDDEN = [
     'var', ]
 
 
+_forbidden_matchers = {}
+
+
+def forbidden_matcher(volume=Volume):
+    'Return a function matching the forbidden paths of volume.'
+    if volume not in _forbidden_matchers:
+        patterns = [fnmatch.translate(os.path.join(volume, pattern))
+                    for pattern in FORBIDDEN]
+        _forbidden_matchers[volume] = re.compile('|'.join(patterns)).match
+    return _forbidden_matchers[volume]
+
+
 def is_forbidden(path, volume=Volume):
-    for pattern in FORBIDDEN:
-        if fnmatch.fnmatch(path, os.path.join(volume, pattern)):
-            return True
-    return False
+    return forbidden_matcher(volume)(path) is not None
+
+
+_ver_rel_re = re.compile(r'([^-]+)(?:-(\d+)$)?')
+_component_re = re.compile(r'(\d+|[a-z]+|\.)')
+_version_keys = {}
+
+
+def version_key(version):
+    '''Return a sort key for a software version.
+
+    Versions compare as distutils' LooseVersion and then by revision (the
+    number after the last dash), like version_compare.  Keys are memoized.'''
+    try:
+        return _version_keys[version]
+    except KeyError:
+        pass
+    match = _ver_rel_re.match(version)
+    v, r = match.groups() if match else (version, None)
+    components = []
+    for x in _component_re.split(v):
+        if x and x != '.':
+            # Python 2 orders numbers before strings, so does LooseVersion
+            components.append((0, int(x)) if x.isdigit() else (1, x))
+    key = (tuple(components), int(r or 0))
+    _version_keys[version] = key
+    return key
 
 
 def version_compare(v1, v2):
     'Compare software version'
-    ver_rel_re = re.compile('([^-]+)(?:-(\d+)$)?')
-    v1, r1 = ver_rel_re.match(v1).groups()
-    v2, r2 = ver_rel_re.match(v2).groups()
-    v_cmp = cmp(LooseVersion(v1), LooseVersion(v2))
-    # if they are in the same version, then compare the revision
-    if v_cmp == 0:
-        if r1 is None:
-            r1 = 0
-        if r2 is None:
-            r2 = 0
-        return cmp(int(r1), int(r2))
-    else:
-        return v_cmp
+    return cmp(version_key(v1), version_key(v2))
 
 
 def normalize(name):
@@ -115,20 +161,175 @@ def administrator(func):
     return new_func
 
 
-def call_with_output(args):
-    'Call a process and return its output data as a list of strings.'
+class Tracer(object):
+
+    """Class that records the time spent in external commands, HTTP
+    fetches and phases of a rudix command."""
+
+    def __init__(self, argv=None):
+        self.argv = list(argv if argv is not None else sys.argv)
+        self.started = time.time()
+        self.elapsed = None
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Tracer(%d events)' % len(self.events)
+
+    def record(self, kind, name, start, ok=True, **fields):
+        'Record an event of kind called name which began at start.'
+        event = {'kind': kind,
+                 'name': name,
+                 'start': start - self.started,
+                 'duration': time.time() - start,
+                 'ok': ok,
+                 'thread': threading.current_thread().name}
+        event.update(fields)
+        with self._lock:
+            self.events.append(event)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+
+    def summary(self):
+        'Return a table of the events grouped by kind and name.'
+        rows = {}
+        for event in self.events:
+            row = rows.setdefault((event['kind'], event['name']),
+                                  [0, 0.0, 0.0, 0, 0])
+            row[0] += 1
+            row[1] += event['duration']
+            row[2] = max(row[2], event['duration'])
+            row[3] += event.get('bytes') or 0
+            row[4] += 0 if event['ok'] else 1
+        order = {'phase': 0, 'exec': 1, 'http': 2}
+        lines = ['%-6s %-20s %6s %9s %9s %12s %6s' % (
+            'Kind', 'Name', 'Count', 'Total(s)', 'Max(s)', 'Bytes', 'Failed')]
+        for (kind, name), row in sorted(rows.items(),
+                                        key=lambda i: (order.get(i[0][0], 3),
+                                                       -i[1][1])):
+            lines.append('%-6s %-20s %6d %9.3f %9.3f %12d %6d' % (
+                (kind, name[:20]) + tuple(row)))
+        if self.elapsed is not None:
+            lines.append('Elapsed %.3fs' % self.elapsed)
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        'Write the trace as JSON to path.'
+        import json
+        with open(path, 'w') as f:
+            json.dump({'argv': self.argv,
+                       'started': self.started,
+                       'elapsed': self.elapsed,
+                       'events': self.events}, f, indent=1)
+
+
+class _Phase(object):
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.tracer.record('phase', self.name, self.start,
+                           ok=exc_type is None)
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_tracer = None
+_no_phase = _NoPhase()
+
+
+def start_tracing(argv=None):
+    'Record events from now on and return the Tracer.'
+    global _tracer
+    _tracer = Tracer(argv)
+    return _tracer
+
+
+def get_tracer():
+    'Return the active Tracer, None when not tracing.'
+    return _tracer
+
+
+def phase(name):
+    'Return a context manager recording phase name when tracing.'
+    if _tracer is None:
+        return _no_phase
+    return _tracer.phase(name)
+
+
+def iter_output(args, silent=True, status=None):
+    '''Call a process and yield its output lines as they are written.
+
+    The process is killed if the caller stops iterating early.  When
+    status is a list, the exit status is appended to it at the end (None
+    if the process could not be started).'''
+    tracer = _tracer
+    if tracer is not None:
+        start = time.time()
     try:
-        proc = subprocess.Popen(args,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+        with open(os.devnull, 'w') as dev_null:
+            proc = subprocess.Popen(args,
+                                    stdout=subprocess.PIPE,
+                                    stderr=dev_null if silent else None)
     except OSError as err:
         print >> sys.stderr, err, ': ' + ' '.join(args)
-        return []
-    return proc.communicate()[0].splitlines()
+        if tracer is not None:
+            tracer.record('exec', os.path.basename(args[0]), start, ok=False,
+                          command=args, status=None, error=str(err))
+        if status is not None:
+            status.append(None)
+        return
+    size = 0
+    done = False
+    try:
+        # readline, unlike file iteration, does not wait to fill a buffer
+        for line in iter(proc.stdout.readline, ''):
+            size += len(line)
+            yield line.rstrip('\n')
+        done = True
+    finally:
+        if not done and proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        proc.stdout.close()
+        proc.wait()
+        if status is not None:
+            status.append(proc.returncode)
+        if tracer is not None:
+            tracer.record('exec', os.path.basename(args[0]), start,
+                          ok=proc.returncode == 0, command=args,
+                          status=proc.returncode, bytes=size)
+
+
+def call_with_output(args, silent=True, status=None):
+    '''Call a process and return its output data as a list of strings.
+    The exit status is appended to status as with iter_output.'''
+    return list(iter_output(args, silent, status))
 
 
 def call(args, silent=True):
     'Call a process and return its status.'
+    tracer = _tracer
+    if tracer is not None:
+        start = time.time()
     try:
         if silent:
             with open('/dev/null') as dev_null:
@@ -138,4 +339,45 @@ def call(args, silent=True):
     except OSError as err:
         print >> sys.stderr, err, ': ' + ' '.join(args)
         sts = 1
+    if tracer is not None:
+        tracer.record('exec', os.path.basename(args[0]), start, ok=sts == 0,
+                      command=args, status=sts)
     return True if sts == 0 else False
+
+
+def parallel_map(func, items, jobs=1):
+    '''Call func for every item using up to jobs threads.
+
+    Return the results in the same order as items.'''
+    items = list(items)
+    if jobs <= 1 or len(items) < 2:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for item in enumerate(items):
+        queue.put(item)
+
+    def worker():
+        while not errors:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(jobs, len(items)))]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    for t in workers:
+        # Poll so that KeyboardInterrupt reaches the main thread
+        while t.is_alive():
+            t.join(0.1)
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
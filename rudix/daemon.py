@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+'''Rudix daemon: answer read-only commands from warm repositories.
+
+"rudix serve" keeps the remote catalog (with its aliases and name index)
+and the local repository of every volume asked about in memory, and
+listens on a Unix socket.  The rudix command forwards --list, --info,
+--outdated, --search, --search-path and --status to it when it is
+running, and runs them itself otherwise.
+
+A request is one line of JSON with the command line, the volumes, the
+working directory, the settings of the client and its standard input
+when the command reads it.  The reply is one line of JSON with the exit
+status and the output, as a list of (stream, text) in the order it was
+written.  Byte strings travel as latin-1 text, so they come back intact.'''
+
+import sys
+import os
+import time
+import json
+import errno
+import signal
+import importlib
+import socket
+import traceback
+import SocketServer
+
+from .core import Vendor, RudixSite, RudixVersion, Mirrors, CacheDir
+from .core import CacheTTL, SocketPath
+from .local import Repository
+
+# Seconds a client waits for an answer before running the command itself
+Timeout = 60
+
+# Seconds the daemon waits for a client to send its request or read the
+# reply, requests being answered one at a time
+RequestTimeout = 5
+
+
+def settings():
+    'Return the settings that a daemon must share with its clients.'
+    return {'vendor': Vendor,
+            'site': RudixSite,
+            'mirrors': Mirrors,
+            'rudix': RudixVersion,
+            'cache': CacheDir,
+            'osx': os.getenv('OSX_VERSION')}
+
+
+def _text(data):
+    return data.decode('latin-1') if isinstance(data, str) else data
+
+
+def _bytes(text):
+    return text.encode('latin-1') if isinstance(text, unicode) else text
+
+
+def forward(args, volumes, stdin=None, path=SocketPath, timeout=Timeout):
+    '''Run a command in the daemon listening on path.
+
+    Return its exit status after writing its output, or None if no daemon
+    answered, in which case nothing was written.'''
+    request = {'args': [_text(arg) for arg in args],
+               'volumes': [_text(volume) for volume in volumes],
+               'cwd': _text(os.getcwd()),
+               'settings': settings(),
+               'stdin': _text(stdin)}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + '\n')
+        reply = json.loads(sock.makefile('rb').readline())
+    except (socket.error, ValueError):
+        return None
+    finally:
+        sock.close()
+    if 'error' in reply:
+        return None
+    for stream, text in reply['output']:
+        (sys.stdout if stream == 1 else sys.stderr).write(_bytes(text))
+    return reply['status']
+
+
+class Warm(object):
+
+    """Class that represents the repositories kept by the daemon.
+
+    Local repositories are synchronized on every request, which only
+    reads the receipts that changed, and the remote catalog is
+    synchronized again when it is older than the cache TTL or a refresh
+    is asked for."""
+
+    def __init__(self, ttl=CacheTTL, cache_dir=CacheDir):
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.repositories = {}
+        self.remotes = {}
+
+    def __repr__(self):
+        return 'Warm(%d volume(s), %d catalog(s))' % (len(self.repositories),
+                                                      len(self.remotes))
+
+    def repository(self, volume):
+        # The same relative volume may be another directory for another
+        # client
+        key = (os.path.abspath(volume), volume)
+        repo = self.repositories.get(key)
+        if repo is None:
+            repo = self.repositories[key] = Repository(
+                volume, cache_dir=self.cache_dir)
+        repo.sync()
+        return repo
+
+    def remote(self, options):
+        from .remote import RemoteRepository
+        remote, synced = self.remotes.get(options.cache_only, (None, 0))
+        if remote is None or options.refresh or time.time() - synced > self.ttl:
+            remote = RemoteRepository(offline=options.cache_only)
+            if remote.sync(options.refresh) is False:
+                return None
+            self.remotes[options.cache_only] = (remote, time.time())
+        return remote
+
+    def catalogs(self, options):
+        from .remote import Catalogs, parse_targets
+        targets = parse_targets(options.targets)
+        key = (options.cache_only, tuple(targets))
+        catalogs, synced = self.remotes.get(key, (None, 0))
+        if (catalogs is None or options.refresh or
+                time.time() - synced > self.ttl):
+            catalogs = Catalogs(targets, offline=options.cache_only)
+            if len(catalogs.sync(options.refresh)) == len(catalogs):
+                return None
+            self.remotes[key] = (catalogs, time.time())
+        return catalogs
+
+
+class Output(object):
+
+    """Class that collects what is written to one stream of a command."""
+
+    def __init__(self, stream, chunks):
+        self.stream = stream
+        self.chunks = chunks
+
+    def write(self, text):
+        self.chunks.append((self.stream, _text(text)))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    timeout = RequestTimeout
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except socket.error:
+            # Timed out or gone before sending a request
+            return
+        try:
+            reply = self.server.run(json.loads(line))
+        except ValueError:
+            reply = {'error': 'bad request'}
+        try:
+            self.wfile.write(json.dumps(reply) + '\n')
+        except socket.error:
+            pass
+
+
+class Server(SocketServer.UnixStreamServer):
+
+    """Class that represents the daemon.
+
+    Requests are answered one at a time, in the daemon's process, so the
+    commands can use the standard streams and the warm repositories
+    without locking."""
+
+    def __init__(self, path=SocketPath):
+        self.path = path
+        self.warm = Warm()
+        self.settings = settings()
+        self.requests = 0
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        os.chmod(path, 0600)
+
+    def __repr__(self):
+        return "Server('%s')" % self.path
+
+    def run(self, request):
+        # rudix.main, not the main function exported by the package
+        cli = importlib.import_module('.main', __package__)
+        if request.get('settings') != self.settings:
+            return {'error': 'different settings'}
+        parser = cli.create_parser('', '')
+        try:
+            options, args = parser.parse_args(
+                [_bytes(arg) for arg in request['args']])
+        except SystemExit:
+            return {'error': 'bad command line'}
+        if options.command not in cli.Forwarded:
+            return {'error': 'not a forwarded command'}
+        options.volumes = [_bytes(volume) for volume in request['volumes']]
+        options.volume = options.volumes[0]
+        chunks = []
+        streams = sys.stdin, sys.stdout, sys.stderr
+        cwd = os.getcwd()
+        cli.warm = self.warm
+        try:
+            os.chdir(_bytes(request['cwd']))
+            if request.get('stdin') is not None:
+                import StringIO
+                sys.stdin = StringIO.StringIO(_bytes(request['stdin']))
+            sys.stdout, sys.stderr = Output(1, chunks), Output(2, chunks)
+            status = cli.run_command(options, args)
+        except SystemExit as err:
+            status = err.code
+        except Exception:
+            sys.stdin, sys.stdout, sys.stderr = streams
+            traceback.print_exc()
+            return {'error': 'command failed'}
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = streams
+            cli.warm = None
+            os.chdir(cwd)
+        self.requests += 1
+        return {'status': status or 0, 'output': chunks}
+
+
+def create_server(path=SocketPath):
+    '''Return a Server listening on path, or None if another daemon
+    already is.  A socket left behind by a daemon that died is replaced.'''
+    if not os.path.isdir(os.path.dirname(path) or os.curdir):
+        os.makedirs(os.path.dirname(path))
+    try:
+        return Server(path)
+    except socket.error as err:
+        if err.errno != errno.EADDRINUSE:
+            raise
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return None
+    except socket.error:
+        os.remove(path)
+    finally:
+        probe.close()
+    return Server(path)
+
+
+def serve(path=SocketPath):
+    'Run the daemon until it is interrupted or terminated.'
+    server = create_server(path)
+    if server is None:
+        print >> sys.stderr, "A daemon is already listening on '%s'" % path
+        return 1
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print "Listening on '%s'" % path
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        print '%d request(s) answered' % server.requests
+    return 0
@@ -1,22 +1,511 @@
 import sys
 import os
+import struct
+import calendar
+import plistlib
+import hashlib
+import sqlite3
+import bisect
+import fnmatch
+import re
+import time
+import errno
+import threading
+import array
+import itertools
 
-from .core import Vendor, call_with_output, denormalize, call, is_forbidden
+from .core import Vendor, CacheDir, call_with_output, iter_output, denormalize, call, forbidden_matcher, parallel_map
+
+# Seconds between the Unix and the Core Foundation (2001-01-01) epochs
+CF_EPOCH = 978307200
+
+
+def read_binary_plist(data):
+    'Decode a binary property list (bplist00) into Python objects.'
+    if not data.startswith('bplist00'):
+        raise ValueError('Not a binary property list')
+    offset_size, ref_size, count, top, table = struct.unpack('>6xBBQQQ',
+                                                             data[-32:])
+
+    def uint(buf, size):
+        return int(buf[:size].encode('hex'), 16)
+
+    offsets = [uint(data[table + i * offset_size:], offset_size)
+               for i in range(count)]
+
+    def length(info, pos):
+        if info != 0xF:
+            return info, pos
+        size = 1 << (ord(data[pos]) & 0xF)
+        return uint(data[pos + 1:], size), pos + 1 + size
+
+    def read(ref):
+        pos = offsets[ref]
+        marker = ord(data[pos])
+        kind, info = marker >> 4, marker & 0xF
+        pos += 1
+        if marker in (0x00, 0x08, 0x09):
+            return {0x00: None, 0x08: False, 0x09: True}[marker]
+        if kind == 0x1:
+            size = 1 << info
+            value = uint(data[pos:], size)
+            if size == 8 and value >= 1 << 63:
+                value -= 1 << 64
+            return value
+        if kind == 0x2:
+            fmt = '>f' if info == 2 else '>d'
+            return struct.unpack(fmt, data[pos:pos + (1 << info)])[0]
+        if kind == 0x3:
+            return struct.unpack('>d', data[pos:pos + 8])[0] + CF_EPOCH
+        n, pos = length(info, pos)
+        if kind == 0x4:
+            return data[pos:pos + n]
+        if kind == 0x5:
+            return data[pos:pos + n]
+        if kind == 0x6:
+            return data[pos:pos + n * 2].decode('utf-16-be')
+        refs = [uint(data[pos + i * ref_size:], ref_size)
+                for i in range(n * 2 if kind == 0xD else n)]
+        if kind == 0xA:
+            return [read(r) for r in refs]
+        if kind == 0xD:
+            return dict((read(k), read(v)) for k, v in zip(refs[:n], refs[n:]))
+        raise ValueError('Unsupported object 0x%02x' % marker)
+
+    return read(top)
+
+
+class Receipts(object):
+
+    """Class that reads package receipts straight from the receipts database."""
+
+    paths = ['private/var/db/receipts', 'var/db/receipts']
+
+    def __init__(self, volume='/', vendor=Vendor):
+        self.volume = volume
+        self.vendor = vendor
+        self.path = None
+        for path in self.paths:
+            path = os.path.join(volume, path)
+            if os.path.isdir(path):
+                self.path = path
+                break
+
+    def __repr__(self):
+        return "Receipts('%s')" % self.path
+
+    @property
+    def available(self):
+        return self.path is not None
+
+    def read(self, package_id):
+        '''Return the version and install time of a package as pkgutil
+        prints them, or None if its receipt cannot be read.'''
+        try:
+            with open(os.path.join(self.path, package_id + '.plist'), 'rb') as f:
+                data = f.read()
+            if data.startswith('bplist00'):
+                plist = read_binary_plist(data)
+                install_time = plist['InstallDate']
+            else:
+                plist = plistlib.readPlistFromString(data)
+                install_time = calendar.timegm(plist['InstallDate'].timetuple())
+            return plist['PackageVersion'], '%d' % install_time
+        except Exception:
+            # Missing or damaged receipt, leave it to pkgutil
+            return None
+
+    def stat(self):
+        '''Return a dictionary of package-id to the (mtime, size) of its
+        receipt for all packages from vendor, or None if the receipts
+        database is not available.'''
+        if not self.available:
+            return None
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return None
+        stats = {}
+        prefix = self.vendor + '.'
+        for name in names:
+            if name.startswith(prefix) and name.endswith('.plist'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                stats[name[:-len('.plist')]] = (st.st_mtime, st.st_size)
+        return stats
+
+    def load(self):
+        '''Read all receipts from vendor in one pass.
+
+        Return a dictionary of package-id to (version, install time), or
+        None if the receipts database is not available.'''
+        stats = self.stat()
+        if stats is None:
+            return None
+        return dict((package_id, self.read(package_id)) for package_id in stats)
+
+
+class Index(object):
+
+    """Class that represents the persistent index of a volume.
+
+    Package metadata and file lists are kept in a SQLite database and
+    refreshed only for packages whose receipt changed."""
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS packages (
+            package_id TEXT PRIMARY KEY,
+            version TEXT,
+            install_date TEXT,
+            receipt_mtime REAL,
+            receipt_size INTEGER,
+            files_indexed INTEGER DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS files (
+            package_id TEXT,
+            path TEXT,
+            is_dir INTEGER);
+        CREATE INDEX IF NOT EXISTS files_package ON files (package_id);
+        '''
+
+    def __init__(self, volume='/', vendor=Vendor, cache_dir=CacheDir):
+        self.volume = volume
+        self.vendor = vendor
+        key = hashlib.sha1(os.path.realpath(volume)).hexdigest()[:16]
+        path = os.path.join(cache_dir, 'index-%s.db' % key)
+        self.path = path
+        self.receipts = Receipts(volume, vendor)
+        self.db = None
+        if not self.receipts.available:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.db = sqlite3.connect(path, timeout=30,
+                                      check_same_thread=False)
+            self.db.text_factory = str
+            self.db.executescript(self.schema)
+        except (OSError, sqlite3.Error):
+            self.db = None
+
+    def __repr__(self):
+        return "Index('%s')" % self.path
+
+    @property
+    def available(self):
+        return self.db is not None
+
+    def refresh(self):
+        '''Bring the index up to date with the receipts database.
+
+        Return a dictionary of package-id to (version, install time).'''
+        stats = self.receipts.stat()
+        if stats is None:
+            return None
+        with self.db:
+            known = dict((row[0], row[1:]) for row in self.db.execute(
+                'SELECT package_id, receipt_mtime, receipt_size FROM packages'))
+            for package_id in set(known) - set(stats):
+                self.forget(package_id)
+            for package_id, stat in stats.iteritems():
+                if known.get(package_id) == stat:
+                    continue
+                version, install_date = self.receipts.read(package_id) or (None, None)
+                self.db.execute('DELETE FROM files WHERE package_id = ?',
+                                (package_id,))
+                self.db.execute('INSERT OR REPLACE INTO packages VALUES '
+                                '(?, ?, ?, ?, ?, 0)',
+                                (package_id, version, install_date) + stat)
+        return self.packages()
+
+    def packages(self):
+        'Return a dictionary of package-id to (version, install time).'
+        info = {}
+        for package_id, version, install_date in self.db.execute(
+                'SELECT package_id, version, install_date FROM packages'):
+            info[package_id] = (version, install_date) if version else None
+        return info
+
+    def files(self, package_id):
+        '''Return the relative paths and whether they are directories for
+        a package, or None if its file list is not indexed yet.'''
+        row = self.db.execute('SELECT files_indexed FROM packages '
+                              'WHERE package_id = ?', (package_id,)).fetchone()
+        if not row or not row[0]:
+            return None
+        return self.db.execute('SELECT path, is_dir FROM files '
+                               'WHERE package_id = ? ORDER BY rowid',
+                               (package_id,)).fetchall()
+
+    def iter_files(self, package_id):
+        '''Like files, but iterate over the rows instead of loading them.'''
+        row = self.db.execute('SELECT files_indexed FROM packages '
+                              'WHERE package_id = ?', (package_id,)).fetchone()
+        if not row or not row[0]:
+            return None
+        return self.db.execute('SELECT path, is_dir FROM files '
+                               'WHERE package_id = ? ORDER BY rowid',
+                               (package_id,))
+
+    def record_files(self, package_id, rows):
+        '''Yield the (path, is_dir) rows of a package while storing them.
+
+        The file list is stored only if every row was consumed.'''
+        batch = []
+        with self.db:
+            cur = self.db.execute('UPDATE packages SET files_indexed = 0 '
+                                  'WHERE package_id = ?', (package_id,))
+            indexed = cur.rowcount > 0
+            if indexed:
+                self.db.execute('DELETE FROM files WHERE package_id = ?',
+                                (package_id,))
+            for path, is_dir in rows:
+                yield path, is_dir
+                if indexed:
+                    batch.append((package_id, path, is_dir))
+                    if len(batch) >= 1000:
+                        self.db.executemany('INSERT INTO files VALUES (?, ?, ?)',
+                                            batch)
+                        batch = []
+            if indexed:
+                self.db.executemany('INSERT INTO files VALUES (?, ?, ?)', batch)
+                self.db.execute('UPDATE packages SET files_indexed = 1 '
+                                'WHERE package_id = ?', (package_id,))
+
+    def set_files(self, package_id, files, dirs):
+        'Store the file list of a package that is in the index.'
+        dirs = set(dirs)
+        with self.db:
+            cur = self.db.execute('UPDATE packages SET files_indexed = 1 '
+                                  'WHERE package_id = ?', (package_id,))
+            if cur.rowcount == 0:
+                return
+            self.db.execute('DELETE FROM files WHERE package_id = ?',
+                            (package_id,))
+            self.db.executemany('INSERT INTO files VALUES (?, ?, ?)',
+                                ((package_id, path, path in dirs)
+                                 for path in files))
+
+    def forget(self, *package_ids):
+        'Remove packages from the index.'
+        rows = [(package_id,) for package_id in package_ids]
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE package_id = ?', rows)
+            self.db.executemany('DELETE FROM packages WHERE package_id = ?', rows)
+
+
+class Remover(object):
+
+    """Class that removes package files and directories from a volume."""
+
+    batch_size = 10000
+
+    def __init__(self, volume='/', verbose=False, jobs=1):
+        self.volume = volume
+        self.verbose = verbose
+        self.jobs = jobs
+        self.forbidden = forbidden_matcher(volume)
+        self.stats = dict.fromkeys(['files', 'dirs', 'skipped', 'kept',
+                                    'missing', 'errors'], 0)
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return ('Removed %(files)d file(s) and %(dirs)d directory(ies), '
+                'skipped %(skipped)d forbidden, kept %(kept)d non-empty, '
+                '%(missing)d missing, %(errors)d error(s)' % self.stats +
+                ' in %.2fs' % self.elapsed)
+
+    def __repr__(self):
+        return "Remover('%s')" % self.volume
+
+    def _count(self, key, err=None):
+        with self._lock:
+            self.stats[key] += 1
+            if err is not None and self.verbose:
+                print >> sys.stderr, err
+
+    def _unlink(self, files):
+        '''Unlink files and return those that turned out to be directories.'''
+        dirs = []
+        files_removed = 0
+        for path in files:
+            if self.verbose:
+                print "Removing '%s'" % path
+            try:
+                os.unlink(path)
+                files_removed += 1
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    self._count('missing')
+                elif err.errno in (errno.EISDIR, errno.EPERM) and os.path.isdir(path):
+                    # The manifest did not know it is a directory
+                    dirs.append(path)
+                else:
+                    self._count('errors', err)
+        with self._lock:
+            self.stats['files'] += files_removed
+        return dirs
+
+    def remove(self, paths, dirs=None):
+        '''Remove paths, files first and then directories from the deepest.
+
+        dirs is the collection of paths that are directories, as listed
+        in the package manifest; when it is not given every path is
+        unlinked first.  See remove_entries.'''
+        if dirs is not None and not isinstance(dirs, (set, frozenset)):
+            dirs = set(dirs)
+        if dirs is None:
+            entries = ((path, None) for path in paths)
+        else:
+            entries = ((path, path in dirs) for path in paths)
+        return self.remove_entries(entries)
+
+    def remove_entries(self, entries):
+        '''Remove (path, is_dir) entries as they are produced.
+
+        is_dir None means the kind of the path is not known, so it is
+        unlinked like a file and held as a directory when unlink refuses
+        to remove it.  Files are unlinked in batches of batch_size by up
+        to jobs threads, so only directories are held until the end, when
+        they are removed from the deepest.  A path listed several times
+        (by several packages) is removed once.  Return the statistics.'''
+        start = time.time()
+        forbidden = self.forbidden
+        skipped = set()
+        files = []
+        seen = set()
+        to_rmdir = set()
+        for path, is_dir in entries:
+            if forbidden(path):
+                if path not in skipped:
+                    if self.verbose:
+                        print "Skipping '%s'" % path
+                    skipped.add(path)
+                    self.stats['skipped'] += 1
+                continue
+            if is_dir:
+                to_rmdir.add(path)
+            elif path not in seen:
+                seen.add(path)
+                files.append(path)
+                if len(files) >= self.batch_size:
+                    to_rmdir.update(self._unlink_batch(files))
+                    files = []
+        to_rmdir.update(self._unlink_batch(files))
+        for path in sorted(to_rmdir, key=lambda path: path.count('/'),
+                           reverse=True):
+            if self.verbose:
+                print "Removing directory '%s'" % path
+            try:
+                os.rmdir(path)
+                self.stats['dirs'] += 1
+            except OSError as err:
+                if err.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                    self.stats['kept'] += 1
+                elif err.errno == errno.ENOENT:
+                    self.stats['missing'] += 1
+                else:
+                    self._count('errors', err)
+        self.elapsed += time.time() - start
+        return self.stats
+
+    def _unlink_batch(self, files):
+        # Per-path messages would interleave, so verbose runs are serial
+        jobs = 1 if self.verbose else max(1, min(self.jobs, len(files) // 1000))
+        chunks = [files[i::jobs] for i in range(jobs)]
+        dirs = []
+        for extra in parallel_map(self._unlink, chunks, jobs):
+            dirs.extend(extra)
+        return dirs
+
+
+class FileList(object):
+
+    """Class that represents the file list of a package compactly.
+
+    Paths relative to the volume are kept back to back in one string,
+    with an array of where each one starts and a bytearray flagging the
+    directories (2 when it is not known), instead of one string object
+    per path; full paths are built when they are read."""
+
+    __slots__ = ('volume', '_data', '_offsets', '_dirs')
+
+    def __init__(self, volume, rows=()):
+        self.volume = volume
+        data = bytearray()
+        offsets = array.array('I', [0])
+        dirs = bytearray()
+        for path, is_dir in rows:
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            data.extend(path)
+            offsets.append(len(data))
+            dirs.append(2 if is_dir is None else 1 if is_dir else 0)
+        self._data = str(data)
+        self._offsets = offsets
+        self._dirs = dirs
+
+    def __repr__(self):
+        return 'FileList(%d paths)' % len(self)
+
+    def __len__(self):
+        return len(self._dirs)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('file list index out of range')
+        return os.path.join(self.volume,
+                            self._data[self._offsets[i]:self._offsets[i + 1]])
+
+    def __iter__(self):
+        volume, data, offsets = self.volume, self._data, self._offsets
+        for i in xrange(len(self)):
+            yield os.path.join(volume, data[offsets[i]:offsets[i + 1]])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def entries(self):
+        'Iterate over the (path, is_dir) of the files, is_dir None if unknown.'
+        for path, is_dir in itertools.izip(self, self._dirs):
+            yield path, None if is_dir == 2 else bool(is_dir)
+
+    def directories(self):
+        'Return the paths known to be directories.'
+        return [path for path, is_dir in self.entries() if is_dir]
+
+    @property
+    def nbytes(self):
+        'Memory used by the file list.'
+        return (sys.getsizeof(self) + sys.getsizeof(self._data) +
+                sys.getsizeof(self._offsets) + sys.getsizeof(self._dirs))
 
 
 class Package(object):
 
     """Class that represents a local package."""
 
-    def __init__(self, package_id, volume='/'):
+    def __init__(self, package_id, volume='/', info=None, index=None):
         self.package_id = package_id
         self.volume = volume
+        self.index = index
         self.name = denormalize(self.package_id)
         self._package = None
         self._version = None
-        self._instalL_date = None
+        self._install_date = None
+        self._installed = None
         self._files = None
         self._dirs = None
+        if info:
+            self._version, self._install_date = info
+            self._installed = True
 
     def __str__(self):
         return "Package '%s' on volume '%s'" % (self.package_id,
@@ -27,9 +516,11 @@ class Package(object):
 
     @property
     def installed(self):
-        cmd = ['pkgutil', '--volume', self.volume,
-               '--pkg-info', self.package_id]
-        return call(cmd, silent=True)
+        if self._installed is None:
+            cmd = ['pkgutil', '--volume', self.volume,
+                   '--pkg-info', self.package_id]
+            self._installed = call(cmd, silent=True)
+        return self._installed
 
     @property
     def version(self):
@@ -46,8 +537,7 @@ class Package(object):
     @property
     def package(self):
         if not self._package:
-            self.get_info()
-        self._package = '%s-%s.pkg' % (self.name, self.version)
+            self._package = '%s-%s.pkg' % (self.name, self.version)
         return self._package
 
     @property
@@ -56,6 +546,12 @@ class Package(object):
             self._files = self.get_files()
         return self._files
 
+    @property
+    def dirs(self):
+        if self._dirs is None:
+            self.get_files()
+        return self._dirs
+
     def get_info(self):
         cmd = ['pkgutil', '-v', '--volume', self.volume,
                '--pkg-info', self.package_id]
@@ -70,51 +566,127 @@ class Package(object):
                 self._install_date = line[len('install-time: '):]
         return self._version, self._install_date
 
+    def iter_files(self):
+        '''Iterate over the (path, is_dir) of the package files, with paths
+        on the volume, as they are read from the index or pkgutil.  is_dir
+        is None when it is not known.'''
+        volume = self.volume
+        for path, is_dir in self._rows():
+            if is_dir is not None:
+                is_dir = bool(is_dir)
+            yield os.path.join(volume, path), is_dir
+
+    def _rows(self):
+        indexed = self.index is not None and self.index.available
+        rows = self.index.iter_files(self.package_id) if indexed else None
+        if rows is None:
+            rows = self._pkgutil_files()
+            if indexed:
+                rows = self.index.record_files(self.package_id, rows)
+        return rows
+
+    def _pkgutil_files(self):
+        # Asking pkgutil which paths are directories would read the whole
+        # receipt before the first path, so their kind is left unknown
+        cmd = ['pkgutil', '--volume', self.volume, '--files', self.package_id]
+        for line in iter_output(cmd):
+            yield line.strip(), None
+
     def get_files(self):
-        cmd = ['pkgutil', '--volume', self.volume,
-               '--files', self.package_id]
-        out = call_with_output(cmd)
-        content = [os.path.join(self.volume, line.strip()) for line in out]
-        return content
+        files = FileList(self.volume, self._rows())
+        self._dirs = files.directories()
+        return files
 
     def uninstall(self, verbose=False):
-        dirs = []
-        for x in self.files:
-            if is_forbidden(x, self.volume):
-                if verbose:
-                    print "Skipping '%s'" % x
-                continue
-            if os.path.isdir(x):
-                dirs.append(x)
-                continue
-            if verbose:
-                print "Removing '%s'" % x
-            try:
-                os.unlink(x)
-            except OSError as err:
-                if verbose:
-                    print >> sys.stderr, err
-        dirs.sort(lambda p1, p2: p1.count('/') - p2.count('/'), reverse=True)
-        for x in dirs:
-            if verbose:
-                print "Removing directory '%s'" % x
-            try:
-                os.rmdir(x)
-            except OSError as err:
-                if verbose:
-                    print >> sys.stderr, err
+        remover = Remover(self.volume, verbose)
+        remover.remove_entries(self.iter_files())
+        if verbose:
+            print remover
         cmd = ['pkgutil', '--volume', self.volume, '--forget', self.package_id]
-        return call(cmd, silent=False)
+        status = call(cmd, silent=False)
+        if status and self.index is not None and self.index.available:
+            self.index.forget(self.package_id)
+        return status
+
+
+class PathIndex(object):
+
+    """Class that maps installed paths to the packages owning them.
+
+    Paths are kept in a sorted array so that exact paths, directory
+    prefixes (ending in '/') and glob patterns are answered with a binary
+    search, and every owned path and its parents are kept in a set that
+    quickly rejects paths no package owns."""
+
+    wildcards_re = re.compile(r'[*?[]')
+
+    def __init__(self, entries=()):
+        owners = {}
+        for path, package_id in entries:
+            owners.setdefault(path, set()).add(package_id)
+        self.paths = sorted(owners)
+        self.owners = [tuple(sorted(owners[path])) for path in self.paths]
+        self.known = set()
+        for path in self.paths:
+            while path not in self.known and path not in ('/', ''):
+                self.known.add(path)
+                path = os.path.dirname(path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        return 'PathIndex(%d paths)' % len(self.paths)
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.paths, prefix)
+        end = start
+        while end < len(self.paths) and self.paths[end].startswith(prefix):
+            end += 1
+        return start, end
+
+    def lookup(self, path):
+        'Return the sorted package-ids owning path, a prefix or a pattern.'
+        match = self.wildcards_re.search(path)
+        if match:
+            pattern = re.compile(fnmatch.translate(path))
+            start, end = self._range(path[:match.start()])
+            found = set()
+            for i in xrange(start, end):
+                if pattern.match(self.paths[i]):
+                    found.update(self.owners[i])
+            return sorted(found)
+        if path.endswith('/'):
+            if path.rstrip('/') and path.rstrip('/') not in self.known:
+                return []
+            found = set()
+            start, end = self._range(path)
+            for owners in self.owners[start:end]:
+                found.update(owners)
+            return sorted(found)
+        if path not in self.known:
+            return []
+        i = bisect.bisect_left(self.paths, path)
+        if i < len(self.paths) and self.paths[i] == path:
+            return list(self.owners[i])
+        return []
+
+    def search(self, paths):
+        'Return a list of (path, package-ids) for a batch of paths.'
+        return [(path, self.lookup(path)) for path in paths]
 
 
 class Repository(object):
 
     """Class that represents a local repository."""
 
-    def __init__(self, volume='/', vendor=Vendor):
+    def __init__(self, volume='/', vendor=Vendor, cache_dir=CacheDir):
         self.volume = volume
         self.vendor = vendor
         self.packages = []
+        self.info = {}
+        self.index = Index(volume, vendor, cache_dir)
+        self._path_index = (None, None)
 
     def __str__(self):
         return "%d packages(s) installed on volume '%s'" % (len(self.packages),
@@ -128,30 +700,88 @@ class Repository(object):
         return True
 
     def get_packages(self):
+        if self.index.available:
+            info = self.index.refresh()
+        else:
+            info = Receipts(self.volume, self.vendor).load()
+        if info is not None:
+            self.info = info
+            self.packages = sorted(info)
+            return self.packages
         cmd = ['pkgutil', '--volume', self.volume,
                '--pkgs=' + self.vendor + '.*']
         out = call_with_output(cmd)
         self.packages = [line.strip() for line in out]
         return self.packages
 
-    def install_package(self, filename, verbose=False):
+    def get_package(self, package_id):
+        '''Return a local package, with its metadata when the receipts
+        database could be read (pkgutil is asked otherwise).'''
+        return Package(package_id, volume=self.volume,
+                       info=self.info.get(package_id), index=self.index)
+
+    def install_package(self, filename, verbose=False, silent=False):
         cmd = ['installer']
         if verbose:
             cmd.append('-verbose')
         cmd.extend(['-pkg', filename, '-target', self.volume])
-        call(cmd, silent=False)
+        status = call(cmd, silent=silent)
+        if self.index.available:
+            self.index.refresh()
+        return status
 
-    def remote_install_package(self, remote_package, verbose=False):
-        path = remote_package.download(verbose=True)
-        self.install_package(path, verbose)
-        os.remove(path)
+    def get_path_index(self):
+        '''Build the index of paths owned by the installed packages, or
+        reuse the last one built if no receipt changed since.'''
+        if self.info and self._path_index[0] == self.info:
+            return self._path_index[1]
 
-    def search_path(self, path):
-        'Search for path in all packages'
-        packages = []
-        out = call_with_output(['pkgutil', '--file-info', path])
-        for line in out:
-            line = line.strip()
-            if line.startswith('pkgid: '):
-                packages.append(line[len('pkgid: '):])
-        return packages
+        def entries():
+            for package_id in self.packages:
+                for path in self.get_package(package_id).files:
+                    yield path, package_id
+        index = PathIndex(entries())
+        self._path_index = (self.info, index)
+        return index
+
+    def uninstall_packages(self, packages, verbose=False, jobs=1):
+        '''Uninstall packages as a whole.
+
+        Files and directories of all packages are removed in one pass, so
+        paths shared between packages are handled once, and then the
+        receipts are forgotten.  Return the Remover with its statistics.'''
+        remover = Remover(self.volume, verbose, jobs)
+        remover.remove_entries(entry for p in packages
+                               for entry in p.iter_files())
+        self.forget_packages([p.package_id for p in packages], jobs)
+        return remover
+
+    def forget_packages(self, package_ids, jobs=1):
+        'Forget the receipts of packages, return the ones forgotten.'
+        def forget(package_id):
+            cmd = ['pkgutil', '--volume', self.volume, '--forget', package_id]
+            return call(cmd, silent=False)
+        status = parallel_map(forget, package_ids, jobs)
+        forgotten = [p for p, sts in zip(package_ids, status) if sts]
+        if forgotten and self.index.available:
+            self.index.forget(*forgotten)
+        return forgotten
+
+    def search_paths(self, paths):
+        '''Search for a batch of paths, directory prefixes (ending in '/')
+        or glob patterns in all packages.
+
+        Return a list of (path, package-ids).'''
+        index = self.get_path_index()
+        volume = os.path.join(self.volume, '')
+        queries = []
+        for path in paths:
+            query = path
+            if not query.startswith(volume):
+                query = os.path.join(volume, query.lstrip('/'))
+            if query.endswith('/'):
+                query = os.path.join(os.path.normpath(query), '')
+            else:
+                query = os.path.normpath(query)
+            queries.append(query)
+        return zip(paths, [pkgs for _, pkgs in index.search(queries)])
@@ -4,18 +4,150 @@
 
 import sys
 import os
+import copy
+import time
 import optparse
+from StringIO import StringIO
 
 from .core import administrator, __version__, __copyright__, Volume, normalize
-from .local import Package, Repository
-from .remote import RemotePackage, RemoteRepository
+from .core import RudixVersion, OSX, get_osx_version, version_key
+from .core import parallel_map, phase, start_tracing, TraceFile, SocketPath
+from .local import Repository
+# rudix.remote (and its network modules) is imported by the commands that
+# need it, so that local commands start faster
+
+# The repositories kept by a running daemon (see rudix.daemon), if any
+warm = None
+
+
+def expand_volumes(values):
+    'Return the volumes given with --volume, reading @FILE lists.'
+    volumes = []
+    for value in values or [Volume]:
+        if value.startswith('@'):
+            with open(value[1:]) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        volumes.append(line)
+        else:
+            volumes.append(value)
+    return volumes
+
+
+def local_repository(volume):
+    'Return the synchronized local repository of volume.'
+    if warm is not None:
+        return warm.repository(volume)
+    repo = Repository(volume)
+    repo.sync()
+    return repo
+
+
+def remote_repository(options):
+    '''Return the synchronized remote repository, or None if it could not
+    be synchronized.'''
+    if warm is not None:
+        return warm.remote(options)
+    from .remote import RemoteRepository
+    remote = RemoteRepository(offline=options.cache_only)
+    if remote.sync(options.refresh) is False:
+        return None
+    return remote
+
+
+def remote_catalogs(options):
+    '''Return the synchronized Catalogs of the --target options, or None
+    if none of them could be synchronized.'''
+    if warm is not None:
+        return warm.catalogs(options)
+    from .remote import Catalogs, parse_targets
+    catalogs = Catalogs(parse_targets(options.targets),
+                        offline=options.cache_only)
+    if len(catalogs.sync(options.refresh)) == len(catalogs):
+        return None
+    return catalogs
+
+
+def unique_packages(packages):
+    'Return packages without repeated package files, in order.'
+    unique, seen = [], set()
+    for pkg in packages:
+        if pkg.package not in seen:
+            seen.add(pkg.package)
+            unique.append(pkg)
+    return unique
+
+
+def create_downloader(options):
+    from .remote import Downloader, PackageCache
+    return Downloader(options.jobs, verbose=True, cache=PackageCache(),
+                      offline=options.cache_only)
+
+
+def download_packages(options, packages, store_dir=None):
+    '''Download each distinct package once.
+
+    Return a dictionary of package file name to downloaded path (None if
+    the download failed).'''
+    unique = unique_packages(packages)
+    paths = create_downloader(options).download(unique, store_dir)
+    return dict(zip([p.package for p in unique], paths))
+
+
+def install_on_volumes(options, plans, paths):
+    '''Install packages on volumes, in order within each volume.
+
+    plans is a list of (volume, items) where items are package files or
+    remote packages, and paths.get(package file) returns where a remote
+    package was downloaded (paths is a dictionary or a Prefetch).  A
+    package that failed to download is reported and skipped, and the
+    rest are still installed.  Several volumes are installed concurrently
+    (up to --jobs) and summarized.  Return the exit status.'''
+    from .remote import RemotePackage
+    several = len(plans) > 1
+
+    def install(plan):
+        volume, items = plan
+        repo = Repository(volume)
+        failed = []
+        for item in items:
+            if isinstance(item, RemotePackage):
+                name, path = item.package, paths.get(item.package)
+            else:
+                name = path = item
+                if not several:
+                    print "Found package '%s'" % item
+            if path is None or not repo.install_package(path, options.verbose,
+                                                        silent=several):
+                failed.append(name)
+        return failed
+
+    results = parallel_map(install, plans, options.jobs if several else 1)
+    sts = 0
+    for (volume, items), failed in zip(plans, results):
+        if several:
+            print '%s: %d package(s) installed' % (volume,
+                                                   len(items) - len(failed))
+        if failed:
+            print >>sys.stderr, '%s: failed to install %s' % (volume,
+                                                             ', '.join(failed))
+            sts = 1
+    return sts
+
+
+def remove_downloaded(paths):
+    for path in paths.values():
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
 
 def command_alias(options, args=[]):
     'List aliases.'
+    from .remote import RemoteRepository
     sts = 0
-    remote = RemoteRepository()
-    if remote.sync() is False:
+    remote = RemoteRepository(offline=options.cache_only)
+    if remote.sync(options.refresh) is False:
         return 1
     if not args:
         for alias in remote.aliases:
@@ -32,58 +164,98 @@ def command_alias(options, args=[]):
 
 
 def command_search(options, args=[]):
-    'List all available (remote) packages.'
+    '''List all available (remote) packages.  With several targets every
+    package is preceded by its target.'''
     sts = 0
-    remote = RemoteRepository()
-    if remote.sync() is False:
+    catalogs = remote_catalogs(options)
+    if catalogs is None:
         return 1
-    if not args:
-        for pkg in remote.packages:
-            print pkg
+    if len(catalogs) > 1:
+        show = lambda target, pkg: '%s:%s %s' % (target + (pkg,))
     else:
-        for name in args:
+        show = lambda target, pkg: pkg
+    if not args:
+        for target, remote in catalogs:
+            for pkg in remote.packages:
+                print show(target, pkg)
+    for query in args:
+        found = []
+        for target, remote in catalogs:
+            name = query
             if remote.aliases.has_key(name):
                 name = remote.aliases[name]
-                print "Using '%s'" % name
-            versions = remote.get_versions(name)
-            if versions:
-                for p in versions:
-                    print p.package
-            else:
-                print >>sys.stderr, "No match for '%s'" % name
-                sts = 1
+                if not found:
+                    print "Using '%s'" % name
+            found.extend((target, p.package)
+                         for p in remote.get_versions(name))
+        if not found:
+            for target, remote in catalogs:
+                found.extend((target, pkg)
+                             for pkg in search_packages(remote, query))
+        if not found:
+            print >>sys.stderr, "No match for '%s'" % query
+            sts = 1
+        for target, pkg in found:
+            print show(target, pkg)
+    if catalogs.failed:
+        sts = 1
     return sts
 
 
-def command_list(options, args):
-    'List all installed packages.'
-    repo = Repository(options.volume)
-    repo.sync()
-    if not repo.packages:
-        print >>sys.stderr, 'No Rudix packages installed.'
-        return 1
+def search_packages(remote, query, limit=20):
+    'Return the latest package of every name (or alias) matching query.'
+    found = []
+    for name in remote.search(query, limit):
+        name = remote.aliases.get(name, name)
+        p = remote.latest_version(name)
+        if p and p.package not in found:
+            found.append(p.package)
+    return found
+
+
+def list_packages(volume, verbose=False):
+    'Return the lines listing the packages installed on volume.'
+    repo = local_repository(volume)
+    lines = []
     for pkg in repo.packages:
         pkg = normalize(pkg)
-        if options.verbose:
-            p = Package(pkg, volume=options.volume)
-            print '%s version %s (install: %s)' % (p.package_id,
-                                                   p.version,
-                                                   p.install_date)
+        if verbose:
+            p = repo.get_package(pkg)
+            lines.append('%s version %s (install: %s)' % (p.package_id,
+                                                          p.version,
+                                                          p.install_date))
         else:
-            print pkg
-    return 0
+            lines.append(pkg)
+    return lines
+
+
+def command_list(options, args):
+    'List all installed packages.'
+    sts = 0
+    volumes = options.volumes
+    listings = parallel_map(lambda volume: list_packages(volume,
+                                                         options.verbose),
+                            volumes, len(volumes))
+    for volume, lines in zip(volumes, listings):
+        if len(volumes) > 1:
+            print '%s:' % volume
+        if not lines:
+            print >>sys.stderr, 'No Rudix packages installed.'
+            sts = 1
+        for line in lines:
+            print line
+    return sts
 
 
 def command_info(options, args=[]):
     'Show information about installed packages.'
     sts = 0
+    repo = local_repository(options.volume)
     if not args:
-        repo = Repository(options.volume)
-        repo.sync()
         args = repo.packages
     for pkg in args:
         pkg = normalize(pkg)
-        p = Package(pkg, volume=options.volume)
+        p = repo.get_package(pkg)
         if p.installed is False:
             print >>sys.stderr, "Package '%s' is not installed" % pkg
             sts = 1
@@ -101,29 +273,37 @@ def command_info(options, args=[]):
 def command_files(options, args=[]):
     "Show package's files."
     sts = 0
+    repo = Repository(options.volume)
+    repo.sync()
     for pkg in args:
         pkg = normalize(pkg)
-        p = Package(pkg, volume=options.volume)
+        p = repo.get_package(pkg)
         if p.installed is False:
             print >>sys.stderr, "Package '%s' is not installed" % pkg
             sts = 1
             continue
         print p
-        for x in p.files:
-            if os.path.isdir(x) and not options.verbose:
+        for path, is_dir in p.iter_files():
+            if is_dir is None and not options.verbose:
+                is_dir = os.path.isdir(path)
+            if is_dir and not options.verbose:
                 continue
-            print x
+            print path
     return sts
 
 
 def command_download(options, args):
     'Download packages from Internet.'
+    from .remote import RemoteRepository
     sts = 0
     repo = Repository(options.volume)
     repo.sync()
-    remote = RemoteRepository()
-    if not remote.sync():
+    remote = RemoteRepository(offline=options.cache_only)
+    with phase('sync'):
+        synced = remote.sync(options.refresh)
+    if not synced:
         remote = None
+    to_download = []
     for name in args:
         if os.path.isfile(name):
             print "Found package '%s'" % name
@@ -132,27 +312,31 @@ def command_download(options, args):
             if remote:
                 pkg = remote.match_package(name) or remote.latest_version(name)
                 if pkg:
-                    print 'Downloading %s...' % pkg.package
-                    pkg.download(store_path=pkg.package, verbose=True)
+                    to_download.append(pkg)
                 else:
                     print >>sys.stderr, "No match for '%s'" % name
                     sts = 1
+    with phase('download'):
+        paths = download_packages(options, to_download, store_dir=os.curdir)
+    if None in paths.values():
+        sts = 1
     return sts
 
 
 @administrator
 def command_install(options, args=[]):
     'Install packages from file system or Internet.'
+    from .remote import RemotePackage, RemoteRepository
     sts = 0
-    repo = Repository(options.volume)
-    repo.sync()
-    remote = RemoteRepository()
-    if not remote.sync():
+    remote = RemoteRepository(offline=options.cache_only)
+    with phase('sync'):
+        synced = remote.sync(options.refresh)
+    if not synced:
         remote = None
+    to_install = []
     for name in args:
         if os.path.isfile(name):
-            print "Found package '%s'" % name
-            repo.install_package(name, options.verbose)
+            to_install.append(name)
         else:
             if remote:
                 if remote.aliases.has_key(name):
@@ -160,68 +344,115 @@ def command_install(options, args=[]):
                     print "Using '%s'" % name
                 pkg = remote.match_package(name) or remote.latest_version(name)
                 if pkg:
-                    print 'Downloading %s...' % pkg.package
-                    repo.remote_install_package(pkg, options.verbose)
+                    to_install.append(pkg)
                 else:
                     print >>sys.stderr, "No match for '%s'" % name
                     sts = 1
+    # Fetch remote packages once, then install everything in argument order
+    with phase('download'):
+        paths = download_packages(options, [x for x in to_install
+                                            if isinstance(x, RemotePackage)])
+    try:
+        with phase('install'):
+            sts |= install_on_volumes(options,
+                                      [(volume, to_install)
+                                       for volume in options.volumes],
+                                      paths)
+    finally:
+        remove_downloaded(paths)
     return sts
 
 
-@administrator
-def command_update(options, args):
-    'Try to update the current base of packages.'
-    repo = Repository(options.volume)
+def update_plan(volume, remote, verbose=False):
+    '''Find the packages of volume with a newer version in remote.
+
+    Return the lines describing the plan and the remote packages.'''
+    repo = Repository(volume)
     repo.sync()
-    remote = RemoteRepository()
-    if not remote.sync():
-        return 1
+    lines = []
     to_update = []
     for pkg in repo.packages:
-        p_local = Package(pkg, volume=options.volume)
+        p_local = repo.get_package(pkg)
         p_remote = remote.latest_version(p_local.name)
-        if options.verbose:
-            print "Processing package %s:" % p_local.name,
+        processing = 'Processing package %s:' % p_local.name
         if p_remote is None:
-            if options.verbose:
-                print 'No updates available'
+            if verbose:
+                lines.append(processing + ' No updates available')
             continue
-        if version_compare(p_local.version,
-                           p_remote.version) >= 0:
-            if options.verbose:
-                print 'Already in the latest version'
+        if version_key(p_local.version) >= version_key(p_remote.version):
+            if verbose:
+                lines.append(processing + ' Already in the latest version')
             continue
-        if options.verbose:
-            print 'New version available'
-        print '{0:25} {1:10} will be updated to version {2}'.format(p_local.name,
-                                                                    p_local.version,
-                                                                    p_remote.version)
+        if verbose:
+            lines.append(processing + ' New version available')
+        lines.append('{0:25} {1:10} will be updated to version {2}'.format(
+            p_local.name, p_local.version, p_remote.version))
         to_update.append(p_remote)
-    if not to_update:
-        print 'All packages are up to date'
-    else:
-        total = len(to_update)
-        for cnt, p in enumerate(to_update):
-            print '[%d/%d] Downloading %s...' % (cnt + 1, total, p.package)
-            repo.remote_install_package(p, options.verbose)
-    return 0
+    return lines, to_update
+
+
+@administrator
+def command_update(options, args):
+    'Try to update the current base of packages.'
+    from .remote import RemoteRepository, Prefetch
+    remote = RemoteRepository(offline=options.cache_only)
+    with phase('sync'):
+        synced = remote.sync(options.refresh)
+    if not synced:
+        return 1
+    volumes = options.volumes
+    with phase('plan'):
+        plans = parallel_map(lambda volume: update_plan(volume, remote,
+                                                        options.verbose),
+                             volumes, len(volumes))
+    for volume, (lines, to_update) in zip(volumes, plans):
+        if len(volumes) > 1:
+            print '%s:' % volume
+        for line in lines:
+            print line
+        if not to_update:
+            print 'All packages are up to date'
+    plans = [(volume, to_update)
+             for volume, (_, to_update) in zip(volumes, plans) if to_update]
+    if not plans:
+        return 0
+    # Download the next packages while the current one installs, so the
+    # install phase includes the downloads
+    prefetch = Prefetch(create_downloader(options),
+                        unique_packages([p for _, to_update in plans
+                                         for p in to_update]))
+    try:
+        with phase('install'):
+            return install_on_volumes(options, plans, prefetch)
+    finally:
+        prefetch.close()
+        remove_downloaded(prefetch)
+        print prefetch
 
 
 @administrator
 def command_remove(options, args=[]):
     'Remove (uninstall) one or more packages.'
     sts = 0
+    repo = Repository(options.volume)
+    repo.sync()
+    to_remove = []
     for pkg in args:
         pkg = normalize(pkg)
-        p = Package(pkg, volume=options.volume)
+        p = repo.get_package(pkg)
         if p.installed:
-            p.uninstall(options.verbose)
+            to_remove.append(p)
         else:
             if options.verbose:
                 print >>sys.stderr, '%s is not installed' % p
             else:
                 print >>sys.stderr, "Package '%s' is not installed" % pkg
             sts = 1
+    if to_remove:
+        remover = repo.uninstall_packages(to_remove, options.verbose,
+                                          options.jobs)
+        if options.verbose:
+            print remover
     return sts
 
 
@@ -238,38 +469,111 @@ def command_remove_all(options, args=[]):
     print 'Removing package(s)...'
     repo = Repository(options.volume)
     repo.get_packages()
-    for pkg in repo.packages:
-        p = Package(pkg, volume=options.volume)
-        p.uninstall(options.verbose)
+    remover = repo.uninstall_packages([repo.get_package(pkg)
+                                       for pkg in repo.packages],
+                                      options.verbose, options.jobs)
+    if options.verbose:
+        print remover
     # Remember LinuxConf...
     print 'Cry a little tear, because Rudix is not on this machine anymore...'
 
 
 def command_status(options, args):
-    'Show repositories status.'
+    'Show repositories status, of every target.'
+    osx_version = get_osx_version()
     print 'Rudix %s on OS X %s (%s)' % (RudixVersion,
-                                        OSXVersion,
-                                        OSX.get(OSXVersion, '?'))
-    repo = Repository(options.volume)
-    repo.sync()
+                                        osx_version,
+                                        OSX.get(osx_version, '?'))
+    repo = local_repository(options.volume)
     print repo
-    remote = RemoteRepository()
-    if remote.sync() is False:
+    catalogs = remote_catalogs(options)
+    if catalogs is None:
         return 1
-    print remote
-    if options.verbose:
-        if remote.aliases:
+    synced = dict(catalogs)
+    for target, remote in zip(catalogs.targets, catalogs.repositories):
+        if len(catalogs) > 1:
+            rudix_version, target_osx = target
+            print 'Rudix %s on OS X %s (%s):' % (rudix_version, target_osx,
+                                                 OSX.get(target_osx, '?')),
+        if target not in synced:
+            print 'not synchronized'
+            continue
+        print remote
+        if options.verbose and remote.aliases:
             print '%d alias(es)' % len(remote.aliases)
+    if options.verbose:
+        from .remote import get_mirrors
+        mirrors = get_mirrors()
+        if len(mirrors) > 1:
+            for site in mirrors.ranked():
+                print 'Mirror %s: %s' % (site, mirrors.describe(site))
+    return 1 if catalogs.failed else 0
+
+
+def outdated_packages(repo, remote):
+    '''Return the installed packages of repo with a newer version in
+    remote, as (local package, remote package) sorted by name.
+
+    Installed names are sorted and looked up in the catalog index in one
+    pass.  Versions come from the receipts read by repo.sync(), so pkgutil
+    is only run for packages whose receipt could not be read.'''
+    installed = sorted((repo.get_package(pkg) for pkg in repo.packages),
+                       key=lambda p: p.name)
+    outdated = []
+    for p_local, p_remote in zip(installed, remote.latest_versions(
+            [p.name for p in installed])):
+        if (p_remote is not None and
+                version_key(p_local.version) < version_key(p_remote.version)):
+            outdated.append((p_local, p_remote))
+    return outdated
+
+
+def command_outdated(options, args=[]):
+    '''List the installed packages with a newer version available, from
+    the cached catalog.'''
+    from .remote import RemoteRepository
+    catalog_options = copy.copy(options)
+    # Use the cached catalog as it is, stale or not, unless asked for a
+    # refresh or nothing is cached yet
+    if not options.refresh and RemoteRepository().cached:
+        catalog_options.cache_only = True
+    remote = remote_repository(catalog_options)
+    if remote is None:
+        return 1
+    volumes = options.volumes
+    results = parallel_map(lambda volume: outdated_packages(
+        local_repository(volume), remote), volumes, len(volumes))
+    if options.json:
+        import json
+        report = {'catalog': remote.url, 'volumes': []}
+        for volume, outdated in zip(volumes, results):
+            report['volumes'].append({'volume': volume, 'outdated': [
+                {'name': p_local.name,
+                 'package_id': p_local.package_id,
+                 'installed': p_local.version,
+                 'available': p_remote.version,
+                 'package': p_remote.package}
+                for p_local, p_remote in outdated]})
+        print json.dumps(report, indent=1, sort_keys=True)
+        return 0
+    for volume, outdated in zip(volumes, results):
+        if len(volumes) > 1:
+            print '%s:' % volume
+        for p_local, p_remote in outdated:
+            print '{0:25} {1:10} -> {2}'.format(p_local.name, p_local.version,
+                                                p_remote.version)
+        if not outdated:
+            print 'All packages are up to date'
     return 0
 
 
 def command_search_path(options, args=[]):
     'Search for path in all packages'
     sts = 0
-    repo = Repository(options.volume)
-    repo.sync()
-    for path in args:
-        pkgs = repo.search_path(path)
+    repo = local_repository(options.volume)
+    if reads_stdin(args):
+        args = [line.rstrip('\n') for line in sys.stdin if line.strip()]
+    for path, pkgs in repo.search_paths(args):
         if pkgs:
             print '%s:' % path,
             for pkg in pkgs:
@@ -281,12 +585,181 @@ def command_search_path(options, args=[]):
     return sts
 
 
+def reads_stdin(args):
+    'Whether --search-path reads the paths from standard input.'
+    return not args or args == ['-']
+
+
 def command_freeze(options, args=[]):
     'Output installed packages in package file format.'
     repo = Repository(options.volume)
     repo.sync()
     for pkg in repo.packages:
-        print Package(pkg, volume=options.volume).package
+        print repo.get_package(pkg).package
+
+
+def split_package(package, known):
+    '''Split a name-version.pkg file name into its name and version.
+
+    Names and versions may both contain dashes, so the longest name for
+    which known(name) is true and whose version starts with a digit is
+    taken.  Return None when there is none.'''
+    if not package.endswith('.pkg'):
+        return None
+    stem = package[:-len('.pkg')]
+    i = len(stem)
+    while True:
+        i = stem.rfind('-', 0, i)
+        if i <= 0:
+            return None
+        name, version = stem[:i], stem[i + 1:]
+        if version[:1].isdigit() and known(name):
+            return name, version
+
+
+def read_freeze(path):
+    'Return the package file names listed in a freeze file (- for stdin).'
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def apply_plan(repo, packages, get_remote):
+    '''Compare the packages of a freeze file with the ones installed.
+
+    Return the plan, as a list of (action, local package, remote package)
+    with action one of add, upgrade, downgrade, remove and keep, and the
+    lines of the freeze file that did not match an available package.
+    get_remote() returns the synchronized catalog, or None, and is only
+    called when a package is not installed in the version asked for.'''
+    installed = {}
+    for pkg in repo.packages:
+        p = repo.get_package(pkg)
+        installed[p.name] = p
+    catalog = []
+    plan = []
+    errors = []
+    wanted = set()
+    for package in packages:
+        parts = split_package(package, installed.__contains__)
+        if parts and installed[parts[0]].version == parts[1]:
+            name = parts[0]
+            entry = ('keep', installed[name], None)
+        else:
+            if not catalog:
+                catalog.append(get_remote())
+            remote = catalog[0]
+            parts = remote and split_package(
+                package, lambda name: len(remote.get_versions(name)) > 0)
+            if not parts:
+                errors.append(package)
+                continue
+            name, version = parts
+            # Catalog file names carry the version without the revision
+            matches = [p for p in remote.get_versions(name)
+                       if version in (p.version, p.version.rsplit('-', 1)[0])]
+            if not matches:
+                errors.append(package)
+                continue
+            p_local, p_remote = installed.get(name), matches[0]
+            if p_local is None:
+                entry = ('add', None, p_remote)
+            else:
+                order = cmp(version_key(p_local.version),
+                            version_key(p_remote.version))
+                action = {-1: 'upgrade', 0: 'keep', 1: 'downgrade'}[order]
+                entry = (action, p_local, None if order == 0 else p_remote)
+        if name in wanted:
+            errors.append(package)
+            continue
+        wanted.add(name)
+        plan.append(entry)
+    for name in sorted(set(installed) - wanted):
+        plan.append(('remove', installed[name], None))
+    return plan, errors
+
+
+@administrator
+def command_apply(options, args=[]):
+    '''Install, upgrade, downgrade and remove packages so that the ones
+    installed are those of a freeze file.'''
+    from .remote import Prefetch
+    if len(args) != 1:
+        print >>sys.stderr, 'A freeze file (or - for standard input) is expected'
+        return 1
+    start = time.time()
+    with phase('plan'):
+        try:
+            packages = read_freeze(args[0])
+        except IOError as err:
+            print >>sys.stderr, err
+            return 1
+        repo = local_repository(options.volume)
+        plan, errors = apply_plan(repo, packages,
+                                  lambda: remote_repository(options))
+    planned = time.time()
+    if errors:
+        for package in errors:
+            print >>sys.stderr, "No match for '%s' (or listed twice)" % package
+        print >>sys.stderr, 'Nothing was changed'
+        return 1
+    counts = dict.fromkeys(['add', 'upgrade', 'downgrade', 'remove', 'keep'], 0)
+    for action, p_local, p_remote in plan:
+        counts[action] += 1
+        if action == 'keep' and not options.verbose:
+            continue
+        versions = [p.version for p in (p_local, p_remote) if p is not None]
+        print '%-9s %-25s %s' % (action.capitalize(),
+                                 (p_local or p_remote).name,
+                                 ' -> '.join(versions))
+    print ('%(add)d to add, %(upgrade)d to upgrade, %(downgrade)d to '
+           'downgrade, %(remove)d to remove, %(keep)d unchanged' % counts)
+    to_remove = [p for action, p, _ in plan if action == 'remove']
+    to_install = [p for action, _, p in plan
+                  if action in ('add', 'upgrade', 'downgrade')]
+    sts = 0
+    if to_remove:
+        with phase('remove'):
+            remover = repo.uninstall_packages(to_remove, options.verbose,
+                                              options.jobs)
+        if options.verbose:
+            print remover
+    removed = time.time()
+    if to_install:
+        # Download the next packages while the current one installs
+        prefetch = Prefetch(create_downloader(options), to_install)
+        try:
+            with phase('install'):
+                sts = install_on_volumes(options,
+                                         [(options.volume, to_install)],
+                                         prefetch)
+        finally:
+            prefetch.close()
+            remove_downloaded(prefetch)
+            print prefetch
+    end = time.time()
+    print 'Plan %.2fs, remove %.2fs, install %.2fs, total %.2fs' % (
+        planned - start, removed - planned, end - removed, end - start)
+    return sts
+
+
+def command_serve(options, args=[]):
+    'Answer commands of other rudix processes from warm repositories.'
+    from .daemon import serve
+    return serve(SocketPath)
+
+
+# Commands that share their work among several volumes
+MultiVolume = [command_list, command_install, command_update,
+               command_outdated]
+
+# Commands answered by a running daemon
+Forwarded = [command_list, command_info, command_search, command_search_path,
+             command_status, command_outdated]
 
 
 def create_parser(usage, version):
@@ -294,10 +767,31 @@ def create_parser(usage, version):
                                    version=version)
     parser.add_option('-v', '--verbose', action='store_true', default=False,
                       help='displays more information when available')
-    parser.add_option('--volume', default=Volume,
-                      help='set volume to use. Default "%default"')
+    parser.add_option('--volume', action='append', dest='volumes',
+                      metavar='VOLUME',
+                      help='set volume to use, repeat or use @FILE (one '
+                      'volume per line) for several volumes. Default "%s"' % Volume)
     parser.add_option('--force', action='store_true', default=False,
                       help='force operation')
+    parser.add_option('--refresh', action='store_true', default=False,
+                      help='ignore the cached catalog and download it again')
+    parser.add_option('--target', action='append', dest='targets',
+                      metavar='RUDIX:OSX',
+                      help='Rudix and OS X versions of the catalog used by '
+                      '--status and --search, repeat for several. Default '
+                      '"%s:" (this OS X)' % RudixVersion)
+    parser.add_option('--cache-only', '--offline', action='store_true',
+                      default=False,
+                      help='use only cached package lists and packages')
+    parser.add_option('--profile', action='store_true', default=False,
+                      help='time external commands, HTTP requests and '
+                      'phases, and print a summary at exit (the trace is '
+                      'saved to $RUDIX_TRACE or rudix-trace.json)')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='print --outdated as JSON')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help='number of parallel downloads and removal '
+                      'workers. Default "%default"')
     commands = optparse.OptionGroup(parser,
                                     'Commands',
                                     'The Package manager commands.')
@@ -328,26 +822,58 @@ def create_parser(usage, version):
     commands.add_option('-t', '--status', action='store_const', dest='command',
                         const=command_status,
                         help='show repository status')
+    commands.add_option('-o', '--outdated', action='store_const', dest='command',
+                        const=command_outdated,
+                        help='list the packages that --update would update, '
+                        'from the cached catalog')
     commands.add_option('-s', '--search', action='store_const', dest='command',
                         const=command_search,
                         help='search for remote packages')
     commands.add_option('-S', '--search-path', action='store_const', dest='command',
                         const=command_search_path,
-                        help='search for path in all packages and print if matched')
+                        help='search for path, directory (ending in "/") or '
+                        'pattern in all packages and print if matched; '
+                        'read paths from standard input if none or "-" given')
     commands.add_option('-a', '--alias', action='store_const', dest='command',
                         const=command_alias,
                         help='list aliases')
     commands.add_option('-z', '--freeze', action='store_const', dest='command',
                         const=command_freeze,
                         help='freeze package list.')
+    commands.add_option('--apply', action='store_const', dest='command',
+                        const=command_apply,
+                        help='add, upgrade and remove packages so that the '
+                        'installed ones are those of a freeze file (FILE or '
+                        '"-")')
+    commands.add_option('--serve', action='store_const', dest='command',
+                        const=command_serve,
+                        help='run a daemon that keeps the repositories in '
+                        'memory and answers --list, --info, --outdated, '
+                        '--search, --search-path and --status for other rudix '
+                        'commands (see $RUDIX_SOCKET)')
     parser.add_option_group(commands)
     parser.set_defaults(command=command_list)
     return parser
 
 
+def run_command(options, args):
+    'Run the command of options, on each volume unless it handles several.'
+    if len(options.volumes) > 1 and options.command not in MultiVolume:
+        status = 0
+        for volume in options.volumes:
+            print '%s:' % volume
+            volume_options = copy.copy(options)
+            volume_options.volume = volume
+            volume_options.volumes = [volume]
+            status |= options.command(volume_options, list(args)) or 0
+        return status
+    return options.command(options, args)
+
+
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    argv = ['rudix'] + list(args)
     usage = 'Usage: %prog command [options] [arguments]'
     version = 'Rudix Package Manager (%prog) version ' + __version__ + '\n'
     version += __copyright__
@@ -357,10 +883,40 @@ def main(args=None):
         command = args[0]
         if command.startswith('-') is False:
             args[0] = '--' + command
+    line = list(args)
     (options, args) = parser.parse_args(args)
     try:
-        status = options.command(options, args)
+        options.volumes = expand_volumes(options.volumes)
+    except IOError as err:
+        parser.error(err)
+    options.volume = options.volumes[0]
+    tracer = None
+    if options.profile or TraceFile:
+        tracer = start_tracing(argv)
+    try:
+        status = None
+        if (tracer is None and options.command in Forwarded and
+                SocketPath and os.path.exists(SocketPath)):
+            from .daemon import forward
+            stdin = None
+            if options.command is command_search_path and reads_stdin(args):
+                stdin = sys.stdin.read()
+                sys.stdin = StringIO(stdin)
+            status = forward(line, options.volumes, stdin, SocketPath)
+        if status is None:
+            status = run_command(options, args)
     except KeyboardInterrupt:
         print >> sys.stderr, '\nInterrupted!'
         status = 1
+    finally:
+        if tracer is not None:
+            tracer.finish()
+            path = TraceFile or 'rudix-trace.json'
+            try:
+                tracer.dump(path)
+            except IOError as err:
+                print >> sys.stderr, 'Could not save the trace: %s' % err
+            else:
+                print >> sys.stderr, tracer.summary()
+                print >> sys.stderr, 'Trace saved to %s' % path
     return status
@@ -2,24 +2,1051 @@ import sys
 import os
 import re
 import tempfile
+import threading
+import time
+import json
+import hashlib
+import httplib
+import urlparse
+import socket
+import email.utils
+import shutil
+import fcntl
+import gzip
+import zlib
+import StringIO
+import Queue
+import array
+import bisect
+import heapq
 
-from .core import RudixSite, RudixVersion, OSXVersion, administrator, call, call_with_output
+from .core import RudixSite, RudixVersion, Mirrors, get_osx_version, CacheDir, CacheTTL, CacheSize, Transport, Segments, Lookahead, get_tracer, call_with_output, normalize, version_key, parallel_map
+
+
+BlockSize = 4 * 1024 * 1024
+
+
+def _progress(done, total, out=sys.stderr):
+    'Draw a curl like progress bar.'
+    if total:
+        width = 72
+        out.write('\r%-*s %5.1f%%' % (width, '#' * (width * done // total),
+                                      100.0 * done / total))
+    else:
+        out.write('\r%d bytes' % done)
+    out.flush()
+
+
+def _parse_headers(block):
+    headers = {}
+    for line in block.splitlines()[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    return headers
+
+
+def _set_mtime(path, headers):
+    'Set the modification time of path from a Last-Modified header.'
+    mtime = email.utils.parsedate_tz(headers.get('last-modified') or '')
+    if mtime:
+        mtime = email.utils.mktime_tz(mtime)
+        os.utime(path, (mtime, mtime))
+
+
+def _trace_get(tracer, name, url, start, code, headers):
+    'Record a GET of url in tracer.'
+    size = headers.get('content-length')
+    tracer.record('http', name, start, ok=code in (200, 304), url=url,
+                  status=code, bytes=int(size) if size and code == 200 else 0)
+
+
+class CurlTransport(object):
+
+    """Class that retrieves URLs with the curl command."""
+
+    def __repr__(self):
+        return 'CurlTransport()'
+
+    def get(self, url, store_path, headers={}, resume=False, verbose=False):
+        '''Retrieve url into store_path.
+
+        Return the HTTP status code (0 when the server could not be reached)
+        and the response headers as a dictionary with lower case keys.
+        A resumed (206) transfer reports status 200.'''
+        header_path = store_path + '.headers'
+        cmd = ['curl', '--location', '--remote-time',
+               '--output', store_path, '--dump-header', header_path,
+               '--write-out', '%{http_code}']
+        if resume:
+            cmd.extend(['--continue-at', '-'])
+        for key, value in headers.items():
+            cmd.extend(['--header', '%s: %s' % (key, value)])
+        if verbose:
+            cmd.append('--progress-bar')
+        else:
+            cmd.append('--silent')
+        cmd.append(url)
+        tracer = get_tracer()
+        if tracer is not None:
+            start = time.time()
+        status = []
+        out = call_with_output(cmd, silent=not verbose, status=status)
+        try:
+            code = int(out[-1]) if out else 0
+        except ValueError:
+            code = 0
+        if code == 206 or (code == 416 and resume):
+            # Resumed, or there was nothing left to resume
+            code = 200
+        elif status != [0]:
+            # A transfer cut short still reports the status of its headers
+            code = 0
+        try:
+            with open(header_path) as f:
+                # Only the last response counts when redirects were followed
+                block = f.read().replace('\r', '').strip().split('\n\n')[-1]
+            os.remove(header_path)
+        except (IOError, OSError):
+            block = ''
+        headers = _parse_headers(block)
+        if tracer is not None:
+            _trace_get(tracer, 'curl', url, start, code, headers)
+        return code, headers
+
+
+class HTTPTransport(object):
+
+    """Class that retrieves URLs over a pool of keep-alive connections."""
+
+    chunk_size = 64 * 1024
+    max_redirects = 5
+
+    def __init__(self, timeout=60, max_idle=4, fallback=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.fallback = fallback
+        self.stats = {'requests': 0, 'connections': 0}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'HTTPTransport(%r)' % self.stats
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.stats['connections'] += 1
+        scheme, host = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        'Close all idle connections.'
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+    def _request(self, url, headers):
+        '''Send a GET request, reusing a pooled connection if possible.
+
+        Return the connection key, connection and response.'''
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise httplib.InvalidURL(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                with self._lock:
+                    self.stats['requests'] += 1
+                return key, conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # The server may have dropped an idle connection
+                if not reused:
+                    raise
+
+    def open(self, url, headers={}):
+        '''Send a GET request for url, following redirects.
+
+        Return the response and a function to call, once the body has
+        been read, to give the connection back to the pool (or with True
+        to close it, when the transfer failed).'''
+        for _ in range(self.max_redirects + 1):
+            key, conn, resp = self._request(url, headers)
+            location = resp.getheader('location')
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                resp.read()
+                self._release(key, conn)
+                url = urlparse.urljoin(url, location)
+                continue
+            break
+
+        def release(broken=False):
+            if broken or resp.will_close or not resp.isclosed():
+                conn.close()
+            else:
+                self._release(key, conn)
+
+        return resp, release
+
+    def _get(self, url, store_path, headers, resume, verbose):
+        headers = dict(headers)
+        offset = 0
+        if resume and os.path.isfile(store_path):
+            offset = os.path.getsize(store_path)
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+        resp, release = self.open(url, headers)
+        broken = True
+        try:
+            status = resp.status
+            received = dict(resp.getheaders())
+            if status == 416 and offset:
+                # Nothing left to resume, the file is complete
+                resp.read()
+                status = 200
+            elif status in (200, 206):
+                # A Range asked for by the caller is not a resumed transfer
+                resumed = status == 206 and offset
+                self.save(resp, store_path, offset if resumed else 0, verbose)
+                if status == 206:
+                    status = 200
+                _set_mtime(store_path, received)
+            else:
+                resp.read()
+            broken = False
+        finally:
+            release(broken)
+        return status, received
+
+    def save(self, resp, store_path, offset=0, verbose=False):
+        '''Write the body of resp into store_path, after its first offset
+        bytes (which are kept).  Raise IOError if it comes short.'''
+        done = offset
+        total = resp.length + done if resp.length is not None else None
+        with open(store_path, 'ab' if offset else 'wb') as f:
+            while True:
+                chunk = resp.read(self.chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                done += len(chunk)
+                if verbose:
+                    _progress(done, total)
+        if verbose:
+            print >> sys.stderr
+        if total is not None and done < total:
+            raise IOError('Connection closed after %d of %d bytes' % (done,
+                                                                     total))
+
+    def get(self, url, store_path, headers={}, resume=False, verbose=False):
+        '''Retrieve url into store_path, streaming the body in chunks.
+
+        Return the HTTP status code (0 when the server could not be reached)
+        and the response headers as a dictionary with lower case keys.
+        A resumed (206) transfer reports status 200.'''
+        tracer = get_tracer()
+        if tracer is not None:
+            start = time.time()
+        try:
+            code, received = self._get(url, store_path, headers, resume,
+                                       verbose)
+        except (httplib.HTTPException, socket.error, IOError) as err:
+            if self.fallback is not None:
+                return self.fallback.get(url, store_path, headers,
+                                         resume, verbose)
+            print >> sys.stderr, '%s: %s' % (url, err)
+            code, received = 0, {}
+        if tracer is not None:
+            _trace_get(tracer, 'GET', url, start, code, received)
+        return code, received
+
+
+Transports = {'curl': CurlTransport,
+              'http': lambda: HTTPTransport(fallback=CurlTransport())}
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name=None):
+    'Return the shared transport called name (RUDIX_TRANSPORT by default).'
+    name = name or Transport
+    with _transports_lock:
+        if name not in _transports:
+            _transports[name] = Transports[name]()
+        return _transports[name]
+
+
+class MirrorSet(object):
+
+    """Class that represents the Rudix site and its mirrors.
+
+    Mirrors are ranked by the time they take to send the first probe_size
+    bytes of the manifest, all probed at once.  The ranking is cached for
+    ttl seconds, so only the first command after that pays for it, and
+    sites that fail during a command are moved last.  A single site is
+    never probed."""
+
+    probe_size = 64 * 1024
+
+    def __init__(self, sites, rudix_version=RudixVersion, cache_dir=CacheDir,
+                 ttl=CacheTTL):
+        self.sites = []
+        for site in sites:
+            site = site.rstrip('/')
+            if site not in self.sites:
+                self.sites.append(site)
+        self.probe_path = '/%s/00MANIFEST.txt' % rudix_version
+        self.path = os.path.join(cache_dir, 'mirrors.json')
+        self.ttl = ttl
+        self.scores = None
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'MirrorSet(%r)' % self.sites
+
+    def __len__(self):
+        return len(self.sites)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if (cached.get('sites') != sorted(self.sites) or
+                cached.get('path') != self.probe_path or
+                time.time() - cached.get('probed', 0) >= self.ttl):
+            return None
+        return cached.get('scores')
+
+    def _save(self, scores):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'sites': sorted(self.sites), 'path': self.probe_path,
+                           'probed': time.time(), 'scores': scores}, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            pass
+
+    def _probe_site(self, site):
+        transport = get_transport('http')
+        start = time.time()
+        try:
+            resp, release = transport.open(
+                site + self.probe_path,
+                {'Range': 'bytes=0-%d' % (self.probe_size - 1)})
+            first = time.time()
+            # Servers without Range support send everything, read no more
+            size = len(resp.read(self.probe_size))
+            release()
+        except (httplib.HTTPException, socket.error, IOError):
+            return None
+        if resp.status not in (200, 206):
+            return None
+        end = time.time()
+        return {'latency': first - start,
+                'throughput': size / max(end - first, 1e-6),
+                'seconds': end - start}
+
+    def probe(self):
+        '''Time every site at once and return a dictionary of site to
+        latency, throughput and total seconds (None when it failed).'''
+        results = parallel_map(self._probe_site, self.sites, len(self.sites))
+        return dict(zip(self.sites, results))
+
+    def ranked(self):
+        'Return the sites, the fastest first and the failed ones last.'
+        if len(self.sites) < 2:
+            return list(self.sites)
+        with self._lock:
+            if self.scores is None:
+                self.scores = self._load()
+                if self.scores is None:
+                    self.scores = self.probe()
+                    self._save(self.scores)
+            scores = self.scores
+            failed = set(self.failed)
+
+        def key(site):
+            score = scores.get(site)
+            return (site in failed, score is None,
+                    score['seconds'] if score else 0, self.sites.index(site))
+
+        return sorted(self.sites, key=key)
+
+    def _site(self, url):
+        for site in self.sites:
+            if url.startswith(site + '/'):
+                return site
+        return None
+
+    def alternatives(self, url):
+        '''Return the URLs of the file at url on every site, the fastest
+        first, or just url when it is not on one of them.'''
+        site = self._site(url)
+        if site is None or len(self.sites) < 2:
+            return [url]
+        path = url[len(site):]
+        return [other + path for other in self.ranked()]
+
+    def demote(self, url):
+        'Move the site of url last, after it failed.'
+        site = self._site(url)
+        if site is not None:
+            with self._lock:
+                self.failed.add(site)
+
+    def describe(self, site):
+        'Return the probe results of site as text.'
+        score = (self.scores or {}).get(site)
+        if score is None:
+            return 'unreachable' if self.scores else 'not probed'
+        return '%.0fms latency, %.0f KB/s' % (score['latency'] * 1000,
+                                              score['throughput'] / 1024)
+
+
+_mirrors = None
+_mirrors_lock = threading.Lock()
+
+
+def get_mirrors():
+    'Return the shared MirrorSet of RUDIX_SITE and RUDIX_MIRRORS.'
+    global _mirrors
+    with _mirrors_lock:
+        if _mirrors is None:
+            _mirrors = MirrorSet([RudixSite] + Mirrors)
+        return _mirrors
+
+
+def hedged_get(urls, store_path, headers={}, transport=None):
+    '''Retrieve the same file from the first two of urls at once.
+
+    The first of them to answer with 200 or 304 is read into store_path
+    and the other one is dropped; when both fail the rest of urls are
+    tried in turn.  Return the HTTP status code and the response headers.'''
+    transport = transport or get_transport('http')
+    tracer = get_tracer()
+    if tracer is not None:
+        start = time.time()
+    answers = Queue.Queue()
+    lock = threading.Lock()
+    decided = []
+
+    def race(url):
+        try:
+            resp, release = transport.open(url, headers)
+        except (httplib.HTTPException, socket.error) as err:
+            answers.put((url, None, err))
+            return
+        with lock:
+            if not decided:
+                answers.put((url, resp, release))
+                return
+        # Too late, and the body is not worth reading
+        release()
+
+    racers = urls[:2]
+    for url in racers:
+        thread = threading.Thread(target=race, args=(url,))
+        thread.daemon = True
+        thread.start()
+    code, received = 0, {}
+    failed = set()
+    for _ in racers:
+        url, resp, release = answers.get()
+        if resp is None:
+            print >> sys.stderr, '%s: %s' % (url, release)
+            failed.add(url)
+            continue
+        if resp.status not in (200, 304):
+            code, received = resp.status, dict(resp.getheaders())
+            resp.read()
+            release()
+            failed.add(url)
+            continue
+        with lock:
+            decided.append(url)
+        while not answers.empty():
+            _, other, other_release = answers.get()
+            if other is not None:
+                other_release()
+        code, received = resp.status, dict(resp.getheaders())
+        try:
+            if code == 200:
+                transport.save(resp, store_path)
+                _set_mtime(store_path, received)
+            else:
+                resp.read()
+        except (httplib.HTTPException, socket.error, IOError) as err:
+            # The other racer was dropped, so it is tried again below
+            print >> sys.stderr, '%s: %s' % (url, err)
+            code, received = 0, {}
+            failed.add(url)
+        release()
+        if url not in failed:
+            if tracer is not None:
+                _trace_get(tracer, 'hedged', url, start, code, received)
+            return code, received
+        break
+    for url in failed:
+        get_mirrors().demote(url)
+    for url in urls:
+        if url in failed:
+            continue
+        code, received = transport.get(url, store_path, headers)
+        if code in (200, 304):
+            break
+        get_mirrors().demote(url)
+    return code, received
+
+
+def conditional_get(urls, store_path, etag=None, last_modified=None,
+                    compressed=False):
+    '''Retrieve urls into store_path unless it matches the validators.
+
+    urls is a URL or a list of URLs of the same file on several mirrors,
+    the fastest first, which are raced (see hedged_get).  With compressed
+    the server may send the body gzip encoded (see decode_body).  Return
+    the HTTP status code and the response headers.'''
+    if isinstance(urls, basestring):
+        urls = [urls]
+    headers = {}
+    if compressed:
+        headers['Accept-Encoding'] = 'gzip'
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    transport = get_transport()
+    if len(urls) > 1 and isinstance(transport, HTTPTransport):
+        return hedged_get(urls, store_path, headers, transport)
+    for url in urls:
+        code, received = transport.get(url, store_path, headers)
+        if code in (200, 304):
+            break
+    return code, received
+
+
+def decode_body(path, headers):
+    'Return the content of a downloaded body, decompressing it if needed.'
+    with open(path, 'rb') as f:
+        data = f.read()
+    if headers.get('content-encoding') in ('gzip', 'x-gzip'):
+        data = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+    return data
+
+
+class ContentHash(object):
+
+    """Class that computes the content hash of a file as it streams in.
+
+    The content hash is the SHA-256 of the SHA-256 digests of every
+    block_size bytes, so blocks can be hashed independently and in any
+    order by concurrent segments."""
+
+    def __init__(self, block_size=BlockSize):
+        self.block_size = block_size
+        self.blocks = []
+        self._block = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        while data:
+            room = self.block_size - self._filled
+            self._block.update(data[:room])
+            self._filled += len(data[:room])
+            data = data[room:]
+            if self._filled == self.block_size:
+                self.blocks.append(self._block.hexdigest())
+                self._block = hashlib.sha256()
+                self._filled = 0
+
+    def hexdigest(self, blocks=None):
+        'Return the content hash, of the given block digests if any.'
+        if blocks is None:
+            blocks = list(self.blocks)
+            if self._filled or not blocks:
+                blocks.append(self._block.hexdigest())
+        return hashlib.sha256(''.join(blocks)).hexdigest()
+
+
+def content_hash(path, block_size=BlockSize):
+    'Return the content hash of a file.'
+    digest = ContentHash(block_size)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class SegmentedDownload(object):
+
+    """Class that downloads a file as concurrent Range segments.
+
+    The file is preallocated and every block_size segment is written in
+    place and hashed as it arrives.  Completed segments and their digests
+    are saved next to the file, so an interrupted download fetches only
+    the missing ones, and If-Range makes sure all of them come from the
+    same version of the file.  Servers without Range support are read as
+    a single stream.
+
+    The same file on other mirrors may be given, the fastest first: a
+    transfer that fails is resumed where it stopped from the next one."""
+
+    def __init__(self, url, store_path, transport=None, jobs=Segments,
+                 block_size=BlockSize, mirrors=()):
+        self.url = url
+        self.urls = [url] + [other for other in mirrors if other != url]
+        # The mirror that answered first, which issued the validator
+        self.origin = url
+        self.store_path = store_path
+        self.state_path = store_path + '.segments'
+        self.transport = transport or get_transport('http')
+        self.jobs = max(1, jobs)
+        self.block_size = block_size
+        self.size = None
+        self.headers = {}
+        self.digest = None
+        self._done = 0
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "SegmentedDownload('%s')" % self.url
+
+    def _order(self):
+        'Return the mirrors to try, those that failed last.'
+        with self._lock:
+            failed = set(self._failed)
+        return ([url for url in self.urls if url not in failed] +
+                [url for url in self.urls if url in failed])
+
+    def _fail(self, url):
+        with self._lock:
+            self._failed.add(url)
+        if len(self.urls) > 1:
+            get_mirrors().demote(url)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if os.path.getsize(self.store_path) != state['size']:
+                return {}
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
+        return state
+
+    def _save_state(self, validator, blocks):
+        state = {'url': self.url, 'size': self.size, 'validator': validator,
+                 'block_size': self.block_size, 'blocks': blocks}
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def _stream(self, resp, f, digest, verbose, limit=None):
+        '''Copy a response body into f, hashing it, and return its length.
+        A connection that breaks only makes it short.'''
+        length = 0
+        while limit is None or length < limit:
+            size = HTTPTransport.chunk_size
+            if limit is not None:
+                size = min(size, limit - length)
+            try:
+                chunk = resp.read(size)
+            except (httplib.HTTPException, socket.error):
+                break
+            if not chunk:
+                break
+            f.write(chunk)
+            digest.update(chunk)
+            length += len(chunk)
+            with self._lock:
+                self._done += len(chunk)
+                if verbose:
+                    _progress(self._done, self.size)
+        return length
+
+    def _write_range(self, resp, index, offset, end, digest, verbose):
+        '''Write a (206) response for bytes offset to end of block index in
+        place and return its length.'''
+        content_range = resp.getheader('content-range', '')
+        if resp.status != 206 or not content_range.startswith(
+                'bytes %d-%d/%d' % (offset, end, self.size)):
+            raise IOError("Segment %d of '%s' changed or was refused "
+                          "(HTTP status %d)" % (index, self.url, resp.status))
+        with open(self.store_path, 'r+b') as f:
+            f.seek(offset)
+            return self._stream(resp, f, digest, verbose, end - offset + 1)
+
+    def _fetch_block(self, index, validator, verbose):
+        '''Fetch block index and return its digest.
+
+        A validator only means something to the mirror that issued it, the
+        others must at least agree on the size of the file.'''
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        digest = hashlib.sha256()
+        offset = start
+        for url in self._order():
+            headers = {'Range': 'bytes=%d-%d' % (offset, end)}
+            if validator and url == self.origin:
+                headers['If-Range'] = validator
+            resp = None
+            try:
+                resp, release = self.transport.open(url, headers)
+                try:
+                    offset += self._write_range(resp, index, offset, end,
+                                                digest, verbose)
+                finally:
+                    release(offset <= end)
+            except (httplib.HTTPException, socket.error, IOError) as err:
+                if resp is not None and resp.status == 200 and validator:
+                    # The file changed, the rest cannot come from elsewhere
+                    raise
+                error = err
+            else:
+                if offset > end:
+                    return digest.hexdigest()
+                error = IOError("Segment %d of '%s' is truncated" % (index,
+                                                                     self.url))
+            self._fail(url)
+        raise error
+
+    def _open_first(self, headers):
+        '''Send the first request to the mirrors in turn until one answers
+        with 200 or 206, and return its response and release function.'''
+        order = self._order()
+        for url in order:
+            try:
+                resp, release = self.transport.open(url, headers)
+            except (httplib.HTTPException, socket.error):
+                if url == order[-1]:
+                    raise
+                self._fail(url)
+                continue
+            if resp.status in (200, 206) or url == order[-1]:
+                self.origin = url
+                return resp, release
+            resp.read()
+            release()
+            self._fail(url)
+
+    def _resume_stream(self, f, offset, digest, verbose):
+        '''Complete a single stream that broke at offset from the other
+        mirrors, or raise IOError.'''
+        self._fail(self.origin)
+        for url in self._order():
+            if url == self.origin:
+                continue
+            expected = 'bytes %d-%d/%d' % (offset, self.size - 1, self.size)
+            try:
+                resp, release = self.transport.open(
+                    url, {'Range': 'bytes=%d-' % offset})
+                try:
+                    if (resp.status == 206 and resp.getheader(
+                            'content-range', '').startswith(expected)):
+                        offset += self._stream(resp, f, digest, verbose)
+                finally:
+                    release(offset != self.size)
+            except (httplib.HTTPException, socket.error):
+                pass
+            if offset == self.size:
+                return
+            self._fail(url)
+        raise IOError("'%s' is truncated" % self.url)
+
+    def run(self, verbose=False, expected=None):
+        '''Download the file and return the HTTP status code, 200 when it
+        is complete.  The content hash is left in digest and checked
+        against expected when given.'''
+        state = self._load_state()
+        # Without anything to resume, the first segment comes with the probe
+        probe_end = 0 if state else self.block_size - 1
+        resp, release = self._open_first({'Range': 'bytes=0-%d' % probe_end})
+        try:
+            self.headers = dict(resp.getheaders())
+            if resp.status == 200:
+                self.size = resp.length
+                digest = ContentHash(self.block_size)
+                with open(self.store_path, 'wb') as f:
+                    length = self._stream(resp, f, digest, verbose)
+                    if self.size is not None and length < self.size:
+                        self._resume_stream(f, length, digest, verbose)
+                self.digest = digest.hexdigest()
+            elif resp.status == 206:
+                self.size = int(self.headers['content-range'].rsplit('/', 1)[1])
+                validator = (self.headers.get('etag') or
+                             self.headers.get('last-modified'))
+                blocks = {}
+                if (state.get('size') == self.size and
+                        state.get('block_size') == self.block_size and
+                        state.get('validator') == validator and validator):
+                    blocks = dict((int(i), digest)
+                                  for i, digest in state['blocks'].items())
+                    resp.read()
+                else:
+                    with open(self.store_path, 'wb') as f:
+                        f.truncate(self.size)
+                    end = min(self.block_size, self.size) - 1
+                    digest = hashlib.sha256()
+                    # When it comes short, block 0 is fetched with the rest
+                    if probe_end and self._write_range(
+                            resp, 0, 0, end, digest, verbose) == end + 1:
+                        blocks[0] = digest.hexdigest()
+                        if validator:
+                            self._save_state(validator, blocks)
+                    else:
+                        resp.read()
+            else:
+                resp.read()
+                return resp.status
+        finally:
+            release()
+        if self.digest is None:
+            count = max(1, -(-self.size // self.block_size))
+            missing = [i for i in range(count) if i not in blocks]
+            self._done = self.size - sum(
+                min(self.block_size, self.size - i * self.block_size)
+                for i in missing)
+
+            def fetch(index):
+                digest = self._fetch_block(index, validator, verbose)
+                with self._lock:
+                    blocks[index] = digest
+                    if validator:
+                        self._save_state(validator, blocks)
+
+            try:
+                parallel_map(fetch, missing, self.jobs)
+            finally:
+                if verbose:
+                    print >> sys.stderr
+            self.digest = ContentHash(self.block_size).hexdigest(
+                [blocks[i] for i in range(count)])
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+        elif verbose:
+            print >> sys.stderr
+        _set_mtime(self.store_path, self.headers)
+        if expected and expected != self.digest:
+            os.remove(self.store_path)
+            print >> sys.stderr, "Checksum mismatch for '%s'" % self.url
+            return 0
+        return 200
+
+
+class CatalogCache(object):
+
+    """Class that represents the on-disk cache of a remote catalog."""
+
+    # Bytes of the cached copy requested again by incremental updates
+    overlap = 4096
+
+    def __init__(self, url, key, cache_dir=CacheDir, ttl=CacheTTL):
+        self.url = url
+        self.ttl = ttl
+        self.path = os.path.join(cache_dir, hashlib.sha1(key).hexdigest()[:16])
+
+    def __repr__(self):
+        return "CatalogCache('%s')" % self.path
+
+    def has(self, name):
+        'Whether a copy of name is cached, fresh or not.'
+        return os.path.exists(os.path.join(self.path, name))
+
+    def _load_meta(self, name):
+        try:
+            with open(os.path.join(self.path, name + '.meta')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_meta(self, name, meta):
+        meta_path = os.path.join(self.path, name + '.meta')
+        try:
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.rename(meta_path + '.tmp', meta_path)
+        except (IOError, OSError):
+            pass
+
+    def _read(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return f.read()
+
+    def _store(self, name, data, tmp_path, meta):
+        '''Replace the cached name with data (written through tmp_path).
+
+        Return False if the cache is not writable.'''
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, os.path.join(self.path, name))
+        except (IOError, OSError):
+            return False
+        self._save_meta(name, meta)
+        return True
+
+    def _fetch_delta(self, name, meta, tmp_path):
+        '''Bring the cached name up to date with the bytes appended since.
+
+        The server publishes the SHA-256 of name in name.sha256; the
+        cached tail is requested again so that a rewritten file is
+        noticed, and the result must match the digest.  Return the new
+        content or None to download the whole file.'''
+        url = self.url + '/' + name
+        transport = get_transport()
+        code, _ = transport.get(url + '.sha256', tmp_path)
+        if code != 200:
+            if code == 404:
+                # No digests published, stop asking until a refresh
+                meta['delta'] = False
+            return None
+        with open(tmp_path) as f:
+            digest = (f.read().split() or [''])[0].lower()
+        data = self._read(name)
+        if digest == meta['sha256']:
+            meta['fetched'] = time.time()
+            self._save_meta(name, meta)
+            return data
+        # The validators describe the old file, do not trust them anymore
+        meta.pop('etag', None)
+        meta.pop('last_modified', None)
+        start = max(0, len(data) - self.overlap)
+        code, headers = transport.get(url, tmp_path,
+                                      {'Range': 'bytes=%d-' % start})
+        if code != 200:
+            return None
+        with open(tmp_path, 'rb') as f:
+            body = f.read()
+        if 'content-range' in headers:
+            if not body.startswith(data[start:]):
+                return None
+            body = data[:start] + body
+        if hashlib.sha256(body).hexdigest() != digest:
+            return None
+        meta.update({'fetched': time.time(),
+                     'etag': headers.get('etag'),
+                     'last_modified': headers.get('last-modified'),
+                     'sha256': digest})
+        self._store(name, body, tmp_path, meta)
+        return body
+
+    def fetch(self, name, refresh=False, offline=False):
+        '''Return the lines of a catalog file, downloading it when stale.
+
+        Fresh entries (younger than ttl seconds) are used as they are,
+        stale entries are updated incrementally when the server publishes
+        digests (see _fetch_delta), else revalidated with ETag /
+        If-Modified-Since, and refresh forces a full download.  Full
+        downloads accept gzip.  Offline, any cached entry is used.
+        Return an empty list on failure.'''
+        data_path = os.path.join(self.path, name)
+        meta = self._load_meta(name) if os.path.isfile(data_path) else {}
+        if offline:
+            return self._read(name).splitlines() if meta else []
+        if meta and not refresh:
+            if time.time() - meta.get('fetched', 0) < self.ttl:
+                return self._read(name).splitlines()
+        try:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Another catalog file may have been fetched at the same time
+                if not os.path.isdir(self.path):
+                    raise
+            fd, tmp_path = tempfile.mkstemp(prefix=name, dir=self.path)
+        except OSError:
+            # Cache not writable, so just go to the network
+            fd, tmp_path = tempfile.mkstemp(prefix=name)
+        os.close(fd)
+        try:
+            if refresh:
+                meta = {}
+            if meta.get('sha256') and meta.get('delta', True):
+                data = self._fetch_delta(name, meta, tmp_path)
+                if data is not None:
+                    return data.splitlines()
+            urls = get_mirrors().alternatives(self.url + '/' + name)
+            code, headers = conditional_get(urls, tmp_path,
+                                            meta.get('etag'),
+                                            meta.get('last_modified'),
+                                            compressed=True)
+            if code == 304 and meta:
+                meta['fetched'] = time.time()
+                self._save_meta(name, meta)
+                return self._read(name).splitlines()
+            if code == 200:
+                try:
+                    data = decode_body(tmp_path, headers)
+                except (IOError, EOFError, zlib.error):
+                    code = 0
+                else:
+                    self._store(name, data, tmp_path,
+                                {'fetched': time.time(),
+                                 'etag': headers.get('etag'),
+                                 'last_modified': headers.get('last-modified'),
+                                 'sha256': hashlib.sha256(data).hexdigest(),
+                                 'delta': meta.get('delta', True)})
+                    return data.splitlines()
+            if meta:
+                print >> sys.stderr, "Using cached '%s' (HTTP status %d)" % (name,
+                                                                             code)
+                return self._read(name).splitlines()
+            return []
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
 
 class RemotePackage(object):
 
     """Class that represents a remote package."""
 
+    __slots__ = ('package', 'url', 'digest', '_name', '_version', '_revision')
+
+    split_re = re.compile(r'^(.+)-([^-]+)\.pkg$')
+
     def __init__(self,
                  package,
                  site_url=RudixSite,
                  rudix_version=RudixVersion,
-                 osx_version=OSXVersion):
+                 osx_version=None):
         self.package = package
         url = '{base}/{rudix}'
         self.url = url.format(base=site_url,
                               rudix=rudix_version,
                               osx=osx_version)
+        self.digest = None
         self._name = None
         self._version = None
         self._revision = None
@@ -49,11 +1076,22 @@ class RemotePackage(object):
         return '%s-%s' % (self._version, self._revision)
 
     def split(self):
-        pat = re.compile(r'^(.+)-([^-]+)\.pkg$')
-        self._name, self._version, = pat.match(self.package).groups()
+        self._name, self._version, = self.split_re.match(self.package).groups()
         self._revision = 999
         return self._name, self._version, self._revision
 
+    def _get(self, transport, urls, store_path, verbose):
+        '''Download from the mirrors in turn, each resuming where the one
+        before stopped.  Return the HTTP status code.'''
+        for url in urls:
+            code, _ = transport.get(url, store_path, resume=True,
+                                    verbose=verbose)
+            if code == 200:
+                break
+            if len(urls) > 1:
+                get_mirrors().demote(url)
+        return code
+
     def download(self, store_path=None, verbose=False):
         tempf = None
         if store_path is None:
@@ -61,16 +1099,603 @@ class RemotePackage(object):
             store_path = file_path
         url = self.url + '/{package}'
         url = url.format(package=self.package)
-        cmd = ['curl', url, '--output', store_path,
-               '--remote-time', '--continue-at', '-', '--location']
-        if verbose:
-            cmd.append('--progress-bar')
+        urls = get_mirrors().alternatives(url)
+        transport = get_transport()
+        if isinstance(transport, HTTPTransport):
+            download = SegmentedDownload(urls[0], store_path, transport,
+                                         mirrors=urls[1:])
+            tracer = get_tracer()
+            if tracer is not None:
+                start = time.time()
+            try:
+                code = download.run(verbose)
+                self.digest = download.digest
+            except (httplib.HTTPException, socket.error, IOError) as err:
+                code = 0
+                if download.size is None and transport.fallback is not None:
+                    # Nothing was written, so let the fallback try
+                    code = self._get(transport.fallback, urls, store_path,
+                                     verbose)
+                else:
+                    print >> sys.stderr, '%s: %s' % (url, err)
+            if tracer is not None:
+                tracer.record('http', 'segmented', start, ok=code == 200,
+                              url=url, status=code, bytes=download.size or 0)
         else:
-            cmd.append('--silent')
-        call(cmd, silent=False)
+            code = self._get(transport, urls, store_path, verbose)
+        status = code == 200
+        if status is False:
+            print >> sys.stderr, "Could not download '%s' (HTTP status %d)" % (url,
+                                                                               code)
         if tempf:
             os.close(tempf)
-        return store_path
+            if status is False:
+                for path in (store_path, store_path + '.segments'):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return store_path if status else None
+
+
+class PackageCache(object):
+
+    """Class that represents the local cache of downloaded packages.
+
+    Packages are stored as <root>/<package>/<content hash> and published
+    with an atomic rename, so concurrent rudix processes can share the
+    cache.  Private temporary files are hard links to cached packages,
+    other destinations get copies, and the least recently used packages
+    are evicted beyond max_size bytes."""
+
+    def __init__(self, root=None, max_size=CacheSize):
+        self.root = root or os.path.join(CacheDir, 'packages')
+        self.max_size = max_size
+        self.tmp = os.path.join(self.root, '.tmp')
+        try:
+            if not os.path.isdir(self.tmp):
+                os.makedirs(self.tmp)
+            self.available = os.access(self.tmp, os.W_OK)
+        except OSError:
+            self.available = False
+
+    def __repr__(self):
+        return "PackageCache('%s')" % self.root
+
+    def lookup(self, package):
+        'Return the path of the most recently used copy of package.'
+        package_dir = os.path.join(self.root, package)
+        try:
+            entries = [os.path.join(package_dir, name)
+                       for name in os.listdir(package_dir)]
+            entries.sort(key=os.path.getmtime, reverse=True)
+        except OSError:
+            return None
+        return entries[0] if entries else None
+
+    def checkout(self, package, dest=None):
+        '''Copy a cached package to dest, or link it to a private
+        temporary file by default, and return its path, or None if it is
+        not cached.'''
+        path = self.lookup(package)
+        if path is None:
+            return None
+        return self._checkout(path, package, dest)
+
+    def _checkout(self, path, package, dest):
+        linked = False
+        if dest is None:
+            fd, dest = tempfile.mkstemp(suffix=package, dir=self.tmp)
+            os.close(fd)
+            os.remove(dest)
+            try:
+                os.link(path, dest)
+                linked = True
+            except OSError:
+                # Evicted in the meantime
+                pass
+        if not linked:
+            # Changes to a link in the caller's hands would reach the cache
+            try:
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                shutil.copy2(path, dest)
+            except (IOError, OSError):
+                return None
+        # Mark it as recently used
+        os.utime(path, None)
+        return dest
+
+    def partial_path(self, package):
+        'Return where package is downloaded before being published.'
+        return os.path.join(self.tmp, package + '.part')
+
+    def _lock(self, package, blocking):
+        path = os.path.join(self.tmp, package + '.lock')
+        while True:
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return None
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    return f
+            except OSError:
+                pass
+            # Removed by its last holder while we waited, lock the new one
+            f.close()
+            if not blocking:
+                return None
+
+    def lock(self, package):
+        'Return a locked file, release it with unlock.'
+        return self._lock(package, True)
+
+    def unlock(self, f):
+        'Release a lock taken with lock and remove its file.'
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+        f.close()
+
+    def publish(self, path, package, digest=None, dest=None):
+        '''Move a downloaded package into the cache and check it out to
+        dest (see checkout) before making room for it.  Return the path
+        of the checked out package, or None if that failed.'''
+        if digest is None:
+            digest = content_hash(path)
+        package_dir = os.path.join(self.root, package)
+        if not os.path.isdir(package_dir):
+            os.makedirs(package_dir)
+        cached = os.path.join(package_dir, digest)
+        os.rename(path, cached)
+        dest = self._checkout(cached, package, dest)
+        self.trim(keep=[cached])
+        return dest
+
+    def trim(self, keep=()):
+        '''Evict the least recently used packages beyond max_size bytes.
+
+        The paths in keep and the packages locked by a download are never
+        evicted, and the lock files left behind are removed.'''
+        entries = []
+        for package in os.listdir(self.root):
+            package_dir = os.path.join(self.root, package)
+            if package.startswith('.') or not os.path.isdir(package_dir):
+                continue
+            for name in os.listdir(package_dir):
+                path = os.path.join(package_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path, package))
+        total = sum(entry[1] for entry in entries)
+        for _, size, path, package in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path in keep:
+                continue
+            lock = self._lock(package, False)
+            if lock is None:
+                continue
+            try:
+                os.remove(path)
+                removed = True
+            except OSError:
+                removed = False
+            self.unlock(lock)
+            if not removed:
+                continue
+            total -= size
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        for name in os.listdir(self.tmp):
+            if name.endswith('.lock'):
+                lock = self._lock(name[:-len('.lock')], False)
+                if lock is not None:
+                    self.unlock(lock)
+
+
+class Downloader(object):
+
+    """Class that downloads remote packages concurrently.
+
+    With a package cache, packages already cached are not downloaded
+    again and offline only uses the cache."""
+
+    def __init__(self, jobs=1, verbose=False, cache=None, offline=False):
+        self.jobs = max(1, jobs)
+        self.verbose = verbose
+        self.cache = cache if cache is not None and cache.available else None
+        self.offline = offline
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Downloader(jobs=%d)" % self.jobs
+
+    def _report(self, msg, out=sys.stdout):
+        with self._lock:
+            print >> out, msg
+            out.flush()
+
+    def _download(self, pkg, store_path):
+        if self.cache is None:
+            # Progress bars from concurrent transfers would garble each other
+            return pkg.download(store_path=store_path,
+                                verbose=self.verbose and self.jobs == 1)
+        lock = self.cache.lock(pkg.package)
+        try:
+            # Another process may have downloaded it meanwhile
+            path = self.cache.checkout(pkg.package, store_path)
+            if path is None:
+                part = self.cache.partial_path(pkg.package)
+                if pkg.download(store_path=part,
+                                verbose=self.verbose and self.jobs == 1):
+                    path = self.cache.publish(part, pkg.package, pkg.digest,
+                                              store_path)
+            return path
+        finally:
+            self.cache.unlock(lock)
+
+    def _fetch(self, cnt, total, pkg, store_dir):
+        store_path = None
+        if store_dir is not None:
+            store_path = os.path.join(store_dir, pkg.package)
+        if self.cache is not None:
+            path = self.cache.checkout(pkg.package, store_path)
+            if path is not None:
+                self._report('[%d/%d] Using cached %s' % (cnt + 1, total,
+                                                          pkg.package))
+                return path
+        if self.offline:
+            self._report('[%d/%d] %s is not in the cache' % (cnt + 1, total,
+                                                            pkg.package),
+                         out=sys.stderr)
+            return None
+        self._report('[%d/%d] Downloading %s...' % (cnt + 1, total, pkg.package))
+        path = self._download(pkg, store_path)
+        if path is None:
+            self._report('[%d/%d] Failed to download %s' % (cnt + 1, total,
+                                                            pkg.package),
+                         out=sys.stderr)
+        elif self.jobs > 1:
+            self._report('[%d/%d] Downloaded %s' % (cnt + 1, total,
+                                                    pkg.package))
+        return path
+
+    def download(self, packages, store_dir=None):
+        '''Download packages, at most jobs at a time.
+
+        Return the stored paths in the same order as packages, None
+        for each package that could not be downloaded.'''
+        total = len(packages)
+
+        def fetch(item):
+            cnt, pkg = item
+            return self._fetch(cnt, total, pkg, store_dir)
+
+        return parallel_map(fetch, enumerate(packages), self.jobs)
+
+
+def _covered(intervals):
+    'Return the seconds covered by a list of (start, end) intervals.'
+    total, end = 0.0, None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+class Prefetch(object):
+
+    """Class that downloads packages ahead of their installation.
+
+    Packages are downloaded in order by the downloader's workers, at
+    most lookahead packages beyond the last one asked for with get.
+    Failed downloads give None, so the caller decides what to skip."""
+
+    def __init__(self, downloader, packages, store_dir=None,
+                 lookahead=Lookahead):
+        self.downloader = downloader
+        self.packages = packages
+        self.store_dir = store_dir
+        self.lookahead = max(0, lookahead)
+        self._position = dict((pkg.package, i)
+                              for i, pkg in enumerate(packages))
+        self._paths = [None] * len(packages)
+        self._done = [threading.Event() for pkg in packages]
+        self._queued = 0
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self.downloading = []
+        self.waiting = []
+        self.started = time.time()
+        self.elapsed = 0.0
+        self._workers = []
+        for i in range(min(downloader.jobs, len(packages))):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._advance(0)
+
+    def __repr__(self):
+        return "Prefetch(%d packages, lookahead=%d)" % (len(self.packages),
+                                                       self.lookahead)
+
+    def __str__(self):
+        downloading = _covered(self.downloading)
+        waiting = _covered(self.waiting)
+        # Download time nobody waited for ran alongside an installation
+        overlap = _covered(self.downloading + self.waiting) - waiting
+        return ('Downloaded %d package(s) in %.2fs, %.2fs of it while '
+                'installing; waited %.2fs for downloads, saved %.2fs '
+                'in %.2fs' % (len(self.packages), downloading, overlap,
+                              waiting, overlap, self.elapsed))
+
+    def _advance(self, index):
+        with self._lock:
+            limit = min(len(self.packages), index + self.lookahead + 1)
+            while self._queued < limit:
+                self._queue.put(self._queued)
+                self._queued += 1
+
+    def _work(self):
+        while True:
+            index = self._queue.get()
+            if index is None:
+                return
+            start = time.time()
+            try:
+                self._paths[index] = self.downloader._fetch(
+                    index, len(self.packages), self.packages[index],
+                    self.store_dir)
+            except Exception as err:
+                self.downloader._report('Failed to download %s: %s' % (
+                    self.packages[index].package, err), out=sys.stderr)
+            finally:
+                with self._lock:
+                    self.downloading.append((start, time.time()))
+                self._done[index].set()
+
+    def get(self, name, default=None):
+        'Wait for package file name and return its path (None on failure).'
+        index = self._position.get(name)
+        if index is None:
+            return default
+        self._advance(index)
+        start = time.time()
+        # Wait with a timeout so that KeyboardInterrupt gets through
+        while not self._done[index].wait(0.1):
+            pass
+        with self._lock:
+            self.waiting.append((start, time.time()))
+        return self._paths[index]
+
+    def values(self):
+        return list(self._paths)
+
+    def close(self):
+        'Drop downloads not started yet and wait for the running ones.'
+        with self._lock:
+            self._queued = len(self.packages)
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except Queue.Empty:
+                pass
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            while worker.is_alive():
+                worker.join(0.1)
+        self.elapsed = time.time() - self.started
+
+
+def edit_distance(a, b, limit):
+    '''Return the edit distance between a and b, counting insertions,
+    deletions, substitutions and swaps of adjacent letters, or limit + 1
+    when it is larger than limit.
+
+    Only the cells within limit of the diagonal are computed.'''
+    n, m = len(a), len(b)
+    if abs(n - m) > limit:
+        return limit + 1
+    if limit == 1:
+        return _within_one(a, b)
+    over = limit + 1
+    before = None
+    previous = [j if j <= limit else over for j in range(m + 1)]
+    for i in range(1, n + 1):
+        ca = a[i - 1]
+        current = [over] * (m + 1)
+        if i <= limit:
+            current[0] = i
+        best = current[0]
+        for j in range(max(1, i - limit), min(m, i + limit) + 1):
+            cost = previous[j - 1] + (ca != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            if (before and j > 1 and ca == b[j - 2] and a[i - 2] == b[j - 1]
+                    and before[j - 2] + 1 < cost):
+                cost = before[j - 2] + 1
+            current[j] = cost if cost < over else over
+            if cost < best:
+                best = cost
+        if best > limit:
+            return over
+        before, previous = previous, current
+    return previous[m]
+
+
+def _within_one(a, b):
+    '''edit_distance(a, b, 1), comparing the rest of the strings after
+    the first difference.'''
+    i = 0
+    size = min(len(a), len(b))
+    while i < size and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        if i == size:
+            return 0
+        if a[i + 1:] == b[i + 1:]:
+            return 1
+        swapped = (a[i] == b[i + 1:i + 2] and a[i + 1:i + 2] == b[i] and
+                   a[i + 2:] == b[i + 2:])
+        return 1 if swapped else 2
+    if len(a) < len(b):
+        a, b = b, a
+    return 1 if a[i + 1:] == b[i:] else 2
+
+
+class NameIndex(object):
+
+    """Class that represents a trigram index of package names.
+
+    Names are padded as ^name$ and every trigram of them, plus the one
+    and two letter prefixes, point to the names containing it.  Queries
+    of three letters or more match anywhere in a name and tolerate
+    typos; shorter ones match name prefixes only.
+
+    Names are numbered from the shortest to the longest, so every list of
+    names is also ordered by length.  Names of up to short letters are
+    also indexed by their single letter deletions, which find the typos
+    of queries too short to share a trigram with the name."""
+
+    short = 5
+
+    def __init__(self, names=()):
+        names = sorted(set(names), key=lambda name: (len(name), name.lower()))
+        self.names = names
+        self._lower = lower = [name.lower() for name in names]
+        # _starts[n] is the number of names shorter than n letters
+        self._starts = starts = array.array('l')
+        grams = {}
+        deletes = {}
+        for i, name in enumerate(lower):
+            while len(starts) <= len(name):
+                starts.append(i)
+            keys = self.grams(name)
+            keys.update(['^' + name[:1], '^' + name[:2]])
+            for gram in keys:
+                ids = grams.get(gram)
+                if ids is None:
+                    grams[gram] = array.array('l', [i])
+                else:
+                    ids.append(i)
+            if len(name) <= self.short:
+                for key in self.deletions(name):
+                    ids = deletes.get(key)
+                    if ids is None:
+                        deletes[key] = array.array('l', [i])
+                    else:
+                        ids.append(i)
+        starts.append(len(lower))
+        self._grams = grams
+        self._deletes = deletes
+
+    def __repr__(self):
+        return 'NameIndex(%d names)' % len(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def grams(text):
+        padded = '^%s$' % text
+        return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    @staticmethod
+    def deletions(text):
+        'Return text and every text with one letter deleted.'
+        keys = set(text[:i] + text[i + 1:] for i in range(len(text)))
+        keys.add(text)
+        return keys
+
+    def search(self, query, limit=20, fuzzy=True):
+        '''Return up to limit names matching query, the best first.
+
+        Exact matches rank first, then prefixes and substrings by
+        position, shorter names first.  When nothing contains the query
+        and fuzzy is set, names within one edit of it (two for queries
+        longer than ten letters) are returned instead.'''
+        query = query.lower()
+        if not query:
+            return []
+        if len(query) < 3:
+            # Already from the shortest to the longest
+            ids = self._grams.get('^' + query, ())[:limit]
+            return [self.names[i] for i in ids]
+        lower = self._lower
+        # Names containing the query contain all its inner trigrams, so
+        # the rarest one is enough to find them
+        inner = [query[i:i + 3] for i in range(len(query) - 2)]
+        candidates = min((self._grams.get(gram, ()) for gram in inner), key=len)
+        ranked = []
+        for i in candidates:
+            position = lower[i].find(query)
+            if position > 0:
+                ranked.append((2, position, i))
+            elif position == 0:
+                ranked.append((0 if lower[i] == query else 1, 0, i))
+        if not ranked and fuzzy:
+            ranked = self._fuzzy(query)
+        return [self.names[i] for _, _, i in heapq.nsmallest(limit, ranked)]
+
+    def _window(self, ids, low, high):
+        '''Return the part of ids (a sorted list of names) with names
+        between low and high letters long.'''
+        starts = self._starts
+        first = starts[min(max(low, 0), len(starts) - 1)]
+        last = starts[min(high + 1, len(starts) - 1)]
+        return ids[bisect.bisect_left(ids, first):bisect.bisect_left(ids, last)]
+
+    def _fuzzy(self, query):
+        limit = 1 if len(query) <= 10 else 2
+        size = len(query)
+        grams = self.grams(query)
+        # Every edit changes at most four trigrams (a swap)
+        needed = len(grams) - 4 * limit
+        if needed <= 0 and size + limit <= self.short:
+            # A short query may share no trigram with a name one edit
+            # away, but they share a deletion (of the letters changed or
+            # swapped, or of the one inserted in either of them)
+            candidates = set()
+            for key in self.deletions(query):
+                candidates.update(self._deletes.get(key, ()))
+        elif needed <= 0:
+            # Repeated letters, every name of a close length is a candidate
+            starts = self._starts
+            candidates = xrange(
+                starts[min(max(size - limit, 0), len(starts) - 1)],
+                starts[min(size + limit + 1, len(starts) - 1)])
+        else:
+            counts = {}
+            for gram in grams:
+                ids = self._grams.get(gram)
+                if ids:
+                    for i in self._window(ids, size - limit, size + limit):
+                        counts[i] = counts.get(i, 0) + 1
+            candidates = [i for i, count in counts.iteritems()
+                          if count >= needed]
+        lower = self._lower
+        ranked = []
+        for i in candidates:
+            distance = edit_distance(query, lower[i], limit)
+            if distance <= limit:
+                ranked.append((3, distance, i))
+        return ranked
 
 
 class RemoteRepository(object):
@@ -80,16 +1705,27 @@ class RemoteRepository(object):
     def __init__(self,
                  site_url=RudixSite,
                  rudix_version=RudixVersion,
-                 osx_version=OSXVersion):
+                 osx_version=None,
+                 cache_dir=CacheDir,
+                 offline=False):
         self.site_url = site_url
         self.rudix_version = rudix_version
+        if osx_version is None:
+            osx_version = get_osx_version()
         self.osx_version = osx_version
         url = '{base}/{rudix}'
         self.url = url.format(base=self.site_url,
                               rudix=self.rudix_version,
                               osx=self.osx_version)
+        key = '%s|%s|%s' % (self.site_url, self.rudix_version, self.osx_version)
+        self.cache = CatalogCache(self.url, key, cache_dir)
+        self.offline = offline
         self.aliases = {}
         self.packages = []
+        self._index = {}
+        self._unsorted = set()
+        self._name_index = None
+        self._source = None
 
     def __str__(self):
         return "%d package(s) available on '%s'" % (len(self.packages),
@@ -98,57 +1734,194 @@ class RemoteRepository(object):
     def __repr__(self):
         return "RemoteRepository('%s')" % self.url
 
-    def _retrieve_manifest(self):
-        url = self.url + '/00MANIFEST.txt'
-        cmd = ['curl', '-s', url]
-        content = call_with_output(cmd)
-        if not content:
-            return False
-        for line in content:
-            if line.endswith('.pkg'):
-                self.packages.append(line)
-        return True
+    def load_manifest(self, content):
+        '''Load manifest lines and index them by package name.
 
-    def _retrieve_aliases(self):
-        url = self.url + '/00ALIASES.txt'
-        cmd = ['curl', '-s', url]
-        content = call_with_output(cmd)
-        if not content:
-            return False
+        Only the package file names are kept, in packages.  The index
+        maps every name to its positions there (an int, or an array when
+        there are several versions), ordered from the latest to the oldest
+        version the first time the name is looked up, and RemotePackage
+        records are only created when asked for.'''
+        self.packages = packages = [line for line in content
+                                    if line.endswith('.pkg')]
+        match = RemotePackage.split_re.match
+        index = {}
+        seen = set()
+        for i, pkg in enumerate(packages):
+            if pkg in seen:
+                continue
+            seen.add(pkg)
+            m = match(pkg)
+            if m is None:
+                # Not a name-version.pkg file name
+                continue
+            index.setdefault(intern(m.group(1)), []).append(i)
+        unsorted = set()
+        for name, positions in index.iteritems():
+            if len(positions) == 1:
+                index[name] = positions[0]
+            else:
+                index[name] = array.array('l', positions)
+                unsorted.add(name)
+        self._index = index
+        self._unsorted = unsorted
+        self._name_index = None
+        self._source = None
+
+    def _positions(self, name):
+        positions = self._index.get(name, ())
+        if isinstance(positions, int):
+            return (positions,)
+        if name in self._unsorted:
+            match = RemotePackage.split_re.match
+            packages = self.packages
+            positions = array.array('l', sorted(
+                positions, reverse=True,
+                key=lambda i: version_key(match(packages[i]).group(2))))
+            self._index[name] = positions
+            self._unsorted.discard(name)
+        return positions
+
+    def _record(self, i):
+        return RemotePackage(self.packages[i], self.site_url,
+                             self.rudix_version, self.osx_version)
+
+    def load_aliases(self, content):
+        'Load "alias->name" lines.'
+        aliases = {}
         for line in content:
             if '->' in line:
                 alias, pkg = line.split('->')
-                self.aliases[alias] = pkg
+                aliases[alias] = pkg
+        self.aliases = aliases
+        self._name_index = None
+        self._source = None
 
-    def sync(self):
-        status = self._retrieve_manifest()
-        if status is False:
-            print >> sys.stderr, "Could not synchronize with '%s'" % self.site_url
+    def sync(self, refresh=False):
+        '''Retrieve the manifest and the aliases, both at once.  Return
+        False if the manifest could not be retrieved.'''
+        manifest, aliases = parallel_map(
+            lambda name: self.cache.fetch(name, refresh, self.offline),
+            ['00MANIFEST.txt', '00ALIASES.txt'], 2)
+        if not manifest:
+            print >> sys.stderr, "Could not synchronize with '%s'" % self.url
             return False
-        status = self._retrieve_aliases()
+        self.load_manifest(manifest)
+        self.load_aliases(aliases)
         return True
 
+    def share(self, other):
+        '''Use the catalog loaded by other, a repository with the same URL,
+        and its indexes instead of a copy.'''
+        self.packages = other.packages
+        self.aliases = other.aliases
+        self._index = other._index
+        self._unsorted = other._unsorted
+        self._name_index = None
+        self._source = other
+
+    @property
+    def name_index(self):
+        'The NameIndex of package names and aliases, built on first use.'
+        if self._source is not None:
+            return self._source.name_index
+        if self._name_index is None:
+            self._name_index = NameIndex(set(self._index) |
+                                         set(self.aliases))
+        return self._name_index
+
+    def search(self, query, limit=20, fuzzy=True):
+        '''Return the names (and aliases) of packages matching query, the
+        best first; see NameIndex.search.'''
+        return self.name_index.search(query, limit, fuzzy)
+
     def match_package(self, pkg):
-        if pkg in self.packages:
-            return RemotePackage(pkg)
-        else:
+        m = RemotePackage.split_re.match(pkg)
+        if m is None:
             return None
+        for i in self._positions(m.group(1)):
+            if self.packages[i] == pkg:
+                return self._record(i)
+        return None
 
     def get_versions(self, name):
-        versions = []
-        for pkg in self.packages:
-            p = RemotePackage(pkg)
-            if name == p.name:
-                versions.append(p)
-        if versions:
-            versions = sorted(list(set(versions)),
-                              reverse=True,
-                              cmp=lambda x, y: version_compare(x.version,
-                                                               y.version))
-            return versions
-        else:
-            return []
+        return [self._record(i) for i in self._positions(name)]
 
     def latest_version(self, name):
-        versions = self.get_versions(name)
-        return versions[0] if versions else None
+        positions = self._positions(name)
+        return self._record(positions[0]) if len(positions) else None
+
+    def latest_versions(self, names):
+        '''Return the latest package of each of names (None when it is not
+        available), in one pass over names.'''
+        latest = []
+        for name in names:
+            positions = self._positions(name)
+            latest.append(self._record(positions[0]) if len(positions) else None)
+        return latest
+
+    @property
+    def cached(self):
+        'Whether the catalog is in the cache, fresh or not.'
+        return self.cache.has('00MANIFEST.txt')
+
+
+def parse_targets(values):
+    '''Return the (Rudix version, OS X version) of every "RUDIX:OSX" in
+    values, without repeats.  An empty part stands for the current
+    version, and no values for the current target.'''
+    targets = []
+    for value in values or [':']:
+        rudix_version, _, osx_version = value.partition(':')
+        target = (rudix_version or RudixVersion,
+                  osx_version or get_osx_version())
+        if target not in targets:
+            targets.append(target)
+    return targets
+
+
+class Catalogs(object):
+
+    """Class that represents the catalogs of several targets, a (Rudix
+    version, OS X version) pair each.
+
+    All catalogs are synchronized at once, and targets with the same
+    catalog URL share one copy of it and of its indexes."""
+
+    def __init__(self, targets, site_url=RudixSite, cache_dir=CacheDir,
+                 offline=False):
+        self.targets = list(targets)
+        self.repositories = [RemoteRepository(site_url, rudix_version,
+                                              osx_version, cache_dir, offline)
+                             for rudix_version, osx_version in self.targets]
+        self.failed = []
+
+    def __repr__(self):
+        return 'Catalogs(%r)' % self.targets
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __iter__(self):
+        'Iterate over the (target, repository) that are synchronized.'
+        for target, repo in zip(self.targets, self.repositories):
+            if target not in self.failed:
+                yield target, repo
+
+    def sync(self, refresh=False):
+        '''Synchronize the catalogs, all at once, and return the targets
+        that could not be.'''
+        first = {}
+        for repo in self.repositories:
+            first.setdefault(repo.url, repo)
+        unique = [repo for repo in self.repositories if first[repo.url] is repo]
+        synced = dict(zip([repo.url for repo in unique],
+                          parallel_map(lambda repo: repo.sync(refresh),
+                                       unique, len(unique))))
+        self.failed = []
+        for target, repo in zip(self.targets, self.repositories):
+            if not synced[repo.url]:
+                self.failed.append(target)
+            elif first[repo.url] is not repo:
+                repo.share(first[repo.url])
+        return self.failed
@@ -1,3 +1,4 @@
+import time
 import unittest
 
 from rudix.core import *
@@ -37,16 +38,91 @@ class FunctionTests(unittest.TestCase):
         for i in zip(l,l2):
             self.assertEqual(i[0], i[1])
 
+    def test_version_key(self):
+        l = ['1.0', '1.0-2', '1.0.1', '1.2', '1.7', '1.7.1', 'R13B', '2015a',
+             '1.0.1-10', '7.2e', '2.1.0b1-0', '1.11.1-0', '2014z', '1.10.1']
+        for v1 in l:
+            for v2 in l:
+                self.assertEqual(cmp(version_key(v1), version_key(v2)),
+                                 version_compare(v1, v2))
+        self.assertEqual(sorted(l, key=version_key),
+                         sorted(l, cmp=version_compare))
+        self.assertEqual(version_key('1.0.1'), version_key('1.0.1-0'))
+
     def test_normalization(self):
         self.assertEqual(normalize('rudix'),
                          'org.rudix.pkg.rudix')
         self.assertEqual(normalize('org.rudix.pkg.rudix'),
                          'org.rudix.pkg.rudix' )
 
+    def test_forbidden(self):
+        self.assertTrue(is_forbidden('/usr'))
+        self.assertTrue(is_forbidden('/net'))
+        self.assertTrue(is_forbidden('/Library/Python/2.7/site-packages'))
+        self.assertFalse(is_forbidden('/usr/local'))
+        self.assertTrue(is_forbidden('/Volumes/X/usr', '/Volumes/X'))
+        self.assertFalse(is_forbidden('/usr/local/bin', '/Volumes/X'))
+
     def test_denormalization(self):
         self.assertEqual(denormalize('org.rudix.pkg.rudix'), 'rudix')
         self.assertEqual(denormalize('rudix'), 'rudix')
 
+    def test_iter_output(self):
+        start = time.time()
+        lines = iter_output(['sh', '-c', 'echo one; sleep 5; echo two'])
+        self.assertEqual(next(lines), 'one')
+        lines.close()
+        # The first line came as soon as it was written, and closing
+        # the generator killed the process
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(call_with_output(['printf', 'a\\nb\\n']), ['a', 'b'])
+
+    def test_output_status(self):
+        status = []
+        self.assertEqual(call_with_output(['sh', '-c', 'echo a; exit 18'],
+                                          status=status), ['a'])
+        self.assertEqual(status, [18])
+        status = []
+        call_with_output(['/nonexistent/command'], status=status)
+        self.assertEqual(status, [None])
+
+
+class TracerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = start_tracing(['rudix', '--list'])
+
+    def tearDown(self):
+        import rudix.core
+        rudix.core._tracer = None
+
+    def test_calls(self):
+        call(['true'])
+        call(['false'])
+        call_with_output(['echo', 'hello'])
+        call(['/nonexistent/command'])
+        events = self.tracer.events
+        self.assertEqual([e['name'] for e in events],
+                         ['true', 'false', 'echo', 'command'])
+        self.assertEqual([e['ok'] for e in events], [True, False, True, False])
+        self.assertEqual(events[2]['bytes'], 6)
+
+    def test_phase(self):
+        with phase('sync'):
+            call(['true'])
+        self.tracer.finish()
+        self.assertEqual(self.tracer.events[-1]['kind'], 'phase')
+        summary = self.tracer.summary().splitlines()
+        self.assertTrue(summary[1].startswith('phase  sync'))
+        self.assertTrue(summary[2].startswith('exec   true'))
+
+    def test_disabled(self):
+        import rudix.core
+        rudix.core._tracer = None
+        with phase('sync'):
+            call(['true'])
+        self.assertEqual(self.tracer.events, [])
+
 
 if __name__ == '__main__':
     unittest.main()
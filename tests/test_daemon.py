@@ -0,0 +1,123 @@
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import functools
+import threading
+import unittest
+from StringIO import StringIO
+
+from rudix.daemon import *
+from rudix.main import create_parser, run_command
+
+VOLUME = os.path.join(os.path.dirname(__file__), 'volume')
+
+
+def capture(func, *args, **kwargs):
+    'Return the result of func and what it wrote to stdout and stderr.'
+    streams = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        result = func(*args, **kwargs)
+        return result, sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = streams
+
+
+class DaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'rudix.sock')
+        self.server = create_server(self.path)
+        # Keep the index of the test volume out of the user's cache
+        self.server.warm = Warm(cache_dir=self.tmpdir)
+        cli = sys.modules['rudix.main']
+        self.addCleanup(setattr, cli, 'Repository', cli.Repository)
+        cli.Repository = functools.partial(Repository, cache_dir=self.tmpdir)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def direct(self, args):
+        options, args = create_parser('', '').parse_args(args)
+        options.volume = options.volumes[0]
+        return capture(run_command, options, args)
+
+    def test_list(self):
+        args = ['--list', '--verbose', '--volume', VOLUME]
+        answered = capture(forward, args, [VOLUME], path=self.path)
+        self.assertEqual(answered, self.direct(args))
+        self.assertTrue('org.rudix.pkg.foo' in answered[1])
+        self.assertEqual(self.server.requests, 1)
+
+    def test_info(self):
+        args = ['--info', 'foo', 'missing', '--volume', VOLUME]
+        status, out, err = capture(forward, args, [VOLUME], path=self.path)
+        self.assertEqual(status, 1)
+        self.assertTrue('Name: foo' in out)
+        self.assertTrue("'org.rudix.pkg.missing' is not installed" in err)
+        # The repository is kept for the next request
+        capture(forward, args, [VOLUME], path=self.path)
+        self.assertEqual(len(self.server.warm.repositories), 1)
+
+    def test_main(self):
+        cli = sys.modules['rudix.main']
+        path, cli.SocketPath = cli.SocketPath, self.path
+        self.addCleanup(setattr, cli, 'SocketPath', path)
+        status, out, _ = capture(cli.main, ['info', 'foo', '--volume', VOLUME])
+        self.assertEqual(status, 0)
+        self.assertTrue('Name: foo' in out)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_silent_client(self):
+        self.assertEqual(Handler.timeout, RequestTimeout)
+        self.addCleanup(setattr, Handler, 'timeout', Handler.timeout)
+        Handler.timeout = 0.1
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(silent.close)
+        silent.connect(self.path)
+        status, out, _ = capture(forward, ['--list', '--volume', VOLUME],
+                                 [VOLUME], path=self.path, timeout=5)
+        self.assertEqual(status, 0)
+        self.assertTrue('org.rudix.pkg.foo' in out)
+
+    def test_cwd(self):
+        cwd = os.getcwd()
+        reply = self.server.run({'args': ['--list', '--volume', VOLUME],
+                                 'volumes': [VOLUME], 'cwd': self.tmpdir,
+                                 'settings': settings(), 'stdin': None})
+        self.assertEqual(reply['status'], 0)
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_not_forwarded(self):
+        self.assertEqual(forward(['--remove-all'], [VOLUME], path=self.path),
+                         None)
+
+    def test_settings(self):
+        self.server.settings = dict(self.server.settings, rudix='other')
+        self.assertEqual(forward(['--list'], [VOLUME], path=self.path), None)
+
+    def test_absent(self):
+        path = os.path.join(self.tmpdir, 'absent.sock')
+        self.assertEqual(forward(['--list'], [VOLUME], path=path), None)
+
+    def test_running(self):
+        self.assertEqual(create_server(self.path), None)
+
+    def test_stale(self):
+        path = os.path.join(self.tmpdir, 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        server = create_server(path)
+        self.assertNotEqual(server, None)
+        server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
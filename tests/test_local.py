@@ -1,7 +1,12 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 from rudix.local import *
 
+VOLUME = os.path.join(os.path.dirname(__file__), 'volume')
+
 
 class PackageTests(unittest.TestCase):
 
@@ -18,5 +23,253 @@ class PackageTests(unittest.TestCase):
         self.assertEqual(self.foo.version, '(none)')
 
 
+class FileListTests(unittest.TestCase):
+
+    def setUp(self):
+        self.files = FileList('/Volumes/X', [('usr/local/bin', True),
+                                             (u'usr/local/bin/caf\xe9', False),
+                                             ('usr/local/bin/foo', False)])
+
+    def test_access(self):
+        self.assertEqual(len(self.files), 3)
+        self.assertEqual(self.files[0], '/Volumes/X/usr/local/bin')
+        self.assertEqual(self.files[-1], '/Volumes/X/usr/local/bin/foo')
+        self.assertEqual(self.files[1], '/Volumes/X/usr/local/bin/caf\xc3\xa9')
+        self.assertRaises(IndexError, lambda: self.files[3])
+        self.assertEqual(list(self.files)[2], self.files[2])
+
+    def test_directories(self):
+        self.assertEqual(self.files.directories(), ['/Volumes/X/usr/local/bin'])
+        self.assertEqual([is_dir for _, is_dir in self.files.entries()],
+                         [True, False, False])
+
+    def test_empty(self):
+        self.assertEqual(FileList('/'), [])
+        self.assertFalse(FileList('/'))
+
+
+class ReceiptsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.receipts = Receipts(VOLUME)
+
+    def test_binary(self):
+        self.assertEqual(self.receipts.read('org.rudix.pkg.foo'),
+                         ('1.0', '1521374400'))
+
+    def test_xml(self):
+        self.assertEqual(self.receipts.read('org.rudix.pkg.static-bar'),
+                         ('2.1.3', '1521448200'))
+
+    def test_load(self):
+        info = self.receipts.load()
+        self.assertEqual(sorted(info), ['org.rudix.pkg.broken',
+                                        'org.rudix.pkg.foo',
+                                        'org.rudix.pkg.static-bar'])
+        self.assertEqual(info['org.rudix.pkg.broken'], None)
+
+    def test_unavailable(self):
+        self.assertEqual(Receipts('/nonexistent').load(), None)
+
+    def test_repository(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        repo = Repository(VOLUME, cache_dir=cache_dir)
+        repo.sync()
+        self.assertEqual(len(repo.packages), 3)
+        p = repo.get_package('org.rudix.pkg.foo')
+        self.assertTrue(p.installed)
+        self.assertEqual(p.package, 'foo-1.0.pkg')
+        self.assertEqual(p.install_date, '1521374400')
+
+
+class IndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.volume = os.path.join(self.tmp_dir, 'volume')
+        shutil.copytree(VOLUME, self.volume)
+        self.receipts = os.path.join(self.volume, 'var/db/receipts')
+        self.index = Index(self.volume, cache_dir=self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_refresh(self):
+        info = self.index.refresh()
+        self.assertEqual(info['org.rudix.pkg.foo'], ('1.0', '1521374400'))
+        self.assertEqual(info['org.rudix.pkg.broken'], None)
+        os.remove(os.path.join(self.receipts, 'org.rudix.pkg.foo.plist'))
+        info = Index(self.volume, cache_dir=self.tmp_dir).refresh()
+        self.assertEqual(sorted(info), ['org.rudix.pkg.broken',
+                                        'org.rudix.pkg.static-bar'])
+
+    def test_files(self):
+        self.index.refresh()
+        self.assertEqual(self.index.files('org.rudix.pkg.foo'), None)
+        self.index.set_files('org.rudix.pkg.foo',
+                             ['usr/local/bin', 'usr/local/bin/foo'],
+                             ['usr/local/bin'])
+        p = Package('org.rudix.pkg.foo', self.volume, index=self.index)
+        self.assertEqual(p.files, [os.path.join(self.volume, 'usr/local/bin'),
+                                   os.path.join(self.volume, 'usr/local/bin/foo')])
+        self.assertEqual(p.dirs, [os.path.join(self.volume, 'usr/local/bin')])
+
+    def test_record_files(self):
+        self.index.refresh()
+        rows = [('usr/local/bin', True), ('usr/local/bin/foo', False)]
+        stream = self.index.record_files('org.rudix.pkg.foo', iter(rows))
+        next(stream)
+        stream.close()
+        self.assertEqual(self.index.files('org.rudix.pkg.foo'), None)
+        self.assertEqual(list(self.index.record_files('org.rudix.pkg.foo',
+                                                      iter(rows))), rows)
+        self.assertEqual(list(self.index.iter_files('org.rudix.pkg.foo')), rows)
+        p = Package('org.rudix.pkg.foo', self.volume, index=self.index)
+        self.assertEqual(list(p.iter_files()),
+                         [(os.path.join(self.volume, path), is_dir)
+                          for path, is_dir in rows])
+
+    def test_pkgutil_files(self):
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'pkgutil'), 'w') as f:
+            f.write('#!/bin/sh\nprintf "usr/local/bin\\nusr/local/bin/foo\\n'
+                    'usr/local/missing\\n"\n')
+        os.chmod(os.path.join(bin_dir, 'pkgutil'), 0755)
+        path = os.environ['PATH']
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        self.index.refresh()
+        p = Package('org.rudix.pkg.foo', self.volume, index=self.index)
+        # The kinds are not known, and not guessed in the index either
+        rows = [('usr/local/bin', None), ('usr/local/bin/foo', None),
+                ('usr/local/missing', None)]
+        self.assertEqual(list(p.iter_files()),
+                         [(os.path.join(self.volume, path), is_dir)
+                          for path, is_dir in rows])
+        self.assertEqual(self.index.files('org.rudix.pkg.foo'), rows)
+        self.assertEqual(p.get_files().directories(), [])
+
+    def test_invalidate(self):
+        self.index.refresh()
+        self.index.set_files('org.rudix.pkg.foo', ['usr/local/bin/foo'], [])
+        path = os.path.join(self.receipts, 'org.rudix.pkg.foo.plist')
+        os.utime(path, (0, 0))
+        self.index.refresh()
+        self.assertEqual(self.index.files('org.rudix.pkg.foo'), None)
+
+
+class RemoverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.volume = tempfile.mkdtemp()
+        self.files = ['usr', 'usr/local', 'usr/local/bin', 'usr/local/bin/foo',
+                      'usr/local/bin/bar', 'usr/local/lib', 'usr/local/lib/libfoo.a']
+        self.files = [os.path.join(self.volume, path) for path in self.files]
+        self.dirs = self.files[:3] + self.files[5:6]
+        for path in self.files:
+            if path in self.dirs:
+                os.mkdir(path)
+            else:
+                open(path, 'w').close()
+        open(os.path.join(self.volume, 'usr/local/lib/other'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.volume)
+
+    def check(self, remover):
+        self.assertEqual(remover.stats['files'], 3)
+        self.assertEqual(remover.stats['dirs'], 1)
+        self.assertEqual(remover.stats['skipped'], 1)
+        self.assertEqual(remover.stats['kept'], 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.volume, 'usr/local'))),
+                         ['lib'])
+
+    def test_manifest(self):
+        remover = Remover(self.volume)
+        remover.remove(self.files, self.dirs)
+        self.check(remover)
+
+    def test_unknown(self):
+        remover = Remover(self.volume)
+        remover.remove(self.files)
+        self.check(remover)
+
+    def test_jobs(self):
+        remover = Remover(self.volume, jobs=4)
+        remover.remove(self.files + self.files, self.dirs)
+        self.check(remover)
+        self.assertEqual(remover.stats['missing'], 0)
+
+    def test_uninstall_packages(self):
+        shutil.copytree(os.path.join(VOLUME, 'var'),
+                        os.path.join(self.volume, 'var'))
+        repo = Repository(self.volume, cache_dir=self.volume)
+        repo.sync()
+        repo.index.set_files('org.rudix.pkg.foo',
+                             ['usr/local', 'usr/local/bin', 'usr/local/bin/foo'],
+                             ['usr/local', 'usr/local/bin'])
+        repo.index.set_files('org.rudix.pkg.static-bar',
+                             ['usr/local', 'usr/local/bin', 'usr/local/bin/bar'],
+                             ['usr/local', 'usr/local/bin'])
+        packages = [repo.get_package('org.rudix.pkg.foo'),
+                    repo.get_package('org.rudix.pkg.static-bar')]
+        remover = repo.uninstall_packages(packages)
+        self.assertEqual(remover.stats['files'], 2)
+        self.assertEqual(remover.stats['dirs'], 1)
+        self.assertEqual(remover.stats['kept'], 1)
+
+    def test_missing(self):
+        os.remove(self.files[3])
+        remover = Remover(self.volume)
+        remover.remove(self.files, [])
+        self.assertEqual(remover.stats['missing'], 1)
+        self.assertEqual(remover.stats['errors'], 0)
+        self.assertEqual(remover.stats['dirs'], 1)
+
+
+class PathIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PathIndex([('/usr/local/bin', 'foo'),
+                                ('/usr/local/bin', 'bar'),
+                                ('/usr/local/bin/foo', 'foo'),
+                                ('/usr/local/bin/bar', 'bar'),
+                                ('/usr/local/lib/libbar.a', 'bar')])
+
+    def test_exact(self):
+        self.assertEqual(self.index.lookup('/usr/local/bin/foo'), ['foo'])
+        self.assertEqual(self.index.lookup('/usr/local/bin'), ['bar', 'foo'])
+        self.assertEqual(self.index.lookup('/usr/local/lib'), [])
+        self.assertEqual(self.index.lookup('/usr/local/bin/baz'), [])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.lookup('/usr/local/lib/'), ['bar'])
+        self.assertEqual(self.index.lookup('/usr/'), ['bar', 'foo'])
+        self.assertEqual(self.index.lookup('/'), ['bar', 'foo'])
+        self.assertEqual(self.index.lookup('/opt/'), [])
+
+    def test_glob(self):
+        self.assertEqual(self.index.lookup('/usr/local/*/lib*'), ['bar'])
+        self.assertEqual(self.index.lookup('/usr/local/bin/?oo'), ['foo'])
+        self.assertEqual(self.index.lookup('/opt/*'), [])
+
+    def test_search_paths(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        repo = Repository(VOLUME, cache_dir=cache_dir)
+        repo.sync()
+        repo.index.set_files('org.rudix.pkg.foo', ['usr/local/bin/foo'], [])
+        repo.index.set_files('org.rudix.pkg.static-bar', ['usr/local/lib/libbar.a'], [])
+        repo.index.set_files('org.rudix.pkg.broken', [], [])
+        self.assertEqual(repo.search_paths(['/usr/local/bin/foo',
+                                            'usr/local/lib/',
+                                            '/usr/local/share']),
+                         [('/usr/local/bin/foo', ['org.rudix.pkg.foo']),
+                          ('usr/local/lib/', ['org.rudix.pkg.static-bar']),
+                          ('/usr/local/share', [])])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,130 @@
+import os
+import sys
+import shutil
+import tempfile
+import functools
+import unittest
+from StringIO import StringIO
+
+from rudix.main import *
+
+VOLUME = os.path.join(os.path.dirname(__file__), 'volume')
+
+
+class VolumesTests(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual(expand_volumes(None), ['/'])
+
+    def test_file(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        os.write(fd, '# targets\n/Volumes/A\n\n/Volumes/B\n')
+        os.close(fd)
+        self.assertEqual(expand_volumes(['/', '@' + path]),
+                         ['/', '/Volumes/A', '/Volumes/B'])
+
+    def test_list(self):
+        # Keep the index of the test volume out of the user's cache
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cli = sys.modules['rudix.main']
+        self.addCleanup(setattr, cli, 'Repository', cli.Repository)
+        cli.Repository = functools.partial(Repository, cache_dir=cache_dir)
+        options = create_parser('', '').parse_args(['--volume', VOLUME,
+                                                    '--volume', VOLUME])[0]
+        options.volumes = expand_volumes(options.volumes)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            command_list(options, [])
+            output = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output.count('%s:' % VOLUME), 2)
+        self.assertEqual(output.count('org.rudix.pkg.foo'), 2)
+
+
+class SearchTests(unittest.TestCase):
+
+    def test_search_packages(self):
+        from rudix.remote import RemoteRepository
+        remote = RemoteRepository(site_url='http://example.com',
+                                  osx_version='10.13')
+        remote.load_manifest(['openssl-1.0.pkg', 'openssl-1.1.pkg',
+                              'libressl-2.0.pkg'])
+        remote.aliases['ssl'] = 'openssl'
+        self.assertEqual(search_packages(remote, 'ssl'),
+                         ['openssl-1.1.pkg', 'libressl-2.0.pkg'])
+        self.assertEqual(search_packages(remote, 'opnessl'),
+                         ['openssl-1.1.pkg'])
+        self.assertEqual(search_packages(remote, 'zzz'), [])
+
+
+class ApplyTests(unittest.TestCase):
+
+    def setUp(self):
+        from rudix.remote import RemoteRepository
+        self.remote = RemoteRepository(site_url='http://example.com',
+                                       osx_version='10.13')
+        self.remote.load_manifest(['foo-1.0.pkg', 'foo-0.9.pkg', 'new-1.0.pkg',
+                                   'static-bar-2.2.pkg', 'foo-bar-1.0.pkg'])
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.repo = Repository(VOLUME, cache_dir=cache_dir)
+        self.repo.sync()
+
+    def test_split_package(self):
+        known = set(['foo', 'foo-bar']).__contains__
+        self.assertEqual(split_package('foo-bar-1.0-999.pkg', known),
+                         ('foo-bar', '1.0-999'))
+        self.assertEqual(split_package('foo-1.0.pkg', known), ('foo', '1.0'))
+        self.assertEqual(split_package('foo-bar.pkg', known), None)
+        self.assertEqual(split_package('foo-1.0', known), None)
+
+    def plan(self, packages):
+        plan, errors = apply_plan(self.repo, packages, lambda: self.remote)
+        return [(action, (p_local or p_remote).name,
+                 p_remote and p_remote.package)
+                for action, p_local, p_remote in plan], errors
+
+    def test_plan(self):
+        plan, errors = self.plan(['foo-1.0.pkg', 'static-bar-2.2-999.pkg',
+                                  'new-1.0.pkg'])
+        self.assertEqual(errors, [])
+        self.assertEqual(plan, [('keep', 'foo', None),
+                                ('upgrade', 'static-bar', 'static-bar-2.2.pkg'),
+                                ('add', 'new', 'new-1.0.pkg'),
+                                ('remove', 'broken', None)])
+
+    def test_downgrade(self):
+        plan, _ = self.plan(['foo-0.9.pkg', 'static-bar-2.1.3.pkg'])
+        self.assertEqual(plan[0], ('downgrade', 'foo', 'foo-0.9.pkg'))
+        self.assertEqual(plan[1], ('keep', 'static-bar', None))
+
+    def test_errors(self):
+        _, errors = self.plan(['missing-1.0.pkg', 'new-2.0.pkg',
+                               'foo-1.0.pkg', 'foo-0.9.pkg'])
+        self.assertEqual(errors, ['missing-1.0.pkg', 'new-2.0.pkg',
+                                  'foo-0.9.pkg'])
+
+
+class OutdatedTests(unittest.TestCase):
+
+    def test_outdated_packages(self):
+        from rudix.remote import RemoteRepository
+        remote = RemoteRepository(site_url='http://example.com',
+                                  osx_version='10.13')
+        remote.load_manifest(['foo-0.9.pkg', 'foo-1.1.pkg',
+                              'static-bar-2.1.pkg', 'other-3.0.pkg'])
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        repo = Repository(VOLUME, cache_dir=cache_dir)
+        repo.sync()
+        outdated = outdated_packages(repo, remote)
+        self.assertEqual([(p_local.name, p_local.version, p_remote.package)
+                          for p_local, p_remote in outdated],
+                         [('foo', '1.0', 'foo-1.1.pkg')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,754 @@
+import gzip
+import hashlib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import BaseHTTPServer
+import StringIO
+import SocketServer
+
+import rudix.core
+import rudix.remote
+from rudix.core import start_tracing
+from rudix.remote import *
+
+
+class CatalogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    files = {'/master/00MANIFEST.txt': 'foo-1.0.pkg\nfoo-1.1.pkg\n',
+             '/master/00ALIASES.txt': 'bar->foo\n'}
+    requests = []
+    digests = False
+    compress = False
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = self.files.get(self.path)
+        if self.digests and self.path.endswith('.sha256'):
+            body = self.files.get(self.path[:-len('.sha256')])
+            if body is not None:
+                body = hashlib.sha256(body).hexdigest() + '  name\n'
+        etag = '"%d"' % hash(body)
+        self.requests.append((self.path, self.headers.get('If-None-Match'),
+                              self.headers.get('Range')))
+        byte_range = self.headers.get('Range')
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+        elif byte_range:
+            start = int(byte_range[len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(body) - 1, len(body)))
+            self.send_header('Content-Length', str(len(body) - start))
+            self.end_headers()
+            self.wfile.write(body[start:])
+        else:
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            if self.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                out = StringIO.StringIO()
+                with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                    f.write(body)
+                body = out.getvalue()
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PackageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    body = ''.join(chr(i % 251) for i in range(300000))
+    etag = '"v1"'
+    ranges = True
+    connections = []
+    requests = []
+    fail = set()
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+
+    def do_GET(self):
+        start, end = 0, len(self.body) - 1
+        byte_range = self.headers.get('Range')
+        self.requests.append(byte_range)
+        if byte_range and self.headers.get('If-Range', self.etag) != self.etag:
+            byte_range = None
+        if byte_range and self.ranges:
+            first, last = byte_range[len('bytes='):].split('-')
+            start = int(first)
+            end = min(int(last), end) if last else end
+            if start in self.fail:
+                self.fail.discard(start)
+                self.send_error(500)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', 'Sun, 18 Mar 2018 12:00:00 GMT')
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(self.body[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class MirrorHandler(PackageHandler):
+
+    """PackageHandler that answers after delay seconds and drops the
+    connection after sending drop bytes of a body."""
+
+    delay = 0
+    drop = None
+
+    def handle(self):
+        # Clients hang up on the mirrors that lose a race
+        try:
+            PackageHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            PackageHandler.finish(self)
+        except socket.error:
+            pass
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        start, end = 0, len(self.body) - 1
+        byte_range = self.headers.get('Range')
+        self.requests.append(byte_range)
+        if byte_range and self.headers.get('If-Range', self.etag) != self.etag:
+            byte_range = None
+        if byte_range and self.ranges:
+            first, last = byte_range[len('bytes='):].split('-')
+            start = int(first)
+            end = min(int(last), end) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        data = self.body[start:end + 1]
+        if self.drop is not None:
+            data = data[:self.drop]
+            self.close_connection = 1
+        self.wfile.write(data)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+class FakePackage(object):
+
+    def __init__(self, package, fail=False):
+        self.package = package
+        self.fail = fail
+
+    def download(self, store_path=None, verbose=False):
+        time.sleep(0.05)
+        if self.fail:
+            return None
+        return store_path or '/tmp/' + self.package
+
+
+class DownloaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.packages = [FakePackage('p%d-1.0-0.pkg' % i) for i in range(8)]
+
+    def test_order(self):
+        paths = Downloader(jobs=4).download(self.packages, store_dir='/x')
+        self.assertEqual(paths,
+                         ['/x/' + p.package for p in self.packages])
+
+    def test_failure(self):
+        self.packages[3].fail = True
+        paths = Downloader(jobs=3).download(self.packages)
+        self.assertEqual(paths[3], None)
+        self.assertEqual(paths.count(None), 1)
+
+    def test_concurrency(self):
+        start = time.time()
+        Downloader(jobs=8).download(self.packages)
+        self.assertTrue(time.time() - start < 0.05 * len(self.packages))
+
+
+class PrefetchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.packages = [FakePackage('p%d-1.0-0.pkg' % i) for i in range(6)]
+
+    def test_order(self):
+        self.packages[2].fail = True
+        prefetch = Prefetch(Downloader(), self.packages, store_dir='/x')
+        self.addCleanup(prefetch.close)
+        paths = [prefetch.get(p.package) for p in self.packages]
+        self.assertEqual(paths[2], None)
+        self.assertEqual(paths[:2], ['/x/p0-1.0-0.pkg', '/x/p1-1.0-0.pkg'])
+        self.assertEqual(prefetch.get('unknown.pkg'), None)
+
+    def test_lookahead(self):
+        prefetch = Prefetch(Downloader(jobs=4), self.packages, lookahead=1)
+        prefetch.get(self.packages[0].package)
+        prefetch.close()
+        # Only the package asked for and the next one were downloaded
+        self.assertEqual(len([p for p in prefetch.values() if p]), 2)
+
+    def test_overlap(self):
+        prefetch = Prefetch(Downloader(), self.packages, lookahead=2)
+        for pkg in self.packages:
+            prefetch.get(pkg.package)
+            time.sleep(0.05)  # installing
+        prefetch.close()
+        # Serially this takes 12 * 0.05s, pipelined about 7 * 0.05s
+        self.assertTrue(prefetch.elapsed < 0.5)
+        self.assertTrue('saved' in str(prefetch))
+
+
+class RemoteRepositoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = RemoteRepository(site_url='http://example.com')
+        self.remote.load_manifest(['foo-1.10.pkg',
+                                   'foo-1.2.pkg',
+                                   'foo-bar-2.0.pkg',
+                                   'foo-1.2.pkg',
+                                   'README',
+                                   'foo-1.9.pkg'])
+
+    def test_match_package(self):
+        p = self.remote.match_package('foo-1.2.pkg')
+        self.assertEqual(p.name, 'foo')
+        self.assertEqual(p.url, 'http://example.com/master')
+        self.assertEqual(self.remote.match_package('foo'), None)
+
+    def test_get_versions(self):
+        versions = [p.package for p in self.remote.get_versions('foo')]
+        self.assertEqual(versions, ['foo-1.10.pkg', 'foo-1.9.pkg',
+                                    'foo-1.2.pkg'])
+        self.assertEqual(self.remote.get_versions('bar'), [])
+
+    def test_latest_version(self):
+        self.assertEqual(self.remote.latest_version('foo-bar').package,
+                         'foo-bar-2.0.pkg')
+        self.assertEqual(self.remote.latest_version('bar'), None)
+
+    def test_latest_versions(self):
+        latest = self.remote.latest_versions(['bar', 'foo', 'foo-bar'])
+        self.assertEqual(latest[0], None)
+        self.assertEqual([p.package for p in latest[1:]],
+                         ['foo-1.10.pkg', 'foo-bar-2.0.pkg'])
+
+
+class NameIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = NameIndex(['openssl', 'libressl', 'ssldump', 'ssl',
+                                'wget', 'git', 'gitflow', 'python'])
+
+    def test_substring(self):
+        self.assertEqual(self.index.search('ssl', fuzzy=False),
+                         ['ssl', 'ssldump', 'openssl', 'libressl'])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.search('gi'), ['git', 'gitflow'])
+        self.assertEqual(self.index.search('it'), [])
+
+    def test_fuzzy(self):
+        self.assertEqual(self.index.search('pyhton'), ['python'])
+        self.assertEqual(self.index.search('wegt'), ['wget'])
+        self.assertEqual(self.index.search('xyz'), [])
+        self.assertEqual(self.index.search('wgets'), ['wget'])
+        self.assertEqual(self.index.search('gti'), ['git'])
+        self.assertEqual(self.index.search('gitt'), ['git'])
+
+    def test_limit(self):
+        self.assertEqual(self.index.search('ssl', limit=2), ['ssl', 'ssldump'])
+
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance('kitten', 'sitting', 3), 3)
+        self.assertEqual(edit_distance('kitten', 'sitting', 1), 2)
+
+    def test_repository(self):
+        remote = RemoteRepository(site_url='http://example.com')
+        remote.load_manifest(['openssl-1.0.pkg', 'libressl-2.0.pkg'])
+        remote.aliases['ssl'] = 'openssl'
+        self.assertEqual(remote.search('ssl'), ['ssl', 'openssl', 'libressl'])
+        remote.load_manifest(['wget-1.0.pkg'])
+        self.assertEqual(remote.search('wget'), ['wget'])
+
+
+class PackageCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.site = start_server(PackageHandler)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = PackageCache(os.path.join(self.tmp_dir, 'cache'))
+        del PackageHandler.requests[:]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def package(self, name='foo-1.0.pkg'):
+        return RemotePackage(name, site_url=self.site)
+
+    def test_reuse(self):
+        downloader = Downloader(cache=self.cache)
+        path, = downloader.download([self.package()])
+        self.assertTrue(path.startswith(self.cache.tmp))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), PackageHandler.body)
+        os.remove(path)
+        requests = len(PackageHandler.requests)
+        path, = downloader.download([self.package()], store_dir=self.tmp_dir)
+        self.assertEqual(path, os.path.join(self.tmp_dir, 'foo-1.0.pkg'))
+        self.assertEqual(len(PackageHandler.requests), requests)
+        cached = self.cache.lookup('foo-1.0.pkg')
+        self.assertEqual(os.path.basename(cached), content_hash(cached))
+        # Packages outside the cache are copies, not links
+        self.assertFalse(os.path.samefile(path, cached))
+
+    def test_offline(self):
+        downloader = Downloader(cache=self.cache, offline=True)
+        self.assertEqual(downloader.download([self.package()]), [None])
+        self.assertEqual(PackageHandler.requests, [])
+
+    def test_trim(self):
+        downloader = Downloader(cache=self.cache)
+        for i, name in enumerate(['a-1.pkg', 'b-1.pkg', 'c-1.pkg']):
+            downloader.download([self.package(name)], store_dir=self.tmp_dir)
+            os.utime(self.cache.lookup(name), (i, i))
+        self.cache.max_size = 2 * len(PackageHandler.body)
+        self.cache.checkout('a-1.pkg', os.path.join(self.tmp_dir, 'a'))
+        downloader.download([self.package('d-1.pkg')], store_dir=self.tmp_dir)
+        self.assertEqual(sorted(name for name in os.listdir(self.cache.root)
+                                if not name.startswith('.')),
+                         ['a-1.pkg', 'd-1.pkg'])
+
+
+    def test_oversized(self):
+        for max_size in (0, len(PackageHandler.body) // 3):
+            self.cache.max_size = max_size
+            downloader = Downloader(jobs=3, cache=self.cache)
+            names = ['%s-%d.pkg' % (name, max_size) for name in 'abc']
+            paths = downloader.download([self.package(name)
+                                         for name in names],
+                                        store_dir=self.tmp_dir)
+            self.assertEqual(paths, [os.path.join(self.tmp_dir, name)
+                                     for name in names])
+            for path in paths:
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), PackageHandler.body)
+        self.assertEqual([name for name in os.listdir(self.cache.tmp)
+                          if name.endswith('.lock')], [])
+
+
+class CatalogCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.site = start_server(CatalogHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        del CatalogHandler.requests[:]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def remote(self):
+        return RemoteRepository(site_url=self.site, cache_dir=self.cache_dir)
+
+    def test_sync(self):
+        remote = self.remote()
+        self.assertTrue(remote.sync())
+        self.assertEqual(remote.packages, ['foo-1.0.pkg', 'foo-1.1.pkg'])
+        self.assertEqual(remote.aliases, {'bar': 'foo'})
+
+    def test_fresh(self):
+        self.remote().sync()
+        self.remote().sync()
+        self.assertEqual(len(CatalogHandler.requests), 2)
+
+    def test_revalidate(self):
+        self.remote().sync()
+        remote = self.remote()
+        remote.cache.ttl = 0
+        remote.sync()
+        # Both files probed for a digest first, then revalidated
+        self.assertEqual(len(CatalogHandler.requests), 6)
+        self.assertTrue(CatalogHandler.requests[-1][1])
+        self.assertEqual(len(remote.packages), 2)
+        remote.sync()
+        # No digests published, so they are not asked for again
+        self.assertEqual(len(CatalogHandler.requests), 8)
+
+    def test_gzip(self):
+        CatalogHandler.compress = True
+        self.addCleanup(setattr, CatalogHandler, 'compress', False)
+        remote = self.remote()
+        self.assertTrue(remote.sync())
+        self.assertEqual(remote.packages, ['foo-1.0.pkg', 'foo-1.1.pkg'])
+        remote.cache.ttl = 0
+        self.assertTrue(remote.sync())
+        self.assertEqual(remote.packages, ['foo-1.0.pkg', 'foo-1.1.pkg'])
+
+    def test_delta(self):
+        name = '/master/00MANIFEST.txt'
+        files = dict(CatalogHandler.files)
+        self.addCleanup(setattr, CatalogHandler, 'files', files)
+        CatalogHandler.digests = True
+        self.addCleanup(setattr, CatalogHandler, 'digests', False)
+        CatalogHandler.files = dict(files)
+        CatalogHandler.files[name] = ''.join('p%d-1.0.pkg\n' % i
+                                             for i in range(1000))
+        self.remote().sync()
+        CatalogHandler.files[name] += 'new-1.0.pkg\n'
+        del CatalogHandler.requests[:]
+        remote = self.remote()
+        remote.cache.ttl = 0
+        self.assertTrue(remote.sync())
+        self.assertEqual(len(remote.packages), 1001)
+        self.assertEqual(remote.packages[-1], 'new-1.0.pkg')
+        ranges = [r[2] for r in CatalogHandler.requests if r[0] == name]
+        self.assertEqual(len(ranges), 1)
+        self.assertTrue(ranges[0].startswith('bytes='))
+        # A rewritten file does not match the digest and is downloaded again
+        CatalogHandler.files[name] = 'foo-2.0.pkg\n' * 2000
+        del CatalogHandler.requests[:]
+        self.assertTrue(remote.sync())
+        self.assertEqual(remote.packages, ['foo-2.0.pkg'] * 2000)
+        self.assertEqual([r[2] for r in CatalogHandler.requests
+                          if r[0] == name][-1], None)
+
+    def test_refresh(self):
+        self.remote().sync()
+        self.remote().sync(refresh=True)
+        self.assertEqual(len(CatalogHandler.requests), 4)
+        self.assertEqual(CatalogHandler.requests[-1][1], None)
+
+    def test_offline(self):
+        remote = RemoteRepository(site_url=self.site, cache_dir=self.cache_dir,
+                                  offline=True)
+        self.assertFalse(remote.sync())
+        self.remote().sync()
+        remote.cache.ttl = 0
+        self.assertTrue(remote.sync())
+        self.assertEqual(len(CatalogHandler.requests), 2)
+
+    def test_missing(self):
+        remote = RemoteRepository(site_url=self.site, rudix_version='none',
+                                  cache_dir=self.cache_dir)
+        self.assertFalse(remote.sync())
+
+    def test_concurrent(self):
+        CatalogHandler.delay = 0.2
+        self.addCleanup(setattr, CatalogHandler, 'delay', 0)
+        start = time.time()
+        self.assertTrue(self.remote().sync())
+        # The manifest and the aliases were requested at the same time
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_catalogs(self):
+        catalogs = Catalogs([('master', '10.13'), ('master', '10.14'),
+                             ('none', '10.13')],
+                            site_url=self.site, cache_dir=self.cache_dir)
+        self.assertEqual(catalogs.sync(), [('none', '10.13')])
+        synced = list(catalogs)
+        self.assertEqual([target for target, _ in synced],
+                         [('master', '10.13'), ('master', '10.14')])
+        first, second = [repo for _, repo in synced]
+        # One copy of the catalog for both targets
+        self.assertTrue(first.packages is second.packages)
+        self.assertTrue(first.name_index is second.name_index)
+        self.assertEqual(len([r for r in CatalogHandler.requests
+                              if r[0].startswith('/master/')]), 2)
+        self.assertEqual(second.search('bar'), ['bar'])
+        self.assertEqual(second.latest_version('foo').package, 'foo-1.1.pkg')
+
+    def test_parse_targets(self):
+        osx_version = rudix.core.get_osx_version()
+        self.assertEqual(parse_targets(None),
+                         [(rudix.core.RudixVersion, osx_version)])
+        self.assertEqual(parse_targets(['2018:10.12', ':10.14', '2018:10.12',
+                                        'master:']),
+                         [('2018', '10.12'),
+                          (rudix.core.RudixVersion, '10.14'),
+                          ('master', osx_version)])
+
+
+class TransportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.site = start_server(PackageHandler)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'foo-1.0.pkg')
+        del PackageHandler.connections[:]
+        del PackageHandler.requests[:]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def check_resume(self, transport):
+        with open(self.path, 'wb') as f:
+            f.write(PackageHandler.body[:1000])
+        code, headers = transport.get(self.site + '/foo-1.0.pkg', self.path,
+                                      resume=True)
+        self.assertEqual(code, 200)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), PackageHandler.body)
+        self.assertEqual(os.path.getmtime(self.path), 1521374400)
+
+    def test_http_resume(self):
+        self.check_resume(HTTPTransport())
+
+    def test_curl_resume(self):
+        self.check_resume(CurlTransport())
+
+    def test_curl_truncated(self):
+        class Broken(MirrorHandler):
+            drop = 1000
+        server, site = start_server(Broken)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        code, _ = CurlTransport().get(site + '/foo-1.0.pkg', self.path)
+        self.assertEqual(code, 0)
+
+    def test_http_truncated(self):
+        class Broken(MirrorHandler):
+            drop = 1000
+        server, site = start_server(Broken)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        transport = HTTPTransport()
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            code, _ = transport.get(site + '/foo-1.0.pkg', self.path)
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(code, 0)
+        # The broken connection was not kept for the next request
+        self.assertEqual(transport._idle.get(('http', site[len('http://'):])),
+                         None)
+
+    def test_trace(self):
+        tracer = start_tracing()
+        self.addCleanup(setattr, rudix.core, '_tracer', None)
+        HTTPTransport().get(self.site + '/foo-1.0.pkg', self.path)
+        RemotePackage('foo-1.0.pkg', self.site, '').download(self.path)
+        self.assertEqual([(e['kind'], e['name'], e['bytes'])
+                          for e in tracer.events],
+                         [('http', 'GET', len(PackageHandler.body)),
+                          ('http', 'segmented', len(PackageHandler.body))])
+
+    def test_keep_alive(self):
+        transport = HTTPTransport()
+        for i in range(5):
+            code, _ = transport.get(self.site + '/foo-1.0.pkg', self.path)
+            self.assertEqual(code, 200)
+        self.assertEqual(transport.stats, {'requests': 5, 'connections': 1})
+        self.assertEqual(len(PackageHandler.connections), 1)
+        transport.close()
+
+    def test_segmented(self):
+        download = SegmentedDownload(self.site + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport(), jobs=3, block_size=65536)
+        self.assertEqual(download.run(), 200)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), PackageHandler.body)
+        self.assertEqual(download.digest, content_hash(self.path, 65536))
+        self.assertEqual(len(PackageHandler.requests), 5)
+        self.assertFalse(os.path.exists(download.state_path))
+
+    def test_segmented_resume(self):
+        PackageHandler.fail.add(3 * 65536)
+        download = SegmentedDownload(self.site + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport(), jobs=1, block_size=65536)
+        self.assertRaises(IOError, download.run)
+        self.assertTrue(os.path.exists(download.state_path))
+        del PackageHandler.requests[:]
+        download = SegmentedDownload(self.site + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport(), jobs=2, block_size=65536)
+        self.assertEqual(download.run(), 200)
+        # The probe comes first, the two jobs then race each other
+        self.assertEqual(PackageHandler.requests[0], 'bytes=0-0')
+        self.assertEqual(sorted(PackageHandler.requests[1:]),
+                         ['bytes=196608-262143', 'bytes=262144-299999'])
+        self.assertEqual(download.digest, content_hash(self.path, 65536))
+
+    def test_segmented_changed(self):
+        PackageHandler.fail.add(3 * 65536)
+        download = SegmentedDownload(self.site + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport(), jobs=1, block_size=65536)
+        self.assertRaises(IOError, download.run)
+        PackageHandler.etag = '"v2"'
+        self.addCleanup(setattr, PackageHandler, 'etag', '"v1"')
+        self.assertEqual(download.run(), 200)
+        self.assertEqual(download.digest, content_hash(self.path, 65536))
+
+    def test_no_ranges(self):
+        PackageHandler.ranges = False
+        self.addCleanup(setattr, PackageHandler, 'ranges', True)
+        download = SegmentedDownload(self.site + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport(), block_size=65536)
+        self.assertEqual(download.run(), 200)
+        self.assertEqual(download.digest, content_hash(self.path, 65536))
+
+    def test_checksum(self):
+        download = SegmentedDownload(self.site + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport())
+        self.assertEqual(download.run(expected='0' * 64), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_fallback(self):
+        transport = HTTPTransport(fallback=CurlTransport())
+        code, _ = transport.get('ftp://127.0.0.1:1/foo', self.path)
+        self.assertEqual(code, 0)
+
+
+class MirrorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'foo-1.0.pkg')
+
+    def mirror(self, **attrs):
+        class Mirror(MirrorHandler):
+            requests = []
+            connections = []
+        for name, value in attrs.items():
+            setattr(Mirror, name, value)
+        server, site = start_server(Mirror)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return site, Mirror
+
+    def test_ranked(self):
+        slow, _ = self.mirror(delay=0.2)
+        fast, handler = self.mirror()
+        dead = 'http://127.0.0.1:1'
+        mirrors = MirrorSet([dead, slow, fast + '/'], cache_dir=self.tmp_dir)
+        self.assertEqual(mirrors.ranked(), [fast, slow, dead])
+        self.assertEqual(handler.requests, ['bytes=0-65535'])
+        self.assertEqual(mirrors.describe(dead), 'unreachable')
+        # The ranking is cached
+        mirrors = MirrorSet([fast, slow, dead], cache_dir=self.tmp_dir)
+        self.assertEqual(mirrors.ranked(), [fast, slow, dead])
+        self.assertEqual(len(handler.requests), 1)
+        mirrors.demote(fast + '/master/foo-1.0.pkg')
+        self.assertEqual(mirrors.alternatives(slow + '/master/foo-1.0.pkg'),
+                         [slow + '/master/foo-1.0.pkg',
+                          dead + '/master/foo-1.0.pkg',
+                          fast + '/master/foo-1.0.pkg'])
+        self.assertEqual(mirrors.alternatives('http://example.com/foo'),
+                         ['http://example.com/foo'])
+
+    def test_single(self):
+        site, handler = self.mirror()
+        self.assertEqual(MirrorSet([site], cache_dir=self.tmp_dir).ranked(),
+                         [site])
+        self.assertEqual(handler.requests, [])
+
+    def test_hedged(self):
+        slow, _ = self.mirror(delay=1)
+        fast, _ = self.mirror()
+        start = time.time()
+        code, _ = hedged_get([slow + '/foo', fast + '/foo'], self.path,
+                             transport=HTTPTransport())
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(code, 200)
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read() == MirrorHandler.body)
+
+    def test_hedged_failover(self):
+        broken, _ = self.mirror(drop=1000)
+        site, _ = self.mirror()
+        dead = 'http://127.0.0.1:1'
+        code, _ = hedged_get([dead + '/foo', broken + '/foo', site + '/foo'],
+                             self.path, transport=HTTPTransport())
+        self.assertEqual(code, 200)
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read() == MirrorHandler.body)
+
+    def test_failover(self):
+        broken, _ = self.mirror(drop=40000, etag='"a"')
+        site, handler = self.mirror(etag='"b"')
+        download = SegmentedDownload(broken + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport(), jobs=1,
+                                     block_size=65536,
+                                     mirrors=[site + '/foo-1.0.pkg'])
+        self.assertEqual(download.run(), 200)
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read() == MirrorHandler.body)
+        self.assertEqual(download.digest, content_hash(self.path, 65536))
+        # The first block was resumed where the broken mirror stopped
+        self.assertEqual(handler.requests[0], 'bytes=40000-65535')
+
+    def test_failover_stream(self):
+        broken, _ = self.mirror(drop=100000, ranges=False)
+        site, handler = self.mirror()
+        download = SegmentedDownload(broken + '/foo-1.0.pkg', self.path,
+                                     HTTPTransport(), block_size=65536,
+                                     mirrors=[site + '/foo-1.0.pkg'])
+        self.assertEqual(download.run(), 200)
+        self.assertEqual(handler.requests, ['bytes=100000-'])
+        self.assertEqual(download.digest, content_hash(self.path, 65536))
+
+    def test_download(self):
+        first, _ = self.mirror(drop=40000)
+        second, _ = self.mirror(drop=40000)
+        rudix.remote._mirrors = MirrorSet([first, second],
+                                          cache_dir=self.tmp_dir)
+        self.addCleanup(setattr, rudix.remote, '_mirrors', None)
+        package = RemotePackage('foo-1.0.pkg', first, 'master')
+        self.assertEqual(package.download(self.path), None)
+        third, _ = self.mirror()
+        rudix.remote._mirrors = MirrorSet([first, second, third],
+                                          cache_dir=self.tmp_dir)
+        self.assertEqual(package.download(self.path), self.path)
+        self.assertEqual(package.digest, content_hash(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+VOLUME = os.path.join(os.path.dirname(__file__), 'volume')
+
+# Modules that a local-only command must not import
+NETWORK = ['rudix.remote', 'httplib', 'socket', 'ssl', 'json', 'platform',
+           'email', 'gzip', 'tempfile']
+
+# Seconds of start up allowed over an empty interpreter
+BUDGET = 0.5
+
+
+def run(code, cache_dir):
+    # The index of the test volume must not land in the user's cache
+    env = dict(os.environ, RUDIX_CACHE=cache_dir)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT,
+                                  env=env)
+    return out.splitlines()
+
+
+class StartupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_local_imports(self):
+        code = ('import sys; from rudix.main import main; '
+                'main(["--list", "--volume", %r]); '
+                'print " ".join(m for m in sys.modules '
+                'if sys.modules[m])' % VOLUME)
+        modules = run(code, self.cache_dir)[-1].split()
+        self.assertTrue('rudix.local' in modules)
+        for name in NETWORK:
+            self.assertFalse(name in modules, '%s imported' % name)
+
+    def test_budget(self):
+        def best(code):
+            times = []
+            for _ in range(3):
+                start = time.time()
+                run(code, self.cache_dir)
+                times.append(time.time() - start)
+            return min(times)
+        overhead = best('from rudix.main import main; '
+                        'main(["--list", "--volume", %r])' % VOLUME) - \
+            best('pass')
+        self.assertTrue(overhead < BUDGET, '%.2fs' % overhead)
+
+
+if __name__ == '__main__':
+    unittest.main()